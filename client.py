@@ -6,10 +6,16 @@ import time
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
 import queue
+import protocol
 
 SERVER_HOST = '127.0.0.1'  # Change to server's IP if not local
 SERVER_PORT = 65432
 BUFFER_SIZE = 4096
+SESSION_FILE = '.lost_and_found_session'  # Remembers the server session so your open items follow you across restarts
+USE_BINARY_PROTOCOL = True  # Switch to the compact binary protocol when the server offers it
+USE_COMPRESSION = True  # Ask for deflated item listings (binary protocol only); saves bandwidth on slow links
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # Largest line or frame accepted from the server
+HEARTBEAT_MISSES = 3  # Heartbeat intervals without a byte from the server (each followed by a PING) before the connection counts as lost
 
 # Dark theme color palette
 COLORS = {
@@ -336,7 +342,7 @@ class ChatWindow(tk.Toplevel):
     def send_chat_message_event(self, event=None):
         message = self.chat_input_entry.get().strip()
         if message:
-            self.parent_app.send_to_server(message + "\n") 
+            self.parent_app.send_to_server(message + "\n", chat=message.lower() != "/exit_chat")
             self.display_message_in_chat(f"You: {message}", "user_msg")
             self.chat_input_entry.delete(0, tk.END)
             if message.lower() == "/exit_chat":
@@ -362,6 +368,8 @@ class LostFoundApp:
         self.setup_styles()
 
         self.client_socket = None
+        self.binary_protocol = False  # Set by the receiver thread once we asked for binary framing
+        self.send_lock = threading.Lock()  # Keeps the protocol switch atomic with respect to sends
         self.receiver_thread = None
         self.stop_receiver_event = threading.Event()
         self.message_queue = queue.Queue()
@@ -371,6 +379,13 @@ class LostFoundApp:
         # Add loading state management
         self.loading_items = False
 
+        # Local copy of the server's items by id, refreshed with GET_CHANGES_SINCE items_seq
+        self.item_cache = {}
+        self.items_seq = 0
+        self.sync_items = None  # Where a CHANGES reply in progress goes: a new dict for a full resync, else item_cache
+        self.sync_changed = 0
+        self.pending_seq = 0
+
         self.create_widgets()
         self.connect_to_server()
 
@@ -502,37 +517,106 @@ class LostFoundApp:
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((SERVER_HOST, SERVER_PORT))
-            self.client_socket.settimeout(1.0) 
             self.display_message_main(f"🌐 Connected to server at {SERVER_HOST}:{SERVER_PORT}", "system_msg")
 
             self.stop_receiver_event.clear()
             self.receiver_thread = threading.Thread(target=self.receive_messages_thread, args=(self.client_socket,))
             self.receiver_thread.daemon = True
             self.receiver_thread.start()
+
+            # Pick up the items reported in our previous session, if the server still knows it
+            try:
+                with open(SESSION_FILE) as f:
+                    session_token = f.read().strip()
+                if session_token:
+                    self.send_to_server(f"RESUME {session_token}\n")
+            except OSError:
+                pass
         except socket.error as e:
             self.display_message_main(f"❌ Could not connect to server: {e}", "error_msg")
             messagebox.showerror("Connection Error", f"Could not connect to server: {e}")
             self.root.quit()
 
+    def request_binary_protocol(self, sock, compress=False):
+        # Everything sent after this line must be framed, so switch under the send lock
+        with self.send_lock:
+            request = b"PROTOCOL binary\n"
+            if compress:
+                request += protocol.encode_text("COMPRESS zlib")
+            sock.sendall(request)
+            self.binary_protocol = True
+
+    def answer_heartbeat(self, sock, message):
+        # Sends PING or PONG from the receiver thread, so no GUI calls here
+        with self.send_lock:
+            sock.sendall(protocol.encode_text(message) if self.binary_protocol else message.encode('utf-8') + b"\n")
+
     def receive_messages_thread(self, sock):
+        # Lines, frames and UTF-8 characters can be split across recv() calls; the decoder keeps the tail
+        decoder = protocol.StreamDecoder(MAX_MESSAGE_SIZE)
+        inflater = protocol.FrameInflater(MAX_MESSAGE_SIZE)
+
+        def frames():
+            # Deflated listings carry ordinary frames; inflate them as each piece arrives
+            for frame_type, payload in decoder.messages():
+                if frame_type == protocol.FRAME_DEFLATE:
+                    yield from inflater.feed(payload)
+                else:
+                    yield frame_type, payload
+
+        missed_heartbeats = 0
         while not self.stop_receiver_event.is_set():
             try:
                 response = sock.recv(BUFFER_SIZE)
+                missed_heartbeats = 0
                 if not response:
                     self.message_queue.put(("CONNECTION_LOST", "🔌 Connection lost to server."))
                     break
                 
-                decoded_response = response.decode('utf-8')
-                messages = decoded_response.split('\n') 
-
-                for msg_raw in messages:
-                    msg = msg_raw.strip()
-                    if not msg:
+                decoder.feed(response)
+                for frame_type, payload in frames():
+                    if frame_type == protocol.FRAME_ITEMS:
+                        self.message_queue.put(("ITEMS", protocol.decode_items(payload)))
                         continue
-                    self.message_queue.put(("SERVER_DATA", msg))
+                    if frame_type == protocol.FRAME_CHAT:
+                        self.message_queue.put(("CHAT", protocol.decode_chat(payload)))
+                        continue
+                    if frame_type != protocol.FRAME_TEXT:
+                        continue
+                    for msg_raw in payload.decode('utf-8', errors='replace').split('\n'):
+                        msg = msg_raw.strip()
+                        if not msg:
+                            continue
+                        if msg == "PROTOCOL binary":
+                            decoder.switch_to_binary() # The server frames everything after this line
+                        elif msg == "COMPRESS zlib":
+                            continue # Acknowledges our request; nothing to show
+                        elif msg == "PING":
+                            self.answer_heartbeat(sock, "PONG")
+                        elif msg == "PONG":
+                            continue # Answers our PING
+                        elif msg.startswith("CAPABILITIES"):
+                            capabilities = msg.split()[1:]
+                            for capability in capabilities:
+                                if capability.startswith("heartbeat="):
+                                    sock.settimeout(int(capability.split("=", 1)[1]))
+                            if USE_BINARY_PROTOCOL and "binary" in capabilities:
+                                self.request_binary_protocol(sock, USE_COMPRESSION and "zlib" in capabilities)
+                            if any(capability.startswith("heartbeat=") for capability in capabilities):
+                                self.answer_heartbeat(sock, "PING") # Tells the server we take part in heartbeats
+                        else:
+                            self.message_queue.put(("SERVER_DATA", msg))
 
             except socket.timeout:
-                continue 
+                # Quiet for a heartbeat interval: ask the server for a PONG, and give up after HEARTBEAT_MISSES
+                missed_heartbeats += 1
+                if missed_heartbeats >= HEARTBEAT_MISSES:
+                    self.message_queue.put(("CONNECTION_LOST", "🔌 The server stopped responding."))
+                    break
+                try:
+                    self.answer_heartbeat(sock, "PING")
+                except OSError:
+                    pass # The next recv reports the failure
             except ConnectionResetError:
                 self.message_queue.put(("CONNECTION_LOST", "🔌 Connection reset by server."))
                 break
@@ -578,10 +662,30 @@ class LostFoundApp:
         elif msg_type == "THREAD_STOPPED":
             self.display_message_main(data, "system_msg")
             return
+        elif msg_type == "CHAT":
+            sender_tag, text = data
+            if self.active_chat_window:
+                self.active_chat_window.display_message_in_chat(f"[{sender_tag}]: {text}", "partner_msg")
+            else:
+                self.display_message_main(f"💬 [UNHANDLED] [{sender_tag}]: {text}", "error_msg")
+            return
+        elif msg_type == "ITEMS":
+            if self.sync_items is not None:  # Part of a CHANGES reply
+                self.apply_changed_items(data)
+                return
+            for item in data:
+                self.display_item(item)
+            return
         elif msg_type == "SERVER_DATA":
             msg = data 
             if msg.startswith("WELCOME"):
                 self.display_message_main(f"🎉 {msg.split(' ', 1)[1]}", "server_msg")
+            elif msg.startswith("SESSION"):
+                try:
+                    with open(SESSION_FILE, 'w') as f:
+                        f.write(msg.split(" ", 1)[1])
+                except (IndexError, OSError) as e:
+                    self.display_message_main(f"❌ Could not save session: {e}", "error_msg")
             elif msg.startswith("LOCATIONS"):
                 try:
                     locations_json = msg.split(" ", 1)[1]
@@ -634,6 +738,28 @@ class LostFoundApp:
             elif msg.startswith("ITEM:"):
                 item_details = msg.split("ITEM: ", 1)[1]
                 self.display_message_main(f"  📌 {item_details}", "all_item_entry")
+            elif msg.startswith("CHANGES "):
+                _, seq, kind = msg.split()
+                self.pending_seq = int(seq)
+                self.sync_items = {} if kind == "full" else self.item_cache
+                self.sync_changed = 0
+                self.loading_items = True
+                self.view_all_items_button.config(text="⏳ Loading...", state=tk.DISABLED,
+                                                 bg=COLORS['bg_tertiary'], fg=COLORS['fg_secondary'])
+            elif msg.startswith("CHANGED ") and self.sync_items is not None:
+                try:
+                    self.apply_changed_items([json.loads(msg.split(" ", 1)[1])])
+                except json.JSONDecodeError as e:
+                    self.display_message_main(f"❌ Could not parse item: {e}", "error_msg")
+            elif msg.startswith("REMOVED ") and self.sync_items is not None:
+                for item_id in msg.split()[1:]:
+                    if self.sync_items.pop(item_id, None) is not None:
+                        self.sync_changed += 1
+            elif msg == "CHANGES_END" and self.sync_items is not None:
+                full_resync = self.sync_items is not self.item_cache
+                self.item_cache, self.sync_items = self.sync_items, None
+                self.items_seq = self.pending_seq
+                self.show_cached_items(None if full_resync else self.sync_changed)
             elif msg == "SERVER_SHUTDOWN The server is shutting down. Goodbye.":
                 self.display_message_main(f"🛑 {msg}", "error_msg")
                 self.stop_receiver_event.set()
@@ -645,6 +771,33 @@ class LostFoundApp:
             else:
                 if not any(msg.startswith(prefix) for prefix in ["YOUR_ITEMS", "END_YOUR_ITEMS", "ALL_ITEMS_START", "ALL_ITEMS_END", "ITEM:"]):
                     self.display_message_main(msg, "server_msg") 
+
+    def display_item(self, item):
+        self.display_message_main(
+            f"  📌 Type: {item['status'].capitalize()}, Name: {item['name']}, Color: {item['color']}, "
+            f"Location: {item['location']}, Description: {item['description']}, "
+            f"Reported: {item['timestamp']}, Matched: {'Yes' if item['matched'] else 'No'}", "all_item_entry")
+
+    def apply_changed_items(self, items):
+        for item in items:
+            self.sync_items[item['id']] = item
+        self.sync_changed += len(items)
+
+    def show_cached_items(self, changed):
+        # changed: how many items the delta brought, or None after a full resync
+        self.display_message_main("\n📋 ═══ All Reported Items ═══", "all_items_header")
+        if not self.item_cache:
+            self.display_message_main("  📌 No items reported yet.", "all_item_entry")
+        for item in sorted(self.item_cache.values(), key=lambda item: item['timestamp']):
+            self.display_item(item)
+        if changed is None:
+            self.display_message_main(f"✅ {len(self.item_cache)} items loaded.", "loading_msg")
+        else:
+            self.display_message_main(f"✅ {len(self.item_cache)} items ({changed} updated since the last refresh).", "loading_msg")
+        self.display_message_main("══════════════════════════", "all_items_header")
+        self.loading_items = False
+        self.view_all_items_button.config(text="📋 View All Items", state=tk.NORMAL,
+                                         bg=COLORS['bg_secondary'], fg=COLORS['fg_info'])
     
     def disable_all_controls_on_disconnect(self):
         self.report_lost_button.config(state=tk.DISABLED, bg=COLORS['bg_tertiary'], fg=COLORS['fg_secondary'])
@@ -665,10 +818,17 @@ class LostFoundApp:
             else:
                 self.disable_all_controls_on_disconnect()
 
-    def send_to_server(self, message):
+    def send_to_server(self, message, chat=False):
         if self.client_socket and not self.stop_receiver_event.is_set():
             try:
-                self.client_socket.sendall(message.encode('utf-8'))
+                with self.send_lock:
+                    if not self.binary_protocol:
+                        data = message.encode('utf-8')
+                    elif chat:
+                        data = protocol.encode_chat("", message.rstrip("\n"))
+                    else:
+                        data = protocol.encode_text(message)
+                    self.client_socket.sendall(data)
             except socket.error as e:
                 self.display_message_main(f"❌ Could not send message: {e}", "error_msg")
                 self.message_queue.put(("CONNECTION_LOST", f"🔌 Connection error on send: {e}"))
@@ -701,9 +861,10 @@ class LostFoundApp:
             messagebox.showinfo("Please Wait", "Items are already being loaded. Please wait...", parent=self.root)
             return
         
-        self.send_to_server("GET_ALL_ITEMS\n")
+        # Only the items changed since the last refresh are sent (all of them the first time)
+        self.send_to_server(f"GET_CHANGES_SINCE {self.items_seq}\n")
         self.display_message_main("📋 Requested all reported items.", "user_action")
-        # The loading state will be set when ALL_ITEMS_START is received
+        # The loading state will be set when CHANGES is received
 
     def on_closing(self):
         if messagebox.askokcancel("Quit", "Do you want to quit?"):
@@ -716,16 +877,17 @@ class LostFoundApp:
                 except tk.TclError: pass
                 self.active_chat_window = None
 
+            if self.client_socket:
+                try:
+                    self.client_socket.shutdown(socket.SHUT_RDWR) # Wakes the receiver thread out of recv
+                except (OSError, socket.error): pass 
+
             if self.receiver_thread and self.receiver_thread.is_alive():
                 self.receiver_thread.join(timeout=1.0) 
 
             if self.client_socket:
-                try:
-                    self.client_socket.shutdown(socket.SHUT_RDWR)
-                except (OSError, socket.error): pass 
-                finally:
-                    try: self.client_socket.close()
-                    except socket.error: pass 
+                try: self.client_socket.close()
+                except socket.error: pass 
             self.root.destroy()
             sys.exit(0)
 
@@ -0,0 +1,355 @@
+"""
+Headless load generator for the Lost & Found server.
+
+Simulated clients speak the text protocol over real sockets (one asyncio event loop per
+worker process). Clients work in pairs: one reports a lost item, the other a found item
+that matches it (or, for the share of pairs above --match-rate, one that does not). Matched
+pairs then chat back and forth and leave the chat, and some clients fetch GET_ALL_ITEMS.
+
+By default a fresh server is started in a temporary directory, so every run starts from
+the same empty state and its memory use can be sampled:
+
+    python loadtest.py --scenario mixed
+    python loadtest.py --scenario reports --save before.json
+    python loadtest.py --scenario reports --baseline before.json   # after a change
+
+Reported: throughput, report -> MATCH_FOUND latency, chat relay latency, GET_ALL_ITEMS
+latency and the server's resident memory (Linux only).
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import signal
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 65433 # Not the default port, so a running server is left alone
+REPLY_TIMEOUT = 30 # Seconds to wait for an expected reply before counting an error
+CONNECT_CONCURRENCY = 64 # Connections being opened at once (per worker)
+LOCATIONS = ["A Block", "B Block", "C Block", "Cafe", "Library", "Sports Complex", "Admin Building", "Hostel A", "Hostel B"]
+COLORS = ["Black", "White", "Red", "Blue", "Green", "Yellow", "Brown", "Pink", "Purple", "Orange"]
+
+# Repeatable benchmark scenarios (all runs are seeded, see --seed)
+SCENARIOS = {
+    'smoke': dict(pairs=50, match_rate=0.5, chat_messages=3, listing_rate=0.1, preload=0),
+    'reports': dict(pairs=1000, match_rate=0.5, chat_messages=0, listing_rate=0.0, preload=0),
+    'chat': dict(pairs=200, match_rate=1.0, chat_messages=50, listing_rate=0.0, preload=0),
+    'listing': dict(pairs=100, match_rate=0.0, chat_messages=0, listing_rate=0.5, preload=20000),
+    'mixed': dict(pairs=2000, match_rate=0.3, chat_messages=5, listing_rate=0.01, preload=5000),
+}
+# The spawned server runs without rate limits or a connection cap, so runs measure the server
+# rather than its protection from misbehaving clients (--server-arg can set them again)
+UNLIMITED_SERVER_ARGS = [f"{option}={rate_class}=off" for option in ("--rate-limit", "--global-rate-limit")
+                         for rate_class in ("report", "item", "list", "chat")] + ["--max-connections=1000000"]
+
+def random_word(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+def random_item(rng, location=None):
+    """An item with a made-up name and description, so unrelated items never match each other."""
+    return {"name": f"{random_word(rng, 6).capitalize()} {random_word(rng, 5)}",
+            "color": rng.choice(COLORS),
+            "location": location or rng.choice(LOCATIONS),
+            "description": " ".join(random_word(rng, 6) for _ in range(4))}
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+class SimClient:
+    """One simulated client connection speaking the text protocol."""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port, limit=16 * 1024 * 1024)
+        client = cls(reader, writer)
+        await client.expect("CAPABILITIES") # Last line of the greeting
+        return client
+
+    async def send(self, line, stats):
+        self.writer.write(line.encode('utf-8') + b'\n')
+        stats['commands'] += 1
+        await self.writer.drain()
+
+    async def expect(self, prefix):
+        """Reads lines until one starts with prefix and returns it; other lines are skipped."""
+        while True:
+            try:
+                line = await asyncio.wait_for(self.reader.readline(), REPLY_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise asyncio.TimeoutError(f"no {prefix or 'reply'} within {REPLY_TIMEOUT}s") from None
+            if not line:
+                raise ConnectionError("server closed the connection")
+            line = line.decode('utf-8', errors='replace').rstrip('\n')
+            if line.startswith(prefix):
+                return line
+
+    async def fetch_all_items(self, stats):
+        started = time.perf_counter()
+        await self.send("GET_ALL_ITEMS", stats)
+        await self.expect("ALL_ITEMS_START")
+        count = 0
+        while not (line := await self.expect("")).startswith("ALL_ITEMS_END"):
+            count += line.startswith("ITEM:")
+        stats['listing_latency'].append(time.perf_counter() - started)
+        stats['listed_items'] += count
+
+    def close(self):
+        self.writer.close()
+
+async def run_pair(pair_id, config, host, port, connect_slots, stats):
+    """Lost report, found report, chat, leave, and maybe a listing: one pair of clients."""
+    rng = random.Random(config['seed'] * 1000003 + pair_id)
+    await asyncio.sleep(rng.random() * config['ramp'])
+    clients = []
+    step = "connect"
+    try:
+        async with connect_slots:
+            lost = await SimClient.connect(host, port)
+            clients.append(lost)
+            found = await SimClient.connect(host, port)
+            clients.append(found)
+        lost_item = random_item(rng)
+        matches = rng.random() < config['match_rate']
+        found_item = dict(lost_item) if matches else random_item(rng, lost_item["location"])
+        step = "report"
+        await lost.send("REPORT_LOST " + json.dumps(lost_item), stats)
+        await lost.expect("SUCCESS")
+        stats['reports'] += 1
+
+        started = time.perf_counter()
+        await found.send("REPORT_FOUND " + json.dumps(found_item), stats)
+        stats['reports'] += 1
+        if not matches:
+            await found.expect("SUCCESS")
+        else:
+            await found.expect("MATCH_FOUND")
+            stats['match_latency'].append(time.perf_counter() - started)
+            await lost.expect("MATCH_FOUND")
+            stats['matches'] += 1
+            step = "chat"
+            for seq in range(config['chat_messages']):
+                sender, receiver = (lost, found) if seq % 2 == 0 else (found, lost)
+                await sender.send(f"msg {seq} {time.perf_counter():.9f}", stats)
+                line = await receiver.expect("CHAT_MSG")
+                stats['chat_latency'].append(time.perf_counter() - float(line.rsplit(" ", 1)[1]))
+            await lost.send("/exit_chat", stats)
+            await lost.expect("CHAT_ENDED")
+            await found.expect("CHAT_ENDED")
+
+        if rng.random() < config['listing_rate']:
+            step = "listing"
+            await lost.fetch_all_items(stats)
+    except (OSError, ConnectionError, asyncio.TimeoutError, ValueError, IndexError) as e:
+        stats['errors'] += 1
+        if stats['errors'] <= 5:
+            print(f"[LOADTEST] Pair {pair_id} failed during {step}: {e!r}", file=sys.stderr)
+    finally:
+        for client in clients:
+            client.close()
+
+async def preload_items(host, port, count, seed):
+    """Reports count unrelated lost items over one pipelined connection."""
+    rng = random.Random(seed)
+    client = await SimClient.connect(host, port)
+    stats = new_stats()
+    batch = 500
+    for start in range(0, count, batch):
+        for _ in range(min(batch, count - start)):
+            client.writer.write(("REPORT_LOST " + json.dumps(random_item(rng)) + "\n").encode('utf-8'))
+        await client.writer.drain()
+        for _ in range(min(batch, count - start)):
+            await client.expect("SUCCESS")
+    client.close()
+    return stats
+
+def new_stats():
+    return {'commands': 0, 'reports': 0, 'matches': 0, 'errors': 0, 'listed_items': 0,
+            'match_latency': [], 'chat_latency': [], 'listing_latency': []}
+
+async def run_worker_async(pair_ids, config, host, port):
+    stats = new_stats()
+    connect_slots = asyncio.Semaphore(CONNECT_CONCURRENCY)
+    await asyncio.gather(*(run_pair(pair_id, config, host, port, connect_slots, stats) for pair_id in pair_ids))
+    return stats
+
+def run_worker(args):
+    pair_ids, config, host, port = args
+    return asyncio.run(run_worker_async(pair_ids, config, host, port))
+
+def merge_stats(results):
+    merged = new_stats()
+    for stats in results:
+        for key, value in stats.items():
+            merged[key] += value
+    return merged
+
+def read_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+class RssSampler(threading.Thread):
+    """Samples a process's resident memory every 100 ms while a run is in progress."""
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(0.1):
+            rss = read_rss_kb(self.pid)
+            if rss is not None:
+                self.samples.append(rss)
+
+def start_server(port, server_args):
+    """Starts server.py on port in a temporary directory. Returns (process, log path)."""
+    workdir = tempfile.mkdtemp(prefix="lostfound-loadtest-")
+    log_path = os.path.join(workdir, "server.log")
+    server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    process = subprocess.Popen([sys.executable, server_script, "--port", str(port), *UNLIMITED_SERVER_ARGS, *server_args],
+                               cwd=workdir, stdout=open(log_path, "w"), stderr=subprocess.STDOUT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited during startup, see {log_path}")
+        try:
+            socket.create_connection((SERVER_HOST, port), timeout=1).close()
+            return process, log_path
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"server did not start listening on port {port}, see {log_path}")
+
+def stop_server(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+def raise_fd_limit():
+    """Each simulated client needs a file descriptor here and one in the server."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def summarize(config, stats, duration, rss_samples):
+    """The numbers of one run, as a flat dict (saved by --save, compared by --baseline)."""
+    def ms(values, fraction):
+        value = percentile(sorted(values), fraction)
+        return None if value is None else round(value * 1000, 3)
+    return {
+        'scenario': config['scenario'], 'pairs': config['pairs'], 'clients': config['pairs'] * 2,
+        'duration_s': round(duration, 3),
+        'commands': stats['commands'], 'commands_per_s': round(stats['commands'] / duration, 1),
+        'reports_per_s': round(stats['reports'] / duration, 1),
+        'matches': stats['matches'], 'errors': stats['errors'],
+        'match_p50_ms': ms(stats['match_latency'], 0.5), 'match_p99_ms': ms(stats['match_latency'], 0.99),
+        'chat_messages': len(stats['chat_latency']),
+        'chat_p50_ms': ms(stats['chat_latency'], 0.5), 'chat_p99_ms': ms(stats['chat_latency'], 0.99),
+        'listings': len(stats['listing_latency']), 'listed_items': stats['listed_items'],
+        'listing_p50_ms': ms(stats['listing_latency'], 0.5), 'listing_p99_ms': ms(stats['listing_latency'], 0.99),
+        'server_rss_start_mb': round(rss_samples[0] / 1024, 1) if rss_samples else None,
+        'server_rss_peak_mb': round(max(rss_samples) / 1024, 1) if rss_samples else None,
+        'server_rss_end_mb': round(rss_samples[-1] / 1024, 1) if rss_samples else None,
+    }
+
+def print_summary(summary, baseline=None):
+    for key, value in summary.items():
+        line = f"{key:>22}: {value}"
+        old = (baseline or {}).get(key)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            line += f"   (baseline {old}, {(value - old) / old * 100:+.1f}%)"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the Lost & Found server")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='smoke')
+    parser.add_argument('--pairs', type=int, help="client pairs (two connections each); overrides the scenario")
+    parser.add_argument('--match-rate', type=float, help="share of pairs whose reports match")
+    parser.add_argument('--chat-messages', type=int, help="chat messages exchanged per matched pair")
+    parser.add_argument('--listing-rate', type=float, help="share of pairs that also call GET_ALL_ITEMS")
+    parser.add_argument('--preload', type=int, help="unrelated items reported before the run")
+    parser.add_argument('--ramp', type=float, default=1.0, help="seconds over which pairs start")
+    parser.add_argument('--workers', type=int, default=1, help="load generator processes")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--no-spawn', action='store_true', help="use the server already running on --host/--port")
+    parser.add_argument('--server-pid', type=int, help="with --no-spawn: sample the memory of this process")
+    parser.add_argument('--server-arg', action='append', default=[], metavar='ARG',
+                        help="extra argument for the spawned server.py (repeatable, e.g. --server-arg=--storage=sqlite)")
+    parser.add_argument('--save', metavar='PATH', help="write the results as JSON")
+    parser.add_argument('--baseline', metavar='PATH', help="compare with results saved by --save")
+    args = parser.parse_args()
+
+    config = dict(SCENARIOS[args.scenario], scenario=args.scenario, seed=args.seed, ramp=args.ramp)
+    for key in ('pairs', 'match_rate', 'chat_messages', 'listing_rate', 'preload'):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    raise_fd_limit()
+
+    server, server_pid = None, args.server_pid
+    if not args.no_spawn:
+        server, log_path = start_server(args.port, args.server_arg)
+        server_pid = server.pid
+        print(f"[LOADTEST] Started server (pid {server.pid}), log in {log_path}")
+    try:
+        if config['preload']:
+            started = time.perf_counter()
+            asyncio.run(preload_items(args.host, args.port, config['preload'], args.seed))
+            print(f"[LOADTEST] Preloaded {config['preload']} items in {time.perf_counter() - started:.1f}s")
+        sampler = RssSampler(server_pid) if server_pid else None
+        if sampler:
+            sampler.start()
+        print(f"[LOADTEST] Running '{args.scenario}': {config['pairs']} pairs, {args.workers} worker(s)")
+        chunks = [(list(range(worker, config['pairs'], args.workers)), config, args.host, args.port)
+                  for worker in range(args.workers)]
+        started = time.perf_counter()
+        if args.workers == 1:
+            results = [run_worker(chunks[0])]
+        else:
+            with multiprocessing.Pool(args.workers) as pool:
+                results = pool.map(run_worker, chunks)
+        duration = time.perf_counter() - started
+        if sampler:
+            sampler.stopped.set()
+            sampler.join()
+    finally:
+        if server:
+            stop_server(server)
+
+    summary = summarize(config, merge_stats(results), duration, sampler.samples if sampler else [])
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_summary(summary, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(summary, f, indent=2)
+    sys.exit(1 if summary['errors'] else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Binary framing for the Lost & Found protocol, shared by server.py and client.py.
+
+Connections start in the text protocol (one UTF-8 line per message). The server lists
+"binary" in its CAPABILITIES line; a client that wants it sends "PROTOCOL binary" and frames
+everything it sends after that line. The server answers "PROTOCOL binary" as its last text
+line and frames everything after it. Clients that never ask keep the text protocol.
+A binary client may then send "COMPRESS zlib" (acknowledged with "COMPRESS zlib"), after
+which large bulk responses arrive deflated, see deflate_frames().
+
+Every frame is a 5-byte header - payload length (uint32, big-endian) and frame type
+(uint8) - followed by the payload:
+  FRAME_TEXT   a text protocol message (UTF-8, may span several lines, no trailing newline)
+  FRAME_CHAT   a chat message: sender tag (str8) then the text (rest of the payload)
+  FRAME_ITEMS  a batch of items, see encode_items()
+  FRAME_DEFLATE  a piece of a zlib stream that inflates to more frames, see deflate_frames()
+"""
+import struct
+import zlib
+
+FRAME_HEADER = struct.Struct('!IB')
+FRAME_TEXT = 1
+FRAME_CHAT = 2
+FRAME_ITEMS = 3
+FRAME_DEFLATE = 4
+
+_U8 = struct.Struct('!B')
+# Fields of an item in a FRAME_ITEMS record, in wire order ('matched' is "1" or "")
+ITEM_FIELDS = ('id', 'status', 'matched', 'name', 'color', 'location', 'description', 'timestamp')
+FIELD_SEPARATOR = '\x1f' # ASCII unit separator
+RECORD_SEPARATOR = '\x1e' # ASCII record separator
+_SEPARATORS = str.maketrans('', '', FIELD_SEPARATOR + RECORD_SEPARATOR)
+
+class ProtocolError(ValueError):
+    """A frame whose payload does not decode."""
+
+def encode_frame(frame_type, payload):
+    return FRAME_HEADER.pack(len(payload), frame_type) + payload
+
+def encode_text(message):
+    """A text protocol message as a FRAME_TEXT frame (trailing newline dropped)."""
+    return encode_frame(FRAME_TEXT, message.rstrip('\n').encode('utf-8'))
+
+def encode_chat(sender_tag, text):
+    tag = sender_tag.encode('utf-8')[:255]
+    return encode_frame(FRAME_CHAT, _U8.pack(len(tag)) + tag + text.encode('utf-8'))
+
+def decode_chat(payload):
+    """Returns (sender tag, text) of a FRAME_CHAT payload."""
+    if not payload or len(payload) < 1 + payload[0]:
+        raise ProtocolError("truncated chat frame")
+    tag_end = 1 + payload[0]
+    return payload[1:tag_end].decode('utf-8'), payload[tag_end:].decode('utf-8')
+
+def _item_record(item):
+    return (f"{item['id']}\x1f{item['status']}\x1f{'1' if item.get('matched_with') else ''}\x1f{item['name']}"
+            f"\x1f{item['color']}\x1f{item['location']}\x1f{item['description']}\x1f{item['timestamp']}")
+
+def encode_items(items):
+    """
+    A FRAME_ITEMS frame: one record per item, separated by RECORD_SEPARATOR, each holding
+    the ITEM_FIELDS separated by FIELD_SEPARATOR, all UTF-8. Cheaper to build and to split
+    than per-field length prefixes, and the text labels of ITEM: lines are gone.
+    """
+    records = RECORD_SEPARATOR.join([_item_record(item) for item in items])
+    if records.count(FIELD_SEPARATOR) != len(items) * (len(ITEM_FIELDS) - 1) or \
+       records.count(RECORD_SEPARATOR) != max(len(items) - 1, 0):
+        # Some field contains a separator character; drop those characters
+        records = RECORD_SEPARATOR.join([_item_record({key: str(value).translate(_SEPARATORS) if value else value
+                                                       for key, value in item.items()}) for item in items])
+    return encode_frame(FRAME_ITEMS, records.encode('utf-8'))
+
+def decode_items(payload):
+    """Returns the items of a FRAME_ITEMS payload as dicts keyed by ITEM_FIELDS ('matched' is a bool)."""
+    try:
+        records = payload.decode('utf-8')
+    except UnicodeDecodeError as e:
+        raise ProtocolError(f"bad items frame: {e}") from e
+    items = []
+    for record in records.split(RECORD_SEPARATOR) if records else ():
+        fields = record.split(FIELD_SEPARATOR)
+        if len(fields) != len(ITEM_FIELDS):
+            raise ProtocolError("bad item record")
+        item = dict(zip(ITEM_FIELDS, fields))
+        item['matched'] = item['matched'] == '1'
+        items.append(item)
+    return items
+
+def deflate_frames(chunks, min_bytes, level):
+    """
+    Yields the encoded frames of one bulk response, compressed once they add up to
+    min_bytes. Smaller responses pass through unchanged. Larger ones become FRAME_DEFLATE
+    frames of a single zlib stream. Each chunk is sync-flushed so the receiver can show it
+    straight away, and the stream is finished with the response, so every response starts
+    a fresh stream, even when chunks raises part way through.
+    chunks is pulled lazily, so this can wrap the streamed GET_ALL_ITEMS listing.
+    """
+    chunks = iter(chunks)
+    pending, size = [], 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= min_bytes:
+            break
+    else:
+        yield from pending
+        return
+    compressor = zlib.compressobj(level)
+    yield encode_frame(FRAME_DEFLATE, compressor.compress(b''.join(pending)) + compressor.flush(zlib.Z_SYNC_FLUSH))
+    try:
+        for chunk in chunks:
+            yield encode_frame(FRAME_DEFLATE, compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH))
+    except Exception:
+        yield encode_frame(FRAME_DEFLATE, compressor.flush()) # Finish the stream before the error propagates
+        raise
+    yield encode_frame(FRAME_DEFLATE, compressor.flush())
+
+class FrameInflater:
+    """Turns the FRAME_DEFLATE payloads of deflate_frames() back into frames, incrementally."""
+    def __init__(self, max_frame_bytes):
+        self.decompressor = None
+        self.decoder = StreamDecoder(max_frame_bytes)
+        self.decoder.switch_to_binary()
+
+    def feed(self, payload):
+        """Inflates one FRAME_DEFLATE payload. Returns an iterator of the frames it completes."""
+        if self.decompressor is None: # First piece of a new response
+            self.decompressor = zlib.decompressobj()
+        try:
+            self.decoder.feed(self.decompressor.decompress(payload))
+        except zlib.error as e:
+            self.decompressor = None
+            raise ProtocolError(f"bad deflate frame: {e}") from e
+        if self.decompressor.eof:
+            self.decompressor = None
+        return self.decoder.messages()
+
+class StreamDecoder:
+    """
+    Cuts a received byte stream into messages: newline-terminated text lines and, after
+    switch_to_binary(), length-prefixed frames. Used on both ends of a connection.
+    Lines are split on raw bytes before decoding, so a UTF-8 character split across two
+    recv() calls is reassembled, and the bytes after the line that switched protocols are
+    still undecoded when the switch happens.
+    """
+    def __init__(self, max_frame_bytes):
+        self.max_frame_bytes = max_frame_bytes
+        self.buffer = bytearray()
+        self.binary = False
+        self.discarding = False # Skipping the rest of an oversized text line
+        self.skip = 0 # Bytes of an oversized binary frame still to be skipped
+
+    def feed(self, data):
+        self.buffer += data
+
+    def switch_to_binary(self):
+        self.binary = True
+
+    def messages(self):
+        """
+        Yields (FRAME_TEXT, line bytes) for each complete text line, or (frame type, payload)
+        for each complete binary frame, until the buffer runs out. A message longer than
+        max_frame_bytes is skipped and reported once as (None, None).
+        The protocol is checked before every message, so switch_to_binary() called while
+        iterating applies from the next byte on.
+        """
+        while True:
+            if self.skip:
+                skipped = min(self.skip, len(self.buffer))
+                del self.buffer[:skipped]
+                self.skip -= skipped
+                if self.skip:
+                    return
+            if self.binary:
+                if len(self.buffer) < FRAME_HEADER.size:
+                    return
+                length, frame_type = FRAME_HEADER.unpack_from(self.buffer)
+                end = FRAME_HEADER.size + length
+                if length > self.max_frame_bytes:
+                    self.skip = end
+                    yield None, None
+                    continue
+                if len(self.buffer) < end:
+                    return
+                payload = bytes(self.buffer[FRAME_HEADER.size:end])
+                del self.buffer[:end]
+                yield frame_type, payload
+            else:
+                newline = self.buffer.find(b'\n')
+                if newline == -1:
+                    if len(self.buffer) > self.max_frame_bytes:
+                        del self.buffer[:]
+                        if not self.discarding:
+                            self.discarding = True
+                            yield None, None
+                    return
+                line = bytes(self.buffer[:newline])
+                del self.buffer[:newline + 1]
+                if self.discarding:
+                    self.discarding = False
+                    continue
+                if len(line) > self.max_frame_bytes:
+                    yield None, None
+                    continue
+                yield FRAME_TEXT, line
@@ -4,145 +4,2435 @@ import json
 import uuid
 import time
 import sys # Import sys for graceful exit
+import selectors
+import argparse
+import os
+import sqlite3
+import collections
+import queue
+import multiprocessing
+import signal
+import atexit
+import bisect
+import re
+import heapq
+import itertools
+import gc
+import marshal
+import mmap
+import struct
+import http.server
+import protocol
 
 # Server configuration
 HOST = '0.0.0.0'  # Listen on all available network interfaces
 PORT = 65432
 DATA_FILE = 'items.json'
 BUFFER_SIZE = 4096 # Increased buffer size for potentially longer messages/item details
+MAX_FRAME_SIZE = 64 * 1024 # Longest accepted command line or binary frame, in bytes
+ITEMS_PAGE_SIZE = 100 # Default GET_ITEMS page size
+ITEMS_PAGE_MAX = 1000 # Largest page served by GET_ITEMS (and the page size used by GET_ALL_ITEMS)
+SEARCH_LIMIT = 100 # Default number of SEARCH results
+SEARCH_LIMIT_MAX = 5000 # Most results one SEARCH returns
+SEARCH_BATCH = 500 # Results formatted and written per chunk of a SEARCH reply
+MAX_WATCHES_PER_CLIENT = 20 # WATCH subscriptions one connection may hold
+CHANGE_FEED_SIZE = 10000 # Item changes kept for GET_CHANGES_SINCE; clients further behind get a full resync
+CHANGES_BATCH = 500 # Items looked up, formatted and written per chunk of a GET_CHANGES_SINCE reply
+OUTBOUND_QUEUE_LIMIT = 1024 * 1024 # Bytes queued for one client before the overflow policy applies
+# What to do when a client's queue is full: 'drop' the new message, 'disconnect' the client,
+# or 'coalesce' its queued chat messages into one notice (disconnecting if that is not enough)
+OUTBOUND_OVERFLOW_POLICY = 'coalesce'
+WRITE_CHUNK_SIZE = 64 * 1024 # Queued messages are joined into writes of up to this size
+COMPRESS_MIN_BYTES = 2048 # Bulk responses at least this large are deflated for clients that sent COMPRESS zlib
+COMPRESS_LEVEL = 6 # zlib level (1 = fastest, 9 = smallest)
+# Token buckets per command class (see COMMAND_RATE_CLASSES): {class: (commands per second, burst)}.
+# RATE_LIMITS applies to each connection, GLOBAL_RATE_LIMITS to all connections together; a
+# class missing from a dict is not limited there. Over-limit commands get ERROR RATE_LIMITED.
+RATE_LIMITS = {'report': (1.0, 10), 'item': (5.0, 20), 'list': (2.0, 10), 'chat': (20.0, 50)}
+GLOBAL_RATE_LIMITS = {'report': (500.0, 1000), 'list': (100.0, 200)}
+MAX_CONNECTIONS = 10000 # Connections accepted beyond this are sent ERROR SERVER_BUSY and closed
+LISTEN_BACKLOG = 1024 # Pending connections queued by the kernel (capped by net.core.somaxconn)
+# A client that sends nothing for HEARTBEAT_INTERVAL seconds is sent PING (clients answer PONG)
+# and is disconnected once it has been silent for HEARTBEAT_TIMEOUT; this finds peers that
+# vanished without closing the connection. 0 turns heartbeats off.
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TIMEOUT = 90
+IDLE_TIMEOUT = 0 # Disconnect clients that send no commands (heartbeats aside) for this many seconds; 0 = never
+RESUME_TOKEN_TTL = 7 * 24 * 3600 # A closed connection's items can be RESUMEd for this many seconds; 0 = forever
+# 'eventloop' multiplexes all clients on one selectors loop (a few KB per idle connection);
+# 'threaded' is the original one-thread-per-connection server, kept for comparison, and the
+# one used with SHARDS: the event loop would wait for each shard's reply in turn.
+SERVER_MODE = 'eventloop'
+# 'journal' appends one record per change to JOURNAL_FILE and periodically compacts it into
+# a binary SNAPSHOT_FILE; 'json' rewrites all of DATA_FILE on every change (original behaviour);
+# 'sqlite' keeps items in SQLITE_FILE instead of memory.
+STORAGE_MODE = 'journal'
+JOURNAL_FILE = 'items.journal'
+SNAPSHOT_FILE = 'items.snapshot' # Loaded instead of DATA_FILE when it is the newer of the two
+SNAPSHOT_CHUNK_ITEMS = 10000 # Items per snapshot chunk; loading adds one chunk at a time under items_lock
+SQLITE_FILE = 'items.db'
+JOURNAL_COMPACT_EVERY = 1000 # Compact after this many journal records...
+JOURNAL_COMPACT_INTERVAL = 300 # ...or after this many seconds, whichever comes first
+JOURNAL_FSYNC = False # fsync every record (survives power loss, costs a disk flush per change)
+# Archival moves items that no longer need to be in memory to ARCHIVE_FILE (SQLite), where
+# GET_ARCHIVED still reads them: resolved items at the next pass, matched and claimed items
+# ARCHIVE_MATCHED_AGE seconds after they were matched or claimed, and open reports
+# ARCHIVE_OPEN_TTL seconds after they were reported.
+ARCHIVE_FILE = 'items.archive.db'
+ARCHIVE_INTERVAL = 600 # Seconds between archival passes (0 turns archival off)
+ARCHIVE_MATCHED_AGE = 24 * 3600
+ARCHIVE_OPEN_TTL = 90 * 24 * 3600
+ARCHIVE_BATCH = 500 # Items examined per items_lock hold during a pass
+LOCK_STATS = False # Record lock wait/hold times per call site and print them at shutdown
+# Item shards: 0 keeps items in the server process. N runs N worker processes that each own the
+# items of every Nth entry of LOCATIONS (with their own copy of the data files, see shard_path);
+# the server process keeps the connections, sessions and chats and routes item work to them.
+SHARDS = 0
+# Logging: records are queued and written by a background thread (see log_event)
+LOG_LEVEL = 'info' # 'debug' adds a RECV line per received message and chat session tracing
+LOG_FORMAT = 'text' # 'text' (timestamp, level, [TAG], message, key=value fields) or 'json' (one object per line)
+LOG_PAYLOADS = False # Include the raw message text in RECV lines (it can hold personal details and chat text)
+LOG_SAMPLE_EVERY = {} # Log only one in N RECV lines of these commands, e.g. {'GET_ITEMS': 100}
+# Metrics in the Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics; None disables them.
+# Bound to loopback: the page shows client counts and lock call sites, so keep it off the public port.
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5) # Seconds
+# Matching: a lost and a found item at the same location match when match_score() reaches
+# MATCH_THRESHOLD. MATCH_WEIGHTS = (name trigram similarity, same color, description overlap).
+# Different colors never match, however alike the rest is (a black phone is not a white one).
+MATCH_WEIGHTS = (0.55, 0.3, 0.15)
+MATCH_THRESHOLD = 0.6 # Same name and color always match; so do "Car keys"/"Keys" in "Blk"/"Black"
+MATCH_TOP_K = 5 # Ranked candidates tried (in order) when starting a chat
+MATCH_CANDIDATES = 100 # Items with the most shared index terms that get scored
+MATCH_SCAN_BUDGET = 4000 # Posting entries counted per report (rarest terms first); bounds matching cost
+MATCH_RETRY_BATCH = 64 # Reporters re-matched per batch by the background match worker
+COLOR_SYNONYMS = {
+    "blk": "black", "bk": "black", "wht": "white", "wh": "white", "grey": "gray", "gry": "gray",
+    "silver": "gray", "slv": "gray", "blu": "blue", "navy": "blue", "rd": "red", "maroon": "red",
+    "burgundy": "red", "crimson": "red", "grn": "green", "olive": "green", "ylw": "yellow",
+    "yel": "yellow", "gold": "yellow", "golden": "yellow", "brn": "brown", "tan": "brown",
+    "beige": "brown", "org": "orange", "pnk": "pink", "purp": "purple", "violet": "purple",
+    "transparent": "clear", "multicolor": "multi", "multicolored": "multi", "multicolour": "multi",
+}
+COLOR_MODIFIERS = {"dark", "light", "bright", "pale", "deep", "dull"}
+DESCRIPTION_STOPWORDS = {"the", "and", "with", "has", "have", "was", "were", "for", "near", "from",
+                         "this", "that", "its", "one", "some", "very", "not", "but", "are", "had"}
 
 # Global data structures (with locks for thread safety)
+#
+# Lock hierarchy - a thread holding one of these may only acquire locks further down the list,
+# never one above it, so no two code paths can wait on each other:
+#   1. clients_lock             - client_connections and chat_partners (all per-client session state)
+#   2. JsonItemStore.save_lock  - one compaction at a time
+#   3. items_lock               - item_store, archive_store and match_index. Only taken inside the item operations
+#                                 (items_*), which never look at client state: with SHARDS they run
+#                                 in another process
+#   4. OutboundQueue.lock, EventLoopServer.pending_lock, match_queue_lock, metrics_lock,
+#      ShardClient.lock, rate_limit_lock, watch_lock, change_feed_lock - leaf locks, never held while acquiring another
+# No lock is ever held during socket I/O (see OutboundQueue). Set LOCK_STATS (or --lock-stats)
+# to measure how long each call site waits for and holds these locks.
 items_lock = threading.Lock()
-items = []  # List of item dictionaries
+item_store = None # JsonItemStore or SqliteItemStore, created by load_items(); guarded by items_lock
+archive_store = None # SqliteItemStore on ARCHIVE_FILE, opened by load_items(); guarded by items_lock
+# match_index: {(location, status): {term: {item_id: item}}} - inverted index of name trigrams,
+# name words and description words (see index_terms). Holds only open (unmatched) items whose reporter is still
+# connected, so match_candidates touches real candidates instead of scanning items. Guarded by items_lock.
+# All match_* structures hold Items and are keyed by their packed ids (item.id, item.reporter_id, see pack_id).
+match_index = {}
+# match_open_items: {item_id: (item, match_features(item), (location, status), reporter_id)} for every
+# item in match_index. The keys it was indexed under are kept because the item itself may already
+# have changed (matched, resumed) by the time it is unindexed.
+match_open_items = {}
+# match_index_by_reporter: {reporter_id: {item_id: item}} - lets a disconnect drop its items in O(k)
+match_index_by_reporter = {}
 clients_lock = threading.Lock()
-# client_connections: {client_id: {'conn': conn, 'addr': addr, 'mode': 'command'/'chat', 'chat_partner_id': None/client_id, 'reporting_item': None}}
+# client_connections: {client_id: {'conn': conn, 'addr': addr, 'mode': 'command'/'chat', 'chat_partner_id': None/client_id, 'outbound': OutboundQueue}}
 client_connections = {}
 # active_chats: {client_id_1: client_id_2, client_id_2: client_id_1}
-# This helps quickly find the chat partner
-chat_partners_lock = threading.Lock()
+# This helps quickly find the chat partner. Guarded by clients_lock, like the rest of the session state.
 chat_partners = {}
+# Clients whose items are being claimed for a chat (see start_chat_session); no other match may
+# take them until it is decided. Guarded by clients_lock.
+match_reservations = set()
+# resume_tokens: {token: client_id} - the token sent in SESSION lets a reconnecting client RESUME
+# the reporter identity (and unresolved items) of an earlier connection. Guarded by clients_lock.
+resume_tokens = {}
+# resume_tokens_left: {token: time.monotonic() its connection closed}, oldest first - the
+# resumable tokens of closed connections, forgotten after RESUME_TOKEN_TTL. Guarded by clients_lock.
+resume_tokens_left = {}
+
+# Reporters whose open items should be matched again because they became available (back in
+# command mode, or resumed). Drained in batches by match_worker, off the request path.
+match_queue = collections.deque()
+match_queue_lock = threading.Lock()
+match_requested = threading.Event()
+
+# Set when the journal has grown enough to be worth compacting
+compact_requested = threading.Event()
+# Set at shutdown to wake archive_worker
+archive_requested = threading.Event()
+# Set at shutdown to wake heartbeat_worker
+heartbeat_stop = threading.Event()
+
+# {class: TokenBucket} for GLOBAL_RATE_LIMITS, shared by all connections. The per-connection
+# buckets live in client_connections[client_id]['rate_buckets'] and are only touched by the
+# thread reading that client, so they need no lock.
+global_rate_buckets = {}
+rate_limit_lock = threading.Lock() # Leaf lock, guards global_rate_buckets
+
+# WATCH subscriptions. Each watch is filed under one kind of key of watch_index (see
+# watch_keys), so an item change only looks at the watches that could match it:
+# {key: {(client_id, watch_id): query}}, and {client_id: {watch_id: (query, keys)}}.
+watch_index = collections.defaultdict(dict)
+watches_by_client = {}
+watch_ids = itertools.count(1)
+watch_lock = threading.Lock() # Leaf lock, guards watch_index and watches_by_client
+
+# Change feed for GET_CHANGES_SINCE: (sequence number, item id) of the latest item changes,
+# oldest first. Numbers start from the start time in microseconds, so they keep growing
+# across restarts and a number handed out by an earlier run is older than change_feed_start.
+change_seq = time.time_ns() // 1000 # Number of the latest change
+change_feed = collections.deque()
+change_feed_start = change_seq # Every change after this one is still in change_feed
+change_feed_lock = threading.Lock() # Leaf lock, guards change_seq, change_feed and change_feed_start
+
+# Set once the item store has finished loading (load_items loads it in the background).
+# Until then reads see the items loaded so far and writes raise ItemsLoading.
+items_loaded = threading.Event()
+
+# Set by main() when running in eventloop mode; send_to_client queues output through it
+event_loop = None
+
+# Set by start_shards() when SHARDS is set: [ShardClient], one per worker process
+shard_pool = None
 
 # Global event to signal server shutdown to threads
 server_running = threading.Event()
 server_running.set() # Set to True initially
 
-LOCATIONS = ["A Block", "B Block", "C Block", "Cafe", "Library", "Sports Complex", "Admin Building", "Hostel A", "Hostel B", "Other"]
+LOCATIONS = ["A Block", "B Block", "C Block", "Cafe", "Library", "Sports Complex", "Admin Building", "Hostel A", "Hostel B", "Other"]
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LOG_LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LOG_LEVEL_NAMES = {level: name for name, level in LOG_LEVELS.items()}
+log_threshold = LOG_LEVELS[LOG_LEVEL] # Records below this level are dropped by log_event
+log_queue = queue.SimpleQueue() # (time, level, tag, message, fields) tuples for log_writer; None stops it
+log_sample_counts = {} # {command: RECV messages seen}, for LOG_SAMPLE_EVERY; unlocked, an off-by-one is harmless
+log_thread = None
+log_fields = {} # Fields added to every record, e.g. the shard number in a shard worker
+
+def log_event(level, tag, message, **fields):
+    """
+    Queues a log record. Nothing is formatted here: values go in as fields and are turned
+    into text by log_writer, so a disabled level costs one comparison and an enabled one
+    does not make client threads wait on stdout.
+    """
+    if level >= log_threshold:
+        log_queue.put((time.time(), level, tag, message, fields))
+
+def log_received(client_id, mode, command, message):
+    """The DEBUG RECV line for one received message, subject to LOG_SAMPLE_EVERY and LOG_PAYLOADS."""
+    every = LOG_SAMPLE_EVERY.get(command)
+    if every:
+        seen = log_sample_counts[command] = log_sample_counts.get(command, 0) + 1
+        if (seen - 1) % every:
+            return
+    if LOG_PAYLOADS:
+        log_event(DEBUG, 'RECV', "Message received", client=client_id, mode=mode, command=command, payload=message)
+    else:
+        log_event(DEBUG, 'RECV', "Message received", client=client_id, mode=mode, command=command, bytes=len(message))
+
+def format_log_record(record):
+    created, level, tag, message, fields = record
+    if log_fields:
+        fields = dict(log_fields, **fields)
+    if LOG_FORMAT == 'json':
+        entry = {'time': round(created, 3), 'level': LOG_LEVEL_NAMES[level], 'tag': tag, 'message': message}
+        entry.update(fields)
+        return json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+    parts = [time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created)) + f".{int(created % 1 * 1000):03d}",
+             LOG_LEVEL_NAMES[level].upper(), f"[{tag}]", message]
+    for key, value in fields.items():
+        value = str(value)
+        if not value or any(char in value for char in ' "=\n'):
+            value = json.dumps(value, ensure_ascii=False)
+        parts.append(f"{key}={value}")
+    return " ".join(parts) + "\n"
+
+def log_writer():
+    """Formats queued log records and writes them to stdout, a batch per write."""
+    while True:
+        batch = [log_queue.get()]
+        while len(batch) < 1000:
+            try:
+                batch.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        stopping = None in batch
+        lines = [format_log_record(record) for record in batch if record is not None]
+        try:
+            sys.stdout.write("".join(lines))
+            sys.stdout.flush()
+        except (OSError, ValueError):
+            pass # stdout is gone; keep draining so log_event never blocks
+        if stopping:
+            return
+
+def start_logging():
+    """Starts log_writer with the configured LOG_LEVEL; records queued before this are written too."""
+    global log_threshold, log_thread
+    log_threshold = LOG_LEVELS[LOG_LEVEL]
+    log_thread = threading.Thread(target=log_writer, name='log-writer', daemon=True)
+    log_thread.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    """Writes out everything still queued. Safe to call more than once."""
+    if log_thread and log_thread.is_alive():
+        log_queue.put(None)
+        log_thread.join(5)
+
+# Metrics. Counters and histograms are updated where things happen; gauges are read from the
+# live structures when /metrics is requested. Labels are tuples of (name, value) pairs.
+METRICS = {
+    'lostfound_commands_total': ('counter', "Commands handled, by command"),
+    'lostfound_command_errors_total': ('counter', "ERROR replies sent, by the command being handled"),
+    'lostfound_command_seconds': ('histogram', "Time to handle one command, by command"),
+    'lostfound_reports_total': ('counter', "Items reported, by status"),
+    'lostfound_matches_total': ('counter', "Matches that started a chat, by when they were found"),
+    'lostfound_match_seconds': ('histogram', "Time spent looking for match candidates"),
+    'lostfound_chat_messages_total': ('counter', "Chat messages relayed"),
+    'lostfound_persist_seconds': ('histogram', "Time to persist one change or save the store, by operation"),
+    'lostfound_archived_items_total': ('counter', "Items moved to the archive"),
+    'lostfound_rate_limited_total': ('counter', "Commands refused with RATE_LIMITED, by command class and limit"),
+    'lostfound_connections_refused_total': ('counter', "Connections refused because MAX_CONNECTIONS were open"),
+    'lostfound_connections_reaped_total': ('counter', "Connections closed for missing heartbeats or idling, by reason"),
+    'lostfound_watch_events_total': ('counter', "WATCH_EVENT messages pushed, by change"),
+    'lostfound_change_syncs_total': ('counter', "GET_CHANGES_SINCE replies, by kind (delta or full resync)"),
+    'lostfound_connected_clients': ('gauge', "Connected clients"),
+    'lostfound_active_chats': ('gauge', "Chat sessions in progress"),
+    'lostfound_items': ('gauge', "Stored items, by status"),
+    'lostfound_match_index_items': ('gauge', "Open items waiting for a match"),
+    'lostfound_match_queue': ('gauge', "Reporters waiting to be re-matched"),
+    'lostfound_watches': ('gauge', "Active WATCH subscriptions"),
+    'lostfound_lock_acquisitions_total': ('counter', "Lock acquisitions, by lock and call site (--lock-stats)"),
+    'lostfound_lock_wait_seconds_total': ('counter', "Time spent waiting for locks, by lock and call site (--lock-stats)"),
+    'lostfound_lock_hold_seconds_total': ('counter', "Time locks were held, by lock and call site (--lock-stats)"),
+}
+metrics_lock = threading.Lock() # Leaf lock
+metric_values = {} # {(name, labels): value} for counters
+metric_histograms = {} # {(name, labels): [count per LATENCY_BUCKETS bucket..., count above the last, sum]}
+dispatch_context = threading.local() # .command: label of the command this thread is handling, for error counts
+
+def metric_inc(name, labels=(), amount=1):
+    with metrics_lock:
+        metric_values[(name, labels)] = metric_values.get((name, labels), 0) + amount
+
+def metric_observe(name, seconds, labels=()):
+    with metrics_lock:
+        histogram = metric_histograms.get((name, labels))
+        if histogram is None:
+            histogram = metric_histograms[(name, labels)] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+def record_command(started):
+    """Counts the command this thread just handled (labelled by process_message) and its latency."""
+    labels = (('command', getattr(dispatch_context, 'command', None) or 'NONE'),)
+    dispatch_context.command = None
+    metric_inc('lostfound_commands_total', labels)
+    metric_observe('lostfound_command_seconds', time.perf_counter() - started, labels)
+
+def metric_gauges():
+    """Current gauge values as [(name, labels, value)]."""
+    status_counts, open_items = collections.Counter(), 0
+    for shard_counts, shard_open_items in item_broadcast('stats'):
+        status_counts.update(shard_counts)
+        open_items += shard_open_items
+    with clients_lock:
+        clients = len(client_connections)
+        chats = len(chat_partners) // 2
+    with match_queue_lock:
+        queued = len(match_queue)
+    with watch_lock:
+        watches = sum(map(len, watches_by_client.values()))
+    gauges = [('lostfound_connected_clients', (), clients), ('lostfound_active_chats', (), chats),
+              ('lostfound_match_index_items', (), open_items), ('lostfound_match_queue', (), queued),
+              ('lostfound_watches', (), watches)]
+    gauges += [('lostfound_items', (('status', status),), count) for status, count in sorted(status_counts.items())]
+    return gauges
+
+def metrics_snapshot():
+    """Copies of the counters and histograms, as lists of ((name, labels), value)."""
+    with metrics_lock:
+        return list(metric_values.items()), [(key, list(histogram)) for key, histogram in metric_histograms.items()]
+
+def format_metric_labels(labels, extra=()):
+    labels = labels + extra
+    if not labels:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    samples = {name: [] for name in METRICS} # {name: [(labels, value)]}
+    counters, histograms = metrics_snapshot()
+    if shard_pool:
+        # Matching and persistence are timed in the shard workers; label theirs with the shard
+        for index, (shard_counters, shard_histograms) in enumerate(item_broadcast('metrics')):
+            shard_label = (('shard', index),)
+            counters += [((name, labels + shard_label), value) for (name, labels), value in shard_counters]
+            histograms += [((name, labels + shard_label), histogram) for (name, labels), histogram in shard_histograms]
+    for (name, labels), value in counters:
+        samples[name].append((labels, value))
+    for name, labels, value in metric_gauges():
+        samples[name].append((labels, value))
+    if LOCK_STATS:
+        with lock_stats_lock:
+            for (lock_name, site), (count, total_wait, _, total_hold, _) in lock_stats.items():
+                labels = (('lock', lock_name), ('site', site))
+                samples['lostfound_lock_acquisitions_total'].append((labels, count))
+                samples['lostfound_lock_wait_seconds_total'].append((labels, total_wait))
+                samples['lostfound_lock_hold_seconds_total'].append((labels, total_hold))
+    histograms_by_name = collections.defaultdict(list)
+    for (name, labels), histogram in histograms:
+        histograms_by_name[name].append((labels, histogram))
+
+    lines = []
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in sorted(samples[name]):
+            lines.append(f"{name}{format_metric_labels(labels)} {value}")
+        for labels, histogram in sorted(histograms_by_name[name], key=lambda entry: entry[0]):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_metric_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{format_metric_labels(labels)} {histogram[-1]}")
+            lines.append(f"{name}_count{format_metric_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves render_metrics() at /metrics."""
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log_event(DEBUG, 'METRICS', "Request", client=self.address_string(), request=format % args)
+
+def start_metrics_server():
+    """Serves /metrics from a background thread when METRICS_PORT is set."""
+    try:
+        metrics_server = http.server.ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        log_event(ERROR, 'METRICS', "Could not start the metrics server", port=METRICS_PORT, error=e)
+        return
+    metrics_server.daemon_threads = True
+    threading.Thread(target=metrics_server.serve_forever, name='metrics', daemon=True).start()
+    log_event(INFO, 'METRICS', "Serving metrics", url=f"http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+class InstrumentedLock:
+    """
+    Drop-in replacement for threading.Lock that records, per call site, how long callers
+    waited to acquire the lock and how long they held it. Installed by install_lock_stats().
+    """
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0 # Only written by the thread holding the lock
+        self._site = None
+
+    def _acquire(self, site, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquired_at = time.perf_counter()
+            self._site = site
+            record_lock_timing(self.name, site, self._acquired_at - start, None)
+        return acquired
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self._acquire(call_site(2), blocking, timeout)
+
+    def release(self):
+        held = time.perf_counter() - self._acquired_at
+        site = self._site
+        self._lock.release()
+        record_lock_timing(self.name, site, None, held)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self._acquire(call_site(2))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+def call_site(depth):
+    frame = sys._getframe(depth)
+    return f"{frame.f_code.co_name}:{frame.f_lineno}"
+
+# lock_stats: {(lock_name, call_site): [acquisitions, total_wait, max_wait, total_hold, max_hold]} (seconds)
+lock_stats = {}
+lock_stats_lock = threading.Lock() # Leaf lock, deliberately not instrumented
+
+def record_lock_timing(lock_name, site, waited, held):
+    with lock_stats_lock:
+        stats = lock_stats.setdefault((lock_name, site), [0, 0.0, 0.0, 0.0, 0.0])
+        if waited is not None:
+            stats[0] += 1
+            stats[1] += waited
+            stats[2] = max(stats[2], waited)
+        if held is not None:
+            stats[3] += held
+            stats[4] = max(stats[4], held)
+
+def install_lock_stats():
+    """Replaces the global locks with InstrumentedLocks. Must run before any thread starts."""
+    global items_lock, clients_lock
+    items_lock = InstrumentedLock('items_lock')
+    clients_lock = InstrumentedLock('clients_lock')
+
+def lock_stats_report():
+    """Lock contention per call site, most waited-for first."""
+    with lock_stats_lock:
+        rows = sorted(lock_stats.items(), key=lambda entry: entry[1][1], reverse=True)
+    lines = []
+    for (lock_name, site), (count, total_wait, max_wait, total_hold, max_hold) in rows:
+        lines.append(f"{lock_name} @ {site}: {count} acquisitions, "
+                     f"wait avg {total_wait / count * 1000:.3f} ms max {max_wait * 1000:.3f} ms, "
+                     f"hold avg {total_hold / count * 1000:.3f} ms max {max_hold * 1000:.3f} ms")
+    return lines
+
+def pack_id(value):
+    """
+    A uuid string as its 16 bytes; any other value (e.g. a hand-edited id) unchanged.
+    Only lowercase canonical uuids are packed, so unpack_id() gives back the same string.
+    """
+    if isinstance(value, str) and len(value) == 36 and value[8] == value[13] == value[18] == value[23] == '-' \
+       and value.islower():
+        try:
+            packed = bytes.fromhex(value[:8] + value[9:13] + value[14:18] + value[19:23] + value[24:])
+        except ValueError:
+            return value
+        if len(packed) == 16:
+            return packed
+    return value
+
+def unpack_id(value):
+    if isinstance(value, bytes):
+        digits = value.hex()
+        return f"{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}"
+    return value
+
+def intern_value(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+class Item:
+    """
+    One stored item, in slots instead of a dict of its own: ids are kept as their 16 uuid
+    bytes and location, color and status are interned, since they repeat across items.
+    Reads like the dict it replaces - item["name"], item.get(), dict(item) - with ids given
+    back as strings. to_dict() is the JSON form, used only for persistence and the protocol.
+    Fields outside FIELDS (sent along with a report) are kept in extra.
+    """
+    FIELDS = ('name', 'color', 'location', 'description', 'id', 'reporter_id', 'timestamp', 'matched_with',
+              'status', 'claimed_by', 'matched_at', 'claimed_at')
+    ID_FIELDS = frozenset(('id', 'reporter_id', 'matched_with', 'claimed_by'))
+    INTERNED_FIELDS = frozenset(('color', 'location', 'status'))
+    OPTIONAL_FIELDS = frozenset(('claimed_by', 'matched_at', 'claimed_at')) # Only present once set
+    FIELD_SET = frozenset(FIELDS)
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, fields):
+        get = fields.get
+        self.name = get('name')
+        self.color = intern_value(get('color'))
+        self.location = intern_value(get('location'))
+        self.description = get('description')
+        self.id = pack_id(get('id'))
+        self.reporter_id = pack_id(get('reporter_id'))
+        self.timestamp = get('timestamp')
+        self.matched_with = pack_id(get('matched_with'))
+        self.status = intern_value(get('status'))
+        self.claimed_by = pack_id(get('claimed_by'))
+        self.matched_at = get('matched_at')
+        self.claimed_at = get('claimed_at')
+        self.extra = None
+        if not fields.keys() <= Item.FIELD_SET:
+            self.extra = {key: value for key, value in fields.items() if key not in Item.FIELD_SET}
+
+    def __getitem__(self, key):
+        if key in Item.FIELD_SET:
+            value = getattr(self, key)
+            if value is None and key in Item.OPTIONAL_FIELDS:
+                raise KeyError(key)
+            return unpack_id(value)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in Item.ID_FIELDS:
+            setattr(self, key, pack_id(value))
+        elif key in Item.INTERNED_FIELDS:
+            setattr(self, key, intern_value(value))
+        elif key in Item.FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [key for key in Item.FIELDS if key not in Item.OPTIONAL_FIELDS or getattr(self, key) is not None]
+        if self.extra:
+            keys += self.extra.keys()
+        return keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def update(self, fields):
+        for key, value in fields.items():
+            self[key] = value
+
+    def to_record(self):
+        """The slots as a tuple, as stored in the binary snapshot."""
+        return (self.name, self.color, self.location, self.description, self.id, self.reporter_id,
+                self.timestamp, self.matched_with, self.status, self.claimed_by, self.extra,
+                self.matched_at, self.claimed_at)
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        The Item of a to_record() tuple (ids already packed, values already interned). Records
+        of older snapshots end at extra, which may hold matched_at and claimed_at.
+        """
+        item = cls.__new__(cls)
+        (item.name, item.color, item.location, item.description, item.id, item.reporter_id,
+         item.timestamp, item.matched_with, item.status, item.claimed_by, item.extra) = record[:11]
+        if len(record) > 11:
+            item.matched_at, item.claimed_at = record[11:13]
+        else:
+            extra = item.extra or {}
+            item.matched_at, item.claimed_at = extra.pop('matched_at', None), extra.pop('claimed_at', None)
+            item.extra = extra or None
+        return item
+
+    def to_dict(self):
+        item = {'name': self.name, 'color': self.color, 'location': self.location, 'description': self.description,
+                'id': unpack_id(self.id), 'reporter_id': unpack_id(self.reporter_id), 'timestamp': self.timestamp,
+                'matched_with': unpack_id(self.matched_with), 'status': self.status}
+        if self.claimed_by is not None:
+            item['claimed_by'] = unpack_id(self.claimed_by)
+        if self.matched_at is not None:
+            item['matched_at'] = self.matched_at
+        if self.claimed_at is not None:
+            item['claimed_at'] = self.claimed_at
+        if self.extra:
+            item.update(self.extra)
+        return item
+
+    def __repr__(self):
+        return f"Item({self.to_dict()!r})"
+
+class ItemsLoading(RuntimeError):
+    """An item change arrived while the store is still loading at startup."""
+
+def require_loaded():
+    """Raises ItemsLoading until load_items() has finished; item operations that write call it first."""
+    if not items_loaded.is_set():
+        raise ItemsLoading("items are still loading")
+
+SNAPSHOT_MAGIC = b'LFSNAP1\n'
+SNAPSHOT_TRAILER = struct.Struct('!QQ8s') # Offset and length of the chunk index, then SNAPSHOT_MAGIC again
+
+def write_snapshot_file(path, records):
+    """
+    Writes Item.to_record() tuples as a binary snapshot: SNAPSHOT_MAGIC, chunks of
+    SNAPSHOT_CHUNK_ITEMS records (each one marshal blob, so loading a chunk is a single C
+    call), the chunk index [(offset, length)] and a trailer pointing at the index.
+    Written to a temporary file and synced before it replaces the old one.
+    """
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            chunk_index = []
+            for start in range(0, len(records), SNAPSHOT_CHUNK_ITEMS):
+                blob = marshal.dumps(records[start:start + SNAPSHOT_CHUNK_ITEMS], 4)
+                chunk_index.append((f.tell(), len(blob)))
+                f.write(blob)
+            index_offset = f.tell()
+            blob = marshal.dumps(chunk_index, 4)
+            f.write(blob)
+            f.write(SNAPSHOT_TRAILER.pack(index_offset, len(blob), SNAPSHOT_MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        log_event(DEBUG, 'SYSTEM', "Saved snapshot", count=len(records), file=path)
+    except IOError as e:
+        log_event(ERROR, 'SYSTEM', "Could not save snapshot", file=path, error=e)
+        return False
+    return True
+
+def read_snapshot_chunks(path):
+    """
+    Yields the record lists of a binary snapshot one chunk at a time, read through a memory
+    map. Raises ValueError if the file is not a complete snapshot.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if len(mapped) < len(SNAPSHOT_MAGIC) + SNAPSHOT_TRAILER.size or mapped[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("not a snapshot file")
+        index_offset, index_length, magic = SNAPSHOT_TRAILER.unpack_from(mapped, len(mapped) - SNAPSHOT_TRAILER.size)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("truncated snapshot file")
+        try:
+            chunk_index = marshal.loads(mapped[index_offset:index_offset + index_length])
+            for offset, length in chunk_index:
+                yield marshal.loads(mapped[offset:offset + length])
+        except (EOFError, TypeError) as e: # What marshal raises for bad data
+            raise ValueError(f"damaged snapshot file: {e}") from e
+
+class JsonItemStore:
+    """
+    Keeps every item in memory and persists them to a JSON data file.
+    With a journal, each change is appended to the journal file as one record and folded
+    into a binary snapshot file by save(); without one, the data file is rewritten on every
+    change (original behaviour). Whichever of the data file and the snapshot is newer is
+    loaded, so switching between the two modes keeps the latest items.
+    Items are held as Item records and found through an id -> position map and a
+    reporter_id -> items index (both keyed by packed ids), so lookups and changes touch only
+    the items concerned. A removed item leaves a None slot
+    behind until the next load, so list positions (and GET_ITEMS cursors) stay valid.
+    Every method except load() and save() expects the caller to hold items_lock.
+    """
+    def __init__(self, data_file, journal_path=None, snapshot_path=None):
+        self.data_file = data_file
+        self.journal_path = journal_path
+        self.snapshot_path = snapshot_path
+        self._reset()
+        self.journal_file = None
+        self.journal_records = 0 # Records written since the last compaction
+        self.save_lock = InstrumentedLock('save_lock') if LOCK_STATS else threading.Lock() # Serializes save(); always taken before items_lock
+
+    def _reset(self):
+        self.items = []  # List of Items (None where an item was removed)
+        self.positions = {} # {packed item id: position in items}
+        self.by_reporter = {} # {packed reporter_id: [items]}, in report order (a reporter has few)
+        self.status_counts = collections.Counter() # {status: live items}
+        # Secondary indexes for search(): {(location, status): {Items}}, {name word: {Items}},
+        # and the items sorted by report time as two parallel lists (timestamps, Items). A
+        # removed item leaves None in timestamp_items (deleting from the middle of a list is
+        # O(n)); the lists are compacted once half of their entries are None.
+        self.by_location_status = {}
+        self.by_name_word = {}
+        self.timestamp_keys = []
+        self.timestamp_items = []
+        self.timestamp_removed = 0
+
+    def load(self):
+        """
+        Loads items from the snapshot or the data file, whichever is newer. In journal mode
+        the journal records written since are replayed on top.
+        items_lock is taken once per chunk of SNAPSHOT_CHUNK_ITEMS items, never for the whole
+        load, so clients can read the items loaded so far. Garbage collection is paused
+        meanwhile, since it would rescan every loaded item over and over. Afterwards the
+        loaded items are frozen out of later collections.
+        """
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            if self._snapshot_is_newer():
+                self._load_snapshot()
+            else:
+                self._load_data_file()
+            if self.journal_path:
+                with items_lock:
+                    replayed = self._replay_journal(self.journal_path + '.compacting')
+                    replayed += self._replay_journal(self.journal_path)
+                    self.journal_file = open(self.journal_path, 'ab')
+                if replayed:
+                    log_event(INFO, 'SYSTEM', "Replayed journal", records=replayed, count=len(self.items))
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        gc.freeze()
+
+    def _snapshot_is_newer(self):
+        try:
+            snapshot_mtime = os.path.getmtime(self.snapshot_path) if self.snapshot_path else None
+        except OSError:
+            return False
+        try:
+            return snapshot_mtime >= os.path.getmtime(self.data_file)
+        except OSError:
+            return True
+
+    def _load_snapshot(self):
+        """
+        Loads the binary snapshot. If it cannot be read, the load fails (having loaded nothing)
+        rather than falling back to the data file: the snapshot is the newer copy, and in
+        journal mode the data file is never updated, so the next compaction would replace the
+        snapshot with whatever old state the data file held.
+        """
+        try:
+            for records in read_snapshot_chunks(self.snapshot_path):
+                loaded = [Item.from_record(record) for record in records]
+                with items_lock:
+                    for item in loaded:
+                        self._load_item(item, self.snapshot_path)
+        except (OSError, ValueError):
+            with items_lock:
+                self._reset()
+            raise
+        log_event(INFO, 'SYSTEM', "Loaded items", count=len(self.items), file=self.snapshot_path)
+
+    def _load_data_file(self):
+        try:
+            with open(self.data_file, 'r') as f:
+                loaded = json.load(f)
+        except FileNotFoundError:
+            log_event(INFO, 'SYSTEM', "Data file not found; starting with an empty item list", file=self.data_file)
+            return
+        except json.JSONDecodeError:
+            log_event(ERROR, 'SYSTEM', "Could not decode data file; starting with an empty item list", file=self.data_file)
+            return
+        for start in range(0, len(loaded), SNAPSHOT_CHUNK_ITEMS):
+            chunk = [Item(item) for item in loaded[start:start + SNAPSHOT_CHUNK_ITEMS]]
+            loaded[start:start + SNAPSHOT_CHUNK_ITEMS] = [None] * len(chunk) # Free the dicts as they are converted
+            with items_lock:
+                for item in chunk:
+                    self._load_item(item, self.data_file)
+        log_event(INFO, 'SYSTEM', "Loaded items", count=len(self.items), file=self.data_file)
+
+    def _replay_journal(self, path):
+        """
+        Applies the records of one journal file to items. Caller must hold items_lock.
+        A torn record at the end of the file (crash in the middle of a write) is dropped
+        and truncated away so later appends start on a clean line.
+        """
+        try:
+            f = open(path, 'r+b')
+        except FileNotFoundError:
+            return 0
+        replayed = 0
+        good_offset = 0
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if not line.endswith(b'\n'):
+                        raise ValueError("unterminated record")
+                except ValueError:
+                    log_event(WARNING, 'SYSTEM', "Ignoring torn journal record", file=path, offset=good_offset)
+                    break
+                good_offset += len(line)
+                replayed += 1
+                if record["op"] == "add":
+                    item = record["item"]
+                    if pack_id(item["id"]) in self.positions: # Already contained in the snapshot
+                        self._apply_update(item["id"], item)
+                    else:
+                        self._load_item(Item(item), path)
+                elif record["op"] == "update":
+                    self._apply_update(record["id"], record["fields"])
+                elif record["op"] == "remove":
+                    self._apply_remove(record["id"])
+            f.truncate(good_offset)
+        return replayed
+
+    def _apply_add(self, item):
+        search_keys = self._search_keys(item) # Raises before anything changes
+        self.positions[item.id] = len(self.items)
+        self.items.append(item)
+        self.by_reporter.setdefault(item.reporter_id, []).append(item)
+        self.status_counts[item.status] += 1
+        self._index_search(item, search_keys=search_keys)
+
+    def _load_item(self, item, path):
+        """_apply_add for a loaded item: one that cannot be stored is logged and skipped."""
+        try:
+            self._apply_add(item)
+        except ValueError as e:
+            log_event(ERROR, 'SYSTEM', "Skipping an item that cannot be loaded", file=path, error=e)
+
+    def _apply_update(self, item_id, fields):
+        item = self.get(item_id)
+        if item is None:
+            return None
+        if "status" in fields:
+            self.status_counts[item.status] -= 1
+            self.status_counts[fields["status"]] += 1
+        reindex = SEARCH_FIELDS.intersection(fields) # Only the indexes of changed fields are touched
+        if reindex:
+            self._unindex_search(item, reindex)
+        if "reporter_id" in fields and pack_id(fields["reporter_id"]) != item.reporter_id:
+            self._unlink_reporter(item)
+            item.update(fields)
+            self.by_reporter.setdefault(item.reporter_id, []).append(item)
+        else:
+            item.update(fields)
+        if reindex:
+            self._index_search(item, reindex)
+        return item
+
+    def _apply_remove(self, item_id):
+        position = self.positions.pop(pack_id(item_id), None)
+        if position is None:
+            return None
+        item = self.items[position]
+        self.items[position] = None
+        self._unlink_reporter(item)
+        self.status_counts[item.status] -= 1
+        self._unindex_search(item)
+        return item
+
+    def _search_keys(self, item):
+        """(name words, timestamp) of item for the search indexes. Raises ValueError for fields that are not text."""
+        name, timestamp = item.name or "", item.timestamp or ""
+        if not all(isinstance(value, str) for value in (name, timestamp, item.location, item.status)):
+            raise ValueError(f"item {item.get('id')} has a name, location, status or timestamp that is not text")
+        return set(normalize_words(name)), timestamp
+
+    def _index_search(self, item, fields=None, search_keys=None):
+        """Adds item to the search indexes of fields (all of them for a new item)."""
+        fields = SEARCH_FIELDS if fields is None else fields
+        name_words, timestamp = search_keys or self._search_keys(item)
+        if 'location' in fields or 'status' in fields:
+            self.by_location_status.setdefault((item.location, item.status), set()).add(item)
+        if 'name' in fields:
+            for word in name_words:
+                self.by_name_word.setdefault(word, set()).add(item)
+        if 'timestamp' not in fields:
+            return
+        if not self.timestamp_keys or timestamp >= self.timestamp_keys[-1]: # Reports arrive in time order
+            self.timestamp_keys.append(timestamp)
+            self.timestamp_items.append(item)
+        else:
+            position = bisect.bisect_right(self.timestamp_keys, timestamp)
+            self.timestamp_keys.insert(position, timestamp)
+            self.timestamp_items.insert(position, item)
+
+    def _unindex_search(self, item, fields=None):
+        """Takes item out of the search indexes of fields (default all), before they change."""
+        fields = SEARCH_FIELDS if fields is None else fields
+        if 'location' in fields or 'status' in fields:
+            items = self.by_location_status.get((item.location, item.status))
+            if items is not None:
+                items.discard(item)
+                if not items:
+                    del self.by_location_status[(item.location, item.status)]
+        if 'name' in fields:
+            for word in set(normalize_words(item.name or "")):
+                items = self.by_name_word.get(word)
+                if items is not None:
+                    items.discard(item)
+                    if not items:
+                        del self.by_name_word[word]
+        if 'timestamp' not in fields:
+            return
+        timestamp = item.timestamp or ""
+        position = bisect.bisect_left(self.timestamp_keys, timestamp)
+        while position < len(self.timestamp_items) and self.timestamp_items[position] is not item:
+            position += 1
+        if position < len(self.timestamp_items):
+            self.timestamp_items[position] = None
+            self.timestamp_removed += 1
+            if self.timestamp_removed * 2 > len(self.timestamp_items):
+                kept = [position for position, kept_item in enumerate(self.timestamp_items) if kept_item is not None]
+                self.timestamp_keys = [self.timestamp_keys[position] for position in kept]
+                self.timestamp_items = [self.timestamp_items[position] for position in kept]
+                self.timestamp_removed = 0
+
+    def search(self, query):
+        """
+        The Items matching a parse_search() query, sorted and cut to its limit. Candidates come
+        from whichever index narrows the query most - the (location, status) sets, the name
+        words containing the name filter, or the timestamp range - and only those are filtered.
+        Sorted by time, the timestamp index is walked in order and stops at the limit.
+        """
+        low, high = 0, len(self.timestamp_keys)
+        if query['since']:
+            low = bisect.bisect_left(self.timestamp_keys, query['since'])
+        if query['until']:
+            high = bisect.bisect_right(self.timestamp_keys, query['until'])
+        candidates, size = None, max(high - low, 0)
+        if query['location'] or query['status']:
+            sets = [items for (location, status), items in self.by_location_status.items()
+                    if (not query['location'] or location in query['location'])
+                    and (not query['status'] or status in query['status'])]
+            in_sets = sum(map(len, sets))
+            if in_sets < size:
+                candidates, size = itertools.chain.from_iterable(sets), in_sets
+        if query['name']:
+            named = None
+            for query_word in normalize_words(query['name']):
+                word_items = set().union(*(items for word, items in self.by_name_word.items() if query_word in word))
+                named = word_items if named is None else named & word_items
+            if named is not None and len(named) < size:
+                candidates, size = named, len(named)
+        if candidates is None and query['sort'] in ('newest', 'oldest'):
+            in_range = self.timestamp_items[low:high]
+            ordered = reversed(in_range) if query['sort'] == 'newest' else in_range
+            return list(itertools.islice((item for item in ordered if item is not None and search_matches(item, query)),
+                                         query['limit']))
+        if candidates is None:
+            candidates = self.timestamp_items[low:high]
+        matches = (item for item in candidates if item is not None and search_matches(item, query))
+        key, reverse = search_sort_key(query['sort'], of_items=True)
+        return heapq.nlargest(query['limit'], matches, key) if reverse else heapq.nsmallest(query['limit'], matches, key)
+
+    def _unlink_reporter(self, item):
+        reporter_items = self.by_reporter.get(item.reporter_id)
+        if reporter_items is not None and item in reporter_items:
+            reporter_items.remove(item)
+            if not reporter_items:
+                del self.by_reporter[item.reporter_id]
+
+    def add(self, item):
+        """Stores a new item (a dict or an Item). Returns the stored Item."""
+        item = item if isinstance(item, Item) else Item(item)
+        self._apply_add(item)
+        self._persist({'op': 'add', 'item': item.to_dict()})
+        return item
+
+    def get(self, item_id):
+        """Returns the item with item_id, or None."""
+        position = self.positions.get(pack_id(item_id))
+        return None if position is None else self.items[position]
+
+    def update(self, item_id, fields):
+        """Applies fields to the item with item_id. Returns the updated item or None."""
+        item = self._apply_update(item_id, fields)
+        if item is not None:
+            self._persist({'op': 'update', 'id': item_id, 'fields': fields})
+        return item
+
+    def remove(self, item_id):
+        """Deletes the item with item_id. Returns the removed item or None."""
+        item = self._apply_remove(item_id)
+        if item is not None:
+            self._persist({'op': 'remove', 'id': item_id})
+        return item
+
+    def remove_many(self, item_ids):
+        """Deletes several items, persisted together (one journal write, or one rewrite). Returns how many."""
+        removed = [item_id for item_id in item_ids if self._apply_remove(item_id) is not None]
+        if removed:
+            self._persist(*({'op': 'remove', 'id': item_id} for item_id in removed))
+        return len(removed)
+
+    def items_by_reporter(self, reporter_id):
+        return list(self.by_reporter.get(pack_id(reporter_id), ()))
+
+    def live_items(self):
+        return [item for item in self.items if item is not None]
+
+    def count_by_status(self):
+        return {status: count for status, count in self.status_counts.items() if count}
+
+    def scan(self, cursor, limit):
+        """
+        Returns (up to limit stored Items starting at cursor, next cursor or None).
+        The cursor is the list position, as a string. Raises ValueError for a bad cursor.
+        """
+        position = int(cursor)
+        if position < 0:
+            raise ValueError("negative cursor")
+        scanned = []
+        while position < len(self.items) and len(scanned) < limit:
+            item = self.items[position]
+            position += 1
+            if item is not None:
+                scanned.append(item)
+        return scanned, (str(position) if position < len(self.items) else None)
+
+    def page(self, cursor, limit):
+        """Like scan(), with copies of the items."""
+        scanned, next_cursor = self.scan(cursor, limit)
+        return [item.to_dict() for item in scanned], next_cursor
+
+    def _persist(self, *records):
+        """
+        Persists changes. Runs under items_lock, so records land in the journal in the
+        same order the changes were applied. Without a journal this is a full rewrite.
+        """
+        started = time.perf_counter()
+        if not self.journal_file:
+            self._write_snapshot([item.to_dict() for item in self.live_items()])
+            metric_observe('lostfound_persist_seconds', time.perf_counter() - started, (('op', 'rewrite'),))
+            return
+        try:
+            self.journal_file.write(b''.join(json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+                                             for record in records))
+            self.journal_file.flush()
+            if JOURNAL_FSYNC:
+                os.fsync(self.journal_file.fileno())
+        except (IOError, ValueError) as e:
+            log_event(ERROR, 'SYSTEM', "Could not append to journal", file=self.journal_path, error=e)
+            return
+        metric_observe('lostfound_persist_seconds', time.perf_counter() - started, (('op', 'journal'),))
+        self.journal_records += len(records)
+        if self.journal_records >= JOURNAL_COMPACT_EVERY:
+            compact_requested.set()
+
+    def _write_snapshot(self, snapshot_items):
+        """
+        Writes a list of items to the data file atomically: the new file is fully written and
+        synced before it replaces the old one, so a crash never leaves a truncated file behind.
+        """
+        tmp_path = self.data_file + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot_items, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.data_file)
+            log_event(DEBUG, 'SYSTEM', "Saved items", count=len(snapshot_items), file=self.data_file)
+        except IOError as e:
+            log_event(ERROR, 'SYSTEM', "Could not save items", file=self.data_file, error=e)
+            return False
+        return True
+
+    def needs_compaction(self):
+        return self.journal_records > 0
+
+    def close(self):
+        if self.journal_file:
+            self.journal_file.close()
+            self.journal_file = None
+
+    def save(self):
+        """
+        Saves the current list of items to the data file.
+        In journal mode this is a compaction: the journal is rotated aside under items_lock,
+        the binary snapshot is written without holding the lock, and the rotated journal is
+        deleted only once the snapshot is safely in place.
+        """
+        if not items_loaded.is_set(): # Never replace the files with a partly loaded store
+            return
+        with self.save_lock: # One compaction at a time, so an older snapshot never replaces a newer one
+            with items_lock:
+                if not self.journal_file:
+                    self._write_snapshot([item.to_dict() for item in self.live_items()])
+                    return
+                records = [item.to_record() for item in self.live_items()]
+                self.journal_file.close()
+                rotated_path = self.journal_path + '.compacting'
+                if os.path.exists(rotated_path):
+                    # A previous compaction never finished; keep its records too
+                    with open(rotated_path, 'ab') as rotated, open(self.journal_path, 'rb') as current:
+                        rotated.write(current.read())
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, rotated_path)
+                self.journal_file = open(self.journal_path, 'ab')
+                self.journal_records = 0
+            if write_snapshot_file(self.snapshot_path, records):
+                os.remove(rotated_path)
+
+class SqliteItemStore:
+    """
+    Keeps items in a SQLite database (WAL mode) instead of RAM, with indexes on
+    reporter_id, status, location and the normalized match key.
+    Fields other than the fixed columns are kept as JSON in the 'extra' column. Rows are
+    read back as Items.
+    Every method except load() and save() expects the caller to hold items_lock,
+    which also serializes use of the shared connection.
+    """
+    COLUMNS = ("id", "name", "color", "location", "description", "reporter_id", "timestamp", "status", "matched_with",
+               "matched_at", "claimed_at")
+    ADDED_COLUMNS = ("matched_at", "claimed_at") # Added to databases created before them on load
+    INSERT = (f"INSERT OR REPLACE INTO items ({', '.join(COLUMNS)}, match_key, extra) "
+              f"VALUES ({', '.join('?' * (len(COLUMNS) + 2))})")
+    # The name part of match_key: the name lowercased by Python, since SQLite's lower() only folds ASCII
+    NAME_KEY = "substr(match_key, 1, instr(match_key, char(31)) - 1)"
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = None
+
+    def load(self):
+        with items_lock:
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            self.db.row_factory = sqlite3.Row
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS items (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    color TEXT NOT NULL,
+                    location TEXT NOT NULL,
+                    description TEXT,
+                    reporter_id TEXT,
+                    timestamp TEXT,
+                    status TEXT NOT NULL,
+                    matched_with TEXT,
+                    match_key TEXT NOT NULL,
+                    extra TEXT,
+                    matched_at TEXT,
+                    claimed_at TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_items_reporter_id ON items(reporter_id);
+                CREATE INDEX IF NOT EXISTS idx_items_status ON items(status);
+                CREATE INDEX IF NOT EXISTS idx_items_location ON items(location);
+                CREATE INDEX IF NOT EXISTS idx_items_match_key ON items(match_key, status);
+                CREATE INDEX IF NOT EXISTS idx_items_location_status_time ON items(location, status, timestamp);
+                CREATE INDEX IF NOT EXISTS idx_items_timestamp ON items(timestamp);
+            """)
+            existing = {row["name"] for row in self.db.execute("PRAGMA table_info(items)")}
+            for column in self.ADDED_COLUMNS:
+                if column not in existing:
+                    self.db.execute(f"ALTER TABLE items ADD COLUMN {column} TEXT")
+            count = self.db.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+        log_event(INFO, 'SYSTEM', "Opened database", file=self.db_path, count=count)
+
+    def _row_values(self, item):
+        extra = {k: v for k, v in item.items() if k not in self.COLUMNS}
+        return tuple(item.get(column) for column in self.COLUMNS) + (
+            '\x1f'.join(match_key(item)), json.dumps(extra) if extra else None)
+
+    def _row_to_item(self, row):
+        item = Item({column: row[column] for column in self.COLUMNS})
+        if row["extra"]:
+            item.update(json.loads(row["extra"]))
+        return item
+
+    def _write(self, sql, parameters):
+        """Runs one modifying statement (committed by itself in autocommit mode), timing it."""
+        started = time.perf_counter()
+        self.db.execute(sql, parameters)
+        metric_observe('lostfound_persist_seconds', time.perf_counter() - started, (('op', 'sqlite'),))
+
+    def _write_many(self, sql, rows):
+        """Runs one modifying statement per row of parameters in a single transaction, timing it."""
+        started = time.perf_counter()
+        self.db.execute("BEGIN")
+        try:
+            self.db.executemany(sql, rows)
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        metric_observe('lostfound_persist_seconds', time.perf_counter() - started, (('op', 'sqlite'),))
+
+    def add(self, item):
+        """Stores a new item (a dict or an Item). Returns the stored Item."""
+        item = item if isinstance(item, Item) else Item(item)
+        self._write(self.INSERT, self._row_values(item))
+        return item
+
+    def add_many(self, items):
+        """Stores several items (dicts or Items) in one transaction."""
+        self._write_many(self.INSERT,
+                         [self._row_values(item) for item in items])
+
+    def get(self, item_id):
+        """Returns the item with item_id, or None."""
+        row = self.db.execute("SELECT * FROM items WHERE id = ?", (item_id,)).fetchone()
+        return None if row is None else self._row_to_item(row)
+
+    def update(self, item_id, fields):
+        """Applies fields to the item with item_id. Returns the updated item or None."""
+        item = self.get(item_id)
+        if item is None:
+            return None
+        item.update(fields)
+        assignments = ", ".join(f"{column} = ?" for column in self.COLUMNS[1:]) # Keep id and rowid order
+        self._write(f"UPDATE items SET {assignments}, match_key = ?, extra = ? WHERE id = ?",
+                    self._row_values(item)[1:] + (item_id,))
+        return item
+
+    def remove(self, item_id):
+        """Deletes the item with item_id. Returns the removed item or None."""
+        item = self.get(item_id)
+        if item is not None:
+            self._write("DELETE FROM items WHERE id = ?", (item_id,))
+        return item
+
+    def remove_many(self, item_ids):
+        """Deletes several items in one transaction. Returns how many."""
+        before = self.db.total_changes
+        self._write_many("DELETE FROM items WHERE id = ?", [(item_id,) for item_id in item_ids])
+        return self.db.total_changes - before
+
+    def items_by_reporter(self, reporter_id):
+        rows = self.db.execute("SELECT * FROM items WHERE reporter_id = ? ORDER BY rowid", (reporter_id,))
+        return [self._row_to_item(row) for row in rows]
+
+    def page(self, cursor, limit):
+        """
+        Returns (up to limit items after cursor, next cursor or None).
+        The cursor is the last rowid returned, as a string. Raises ValueError for a bad cursor.
+        """
+        after = int(cursor)
+        if after < 0:
+            raise ValueError("negative cursor")
+        rows = self.db.execute("SELECT rowid, * FROM items WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                               (after, limit + 1)).fetchall()
+        next_cursor = str(rows[limit - 1]["rowid"]) if len(rows) > limit else None
+        return [self._row_to_item(row) for row in rows[:limit]], next_cursor
+
+    scan = page # Rows are read into new Items either way
+
+    def search(self, query):
+        """
+        The Items matching a parse_search() query, sorted and cut to its limit. Status,
+        location, time range and sort go to SQL, where the (location, status, timestamp) and
+        timestamp indexes serve them; the name and color filters are checked on the rows.
+        """
+        conditions, parameters = [], []
+        for column in ('status', 'location'):
+            if query[column]:
+                conditions.append(f"{column} IN ({', '.join('?' * len(query[column]))})")
+                parameters += sorted(query[column])
+        if query['since']:
+            conditions.append("timestamp >= ?")
+            parameters.append(query['since'])
+        if query['until']:
+            conditions.append("timestamp <= ?")
+            parameters.append(query['until'])
+        if query['name']:
+            conditions.append(f"instr({self.NAME_KEY}, ?) > 0")
+            parameters.append(query['name'])
+        order = {'newest': "timestamp DESC, rowid DESC", 'oldest': "timestamp, rowid",
+                 'name': f"{self.NAME_KEY}, timestamp"}[query['sort']]
+        rows = self.db.execute(f"SELECT * FROM items {'WHERE ' + ' AND '.join(conditions) if conditions else ''} ORDER BY {order}",
+                               parameters)
+        matches = (item for item in map(self._row_to_item, rows) if search_matches(item, query))
+        return list(itertools.islice(matches, query['limit']))
+
+    def count_by_status(self):
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM items GROUP BY status").fetchall())
+
+    def needs_compaction(self):
+        return False
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def save(self):
+        """Checkpoints the WAL into the main database file."""
+        with items_lock:
+            if self.db:
+                self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def create_item_store(data_file=None, journal_file=None, sqlite_file=None, snapshot_file=None):
+    """Builds the item store selected by STORAGE_MODE (on the configured files unless given others)."""
+    if STORAGE_MODE == 'sqlite':
+        return SqliteItemStore(sqlite_file or SQLITE_FILE)
+    if STORAGE_MODE == 'journal':
+        return JsonItemStore(data_file or DATA_FILE, journal_file or JOURNAL_FILE, snapshot_file or SNAPSHOT_FILE)
+    return JsonItemStore(data_file or DATA_FILE, snapshot_path=snapshot_file or SNAPSHOT_FILE)
+
+def import_json_items(json_path):
+    """One-shot import of an existing items.json into SQLITE_FILE."""
+    with open(json_path, 'r') as f:
+        imported_items = json.load(f)
+    store = SqliteItemStore(SQLITE_FILE)
+    store.load()
+    with items_lock:
+        store.add_many(imported_items)
+    store.save()
+    log_event(INFO, 'SYSTEM', "Imported items", count=len(imported_items), source=json_path, file=SQLITE_FILE)
+
+def load_items(after_load=None):
+    """
+    Creates the item store selected by STORAGE_MODE and loads it on a background thread,
+    so the server can accept connections straight away. after_load, if given, runs on that
+    thread once the store is loaded, before items_loaded is set.
+    """
+    global item_store
+    items_loaded.clear()
+    with items_lock:
+        # Reporters of stored items are from earlier connections and can never be matched again
+        match_index.clear()
+        match_open_items.clear()
+        match_index_by_reporter.clear()
+    item_store = create_item_store()
+    open_archive()
+    threading.Thread(target=load_worker, args=(after_load,), daemon=True).start()
+
+def load_worker(after_load):
+    """
+    Background thread started by load_items(). If loading fails the store stays unloaded,
+    so it refuses changes instead of overwriting the files it could not read.
+    """
+    started = time.perf_counter()
+    try:
+        item_store.load()
+        if after_load:
+            after_load()
+    except Exception as e:
+        log_event(ERROR, 'SYSTEM', "Could not load items; refusing item changes", error=e)
+        return
+    items_loaded.set()
+    with items_lock:
+        count = sum(item_store.count_by_status().values())
+    log_event(INFO, 'SYSTEM', "Items ready", count=count, seconds=round(time.perf_counter() - started, 2))
+
+def save_items():
+    """Saves (compacts/checkpoints) the item store."""
+    started = time.perf_counter()
+    item_store.save()
+    metric_observe('lostfound_persist_seconds', time.perf_counter() - started, (('op', 'save'),))
+
+def open_archive():
+    global archive_store
+    archive_store = SqliteItemStore(ARCHIVE_FILE)
+    archive_store.load()
+
+def archivable(item, open_before, matched_before):
+    """
+    Whether an item belongs in the archive, given the timestamps that count as old: open
+    items age from their report, matched and claimed ones from when they were matched or
+    claimed (items from before those were recorded fall back to the report time).
+    """
+    status = item["status"]
+    if status == "resolved":
+        return True
+    reported = item.get("timestamp") or ""
+    if status == "matched":
+        return (item.get("matched_at") or reported) < matched_before
+    if status == "claimed":
+        return (item.get("claimed_at") or reported) < matched_before
+    return reported < open_before
+
+def items_archive_batch(cursor, open_before, matched_before):
+    """
+    The next ARCHIVE_BATCH items of an archival pass over item_store: moves the archivable()
+    ones to archive_store in one items_lock hold. A batch is written to the archive before it
+    leaves the store, so readers find each item in one of the two; if the server stops in
+    between, the next pass archives the batch again (INSERT OR REPLACE).
+    Returns (the archived items, the cursor of the next batch or None).
+    """
+    with items_lock:
+        if not server_running.is_set() or not items_loaded.is_set(): # Stores may be closing or loading
+            return [], None
+        batch, cursor = item_store.scan(cursor, ARCHIVE_BATCH)
+        expired = [item for item in batch if archivable(item, open_before, matched_before)]
+        if not expired:
+            return [], cursor
+        archive_store.add_many(expired)
+        for item in expired:
+            unindex_item(item)
+        archived = [item.to_dict() for item in expired]
+        item_store.remove_many([item["id"] for item in expired])
+        compact_requested.set() # Fold the removals into a smaller snapshot
+        return archived, cursor
+
+def archive_items():
+    """
+    One archival pass, driven from the server process a batch at a time (on each shard in
+    turn with SHARDS), so archived items leave the change feed and WATCH subscribers like
+    any other removal. Returns how many items were moved.
+    """
+    now = time.time()
+    open_before = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now - ARCHIVE_OPEN_TTL))
+    matched_before = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now - ARCHIVE_MATCHED_AGE))
+    moved = 0
+    for shard in shard_pool or [None]:
+        cursor = "0"
+        while cursor and server_running.is_set():
+            args = (cursor, open_before, matched_before)
+            archived, cursor = shard.call('archive_batch', args) if shard else items_archive_batch(*args)
+            if archived:
+                moved += len(archived)
+                publish_item_change(archived, 'removed')
+    if moved:
+        metric_inc('lostfound_archived_items_total', amount=moved)
+    return moved
+
+def archive_worker():
+    """Background thread that runs an archival pass every ARCHIVE_INTERVAL seconds."""
+    while server_running.is_set():
+        archive_requested.wait(ARCHIVE_INTERVAL)
+        if not server_running.is_set():
+            break
+        try:
+            moved = archive_items()
+        except (ShardError, OSError) as e:
+            if server_running.is_set():
+                log_event(ERROR, 'ARCHIVE', "Archival pass failed", error=e)
+            continue
+        if moved:
+            log_event(INFO, 'ARCHIVE', "Archived items", count=moved, file=ARCHIVE_FILE)
+
+def compaction_worker():
+    """Background thread that folds the journal into a new snapshot periodically."""
+    while server_running.is_set():
+        compact_requested.wait(JOURNAL_COMPACT_INTERVAL)
+        compact_requested.clear()
+        if not server_running.is_set():
+            break
+        if item_store.needs_compaction():
+            save_items()
+            log_event(INFO, 'SYSTEM', "Compacted journal", file=SNAPSHOT_FILE)
+
+def match_key(item):
+    """Normalized exact (name, color, location) key, stored by SqliteItemStore."""
+    return (item["name"].strip().lower(), item["color"].strip().lower(), item["location"])
+
+WORD_PATTERN = re.compile(r'[^\W_]+') # Runs of characters for which str.isalnum() is true
+
+def normalize_words(text):
+    """Lowercase alphanumeric words of text."""
+    return WORD_PATTERN.findall(text.lower())
+
+def name_trigrams(name):
+    """Trigrams of each word of name, padded so that short words and word edges count too."""
+    grams = set()
+    for word in normalize_words(name):
+        padded = f" {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return frozenset(grams)
+
+def normalize_color(color):
+    """Canonical color words of a color description ("Blk" and "dark black" both give {'black'})."""
+    words = {COLOR_SYNONYMS.get(word, word) for word in normalize_words(color)}
+    return frozenset(words - COLOR_MODIFIERS) or frozenset(words)
+
+def description_words(description):
+    """Significant words of a description, used as whole-word index terms."""
+    return frozenset(word for word in normalize_words(description)
+                     if len(word) > 2 and word not in DESCRIPTION_STOPWORDS)
+
+# Fields that decide where an item sits in JsonItemStore's search indexes
+SEARCH_FIELDS = frozenset(('location', 'status', 'name', 'timestamp'))
+SEARCH_SORTS = ('newest', 'oldest', 'name')
+
+def parse_search(text):
+    """
+    The query of SEARCH <json filter>: {"status": ..., "location": ..., "color": ... (each a
+    string or a list), "name": substring, "from"/"to": "YYYY-MM-DD[ HH:MM:SS]" (inclusive),
+    "sort": "newest"/"oldest"/"name", "limit": n}. Raises ValueError for a bad filter.
+    """
+    try:
+        filters = json.loads(text) if text.strip() else {}
+    except json.JSONDecodeError as e:
+        raise ValueError("the filter is not JSON") from e
+    if not isinstance(filters, dict):
+        raise ValueError("the filter must be a JSON object")
+    unknown = filters.keys() - {'status', 'location', 'color', 'name', 'from', 'to', 'sort', 'limit'}
+    if unknown:
+        raise ValueError(f"unknown filter {sorted(unknown)[0]!r}")
+    def choices(key):
+        value = filters.get(key) or []
+        values = [value] if isinstance(value, str) else value
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            raise ValueError(f"{key!r} must be a string or a list of strings")
+        return frozenset(values)
+    def time_bound(key, day_end):
+        value = filters.get(key)
+        if value is None:
+            return None
+        if not isinstance(value, str) or not value[:10].replace('-', '').isdigit():
+            raise ValueError(f"{key!r} must be a time like 2024-05-01 or 2024-05-01 14:30:00")
+        return value + " 23:59:59" if day_end and len(value) == 10 else value
+    status, location = choices('status'), choices('location')
+    if not status <= {'lost', 'found', 'matched', 'claimed', 'resolved'}:
+        raise ValueError("unknown status")
+    if not location <= set(LOCATIONS):
+        raise ValueError("unknown location")
+    name = filters.get('name') or ""
+    if not isinstance(name, str):
+        raise ValueError("'name' must be a string")
+    sort = filters.get('sort', 'newest')
+    if sort not in SEARCH_SORTS:
+        raise ValueError(f"'sort' must be one of {', '.join(SEARCH_SORTS)}")
+    limit = filters.get('limit', SEARCH_LIMIT)
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+        raise ValueError("'limit' must be a positive number")
+    colors = frozenset().union(*map(normalize_color, choices('color')))
+    return {'status': status, 'location': location, 'color': colors, 'name': name.strip().lower(),
+            'since': time_bound('from', False), 'until': time_bound('to', True), 'sort': sort,
+            'limit': min(limit, SEARCH_LIMIT_MAX)}
+
+def search_matches(item, query):
+    """Whether an Item passes every filter of a parse_search() query."""
+    timestamp = item.timestamp or ""
+    return ((not query['status'] or item.status in query['status'])
+            and (not query['location'] or item.location in query['location'])
+            and (not query['since'] or timestamp >= query['since'])
+            and (not query['until'] or timestamp <= query['until'])
+            and (not query['name'] or query['name'] in (item.name or "").lower())
+            and (not query['color'] or not normalize_color(item.color or "").isdisjoint(query['color'])))
+
+def search_sort_key(sort, of_items=False):
+    """(key, reverse) ordering Items (of_items) or their dicts for a SEARCH sort."""
+    get = getattr if of_items else dict.get
+    if sort == 'name':
+        return (lambda item: ((get(item, 'name') or "").strip().lower(), get(item, 'timestamp') or "")), False # As match_key
+    return (lambda item: get(item, 'timestamp') or ""), sort == 'newest'
+
+def match_features(item):
+    """(name trigrams, canonical colors, description words, name words) compared by match_score()."""
+    return (name_trigrams(item["name"]), normalize_color(item["color"]),
+            description_words(item.get("description", "")), frozenset(normalize_words(item["name"])))
+
+def index_terms(features):
+    """
+    Inverted index keys for an item: its name trigrams (which tolerate typos and partial
+    names), 'n:'-prefixed whole name words and 'w:'-prefixed description words (which are
+    far more selective than trigrams, so match_candidates usually counts them first).
+    """
+    grams, _, words, name_words = features
+    return list(grams) + ["n:" + word for word in name_words] + ["w:" + word for word in words]
+
+def match_score(features, other_features):
+    """
+    Similarity in [0, 1]: Dice coefficient of the name trigrams, whether the colors share a
+    canonical color, and the overlap of the description words, weighted by MATCH_WEIGHTS.
+    Two items whose colors are given and share no canonical color (neither being "multi")
+    score 0.
+    """
+    grams, colors, words, _ = features
+    other_grams, other_colors, other_words, _ = other_features
+    name_weight, color_weight, description_weight = MATCH_WEIGHTS
+    score = 0.0
+    if colors & other_colors:
+        score += color_weight
+    elif colors and other_colors and "multi" not in colors | other_colors:
+        return 0.0
+    if grams and other_grams:
+        score += name_weight * 2 * len(grams & other_grams) / (len(grams) + len(other_grams))
+    if words and other_words:
+        score += description_weight * len(words & other_words) / min(len(words), len(other_words))
+    return score
+
+def index_open_item(item):
+    """Adds an open lost/found Item to match_index. Caller must hold items_lock."""
+    if item.status not in ("lost", "found") or item.matched_with:
+        return
+    if item.id in match_open_items:
+        return
+    features = match_features(item)
+    partition_key = (item.location, item.status)
+    match_open_items[item.id] = (item, features, partition_key, item.reporter_id)
+    postings = match_index.setdefault(partition_key, {})
+    for term in index_terms(features):
+        postings.setdefault(term, {})[item.id] = item
+    match_index_by_reporter.setdefault(item.reporter_id, {})[item.id] = item
+
+def unindex_item(item):
+    """Removes an Item from match_index if present. Caller must hold items_lock."""
+    entry = match_open_items.pop(item.id, None)
+    if entry is None:
+        return
+    _, features, partition_key, reporter_id = entry
+    postings = match_index.get(partition_key, {})
+    for term in index_terms(features):
+        posting = postings.get(term)
+        if posting is not None:
+            posting.pop(item.id, None)
+            if not posting:
+                del postings[term]
+    if not postings:
+        match_index.pop(partition_key, None)
+    reporter_items = match_index_by_reporter.get(reporter_id)
+    if reporter_items is not None:
+        reporter_items.pop(item.id, None)
+        if not reporter_items:
+            del match_index_by_reporter[reporter_id]
+
+def unindex_reporter(reporter_id):
+    """Drops every open item of a disconnected reporter from match_index. Caller must hold items_lock."""
+    for item in list(match_index_by_reporter.get(pack_id(reporter_id), {}).values()):
+        unindex_item(item)
+
+def match_candidates(new_item):
+    """
+    Returns [(score, item)] for an open or newly reported Item, best first: open items of the
+    opposite status at the same location, reported by someone else, whose match_score()
+    reaches MATCH_THRESHOLD. Whether their reporters are free to chat is left to the caller
+    (see available_candidates). Caller must hold items_lock.
+    Candidates come from match_index: each index term shared with the new item counts as a
+    hit, words before trigrams and rarest first, until MATCH_SCAN_BUDGET posting entries have
+    been counted (of a first term longer than that, only its newest entries); only the
+    MATCH_CANDIDATES items with the most hits are scored.
+    """
+    started = time.perf_counter()
+    opposite_status = "found" if new_item["status"] == "lost" else "lost"
+    postings = match_index.get((new_item["location"], opposite_status))
+    if not postings:
+        metric_observe('lostfound_match_seconds', time.perf_counter() - started)
+        return []
+    features = match_features(new_item)
+    # Whole words before trigrams (a word's trigrams mostly repeat what the word says),
+    # rarest first within each: they are the most telling and the cheapest to count
+    terms = [term for term in index_terms(features) if term in postings]
+    terms.sort(key=lambda term: (term[1] != ":", len(postings[term])))
+    hits = collections.Counter()
+    scanned = 0
+    for term in terms:
+        posting = postings[term]
+        if scanned + len(posting) > MATCH_SCAN_BUDGET:
+            if not hits: # Even the rarest term is too common: count only its newest entries
+                hits.update(itertools.islice(reversed(posting.keys()), MATCH_SCAN_BUDGET))
+            break
+        hits.update(posting.keys())
+        scanned += len(posting)
+    scored = []
+    for item_id, _ in hits.most_common(MATCH_CANDIDATES):
+        item, item_features = match_open_items[item_id][:2]
+        # Prevent self-matching
+        if item.reporter_id == new_item.reporter_id:
+            continue
+        score = match_score(features, item_features)
+        if score >= MATCH_THRESHOLD:
+            scored.append((score, item))
+    scored.sort(key=lambda entry: entry[0], reverse=True)
+    metric_observe('lostfound_match_seconds', time.perf_counter() - started)
+    return scored
+
+# Item operations: everything that reads or changes item_store and match_index. They take and
+# return plain data and never look at client state, so the server runs them in-process or, with
+# SHARDS, in the worker process that owns the item's location (see item_call).
+
+def items_report(item):
+    """Stores and indexes a newly reported item. Returns its match candidates."""
+    require_loaded()
+    with items_lock:
+        item = item_store.add(item)
+        index_open_item(item)
+        return match_candidates(item)
+
+def items_claim_pair(item1_id, reporter1_id, item2_id, reporter2_id):
+    """
+    Marks two items as matched with each other if both are still open and still reported
+    by the given reporters, so two chats can never claim one item. Returns the updated items
+    (empty if the claim failed).
+    """
+    require_loaded()
+    with items_lock:
+        if pack_id(item1_id) not in match_index_by_reporter.get(pack_id(reporter1_id), {}) or \
+           pack_id(item2_id) not in match_index_by_reporter.get(pack_id(reporter2_id), {}):
+            return []
+        claimed = []
+        matched_at = time.strftime("%Y-%m-%d %H:%M:%S") # What ARCHIVE_MATCHED_AGE counts from
+        for item_id, other_id in ((item1_id, item2_id), (item2_id, item1_id)):
+            item = item_store.update(item_id, {'status': 'matched', 'matched_with': other_id, 'matched_at': matched_at})
+            if item:
+                unindex_item(item)
+                claimed.append(item.to_dict())
+        return claimed
+
+def items_release_pair(item_statuses, reindex_ids):
+    """
+    Undoes items_claim_pair: each (item_id, status) of item_statuses still matched goes back
+    to status, unmatched. Those in reindex_ids (whose reporters are still connected) go back
+    into match_index. Returns the items put back.
+    """
+    require_loaded()
+    with items_lock:
+        released = []
+        for item_id, status in item_statuses:
+            item = item_store.get(item_id)
+            if item is None or item["status"] != 'matched':
+                continue
+            item = item_store.update(item_id, {'status': status, 'matched_with': None, 'matched_at': None})
+            if item_id in reindex_ids:
+                index_open_item(item)
+            released.append(item.to_dict())
+        return released
+
+def items_open_candidates(reporter_id):
+    """[(item, match candidates)] for each open item of reporter_id."""
+    with items_lock:
+        return [(item, match_candidates(item)) for item in list(match_index_by_reporter.get(pack_id(reporter_id), {}).values())]
+
+def items_of_reporter(reporter_id):
+    with items_lock:
+        return [item.to_dict() for item in item_store.items_by_reporter(reporter_id)]
+
+def items_rekey_reporter(old_reporter_id, new_reporter_id):
+    """Hands the items of old_reporter_id to new_reporter_id and indexes the open ones. Returns how many."""
+    require_loaded()
+    with items_lock:
+        moved = item_store.items_by_reporter(old_reporter_id)
+        for item in moved:
+            index_open_item(item_store.update(item["id"], {"reporter_id": new_reporter_id}))
+        return len(moved)
+
+def items_reporter_gone(reporter_id):
+    """
+    Drops a disconnected reporter's open items from match_index. Returns whether it has any
+    unresolved items (open, matched or claimed), which it can still RESUME to resolve.
+    """
+    with items_lock:
+        unindex_reporter(reporter_id)
+        return any(item["status"] != "resolved" for item in item_store.items_by_reporter(reporter_id))
+
+def items_page(cursor, limit):
+    """One page of item copies, see the stores' page()."""
+    with items_lock:
+        return item_store.page(cursor, limit)
+
+def items_claim(client_id, item_id):
+    """
+    CLAIM on the item store: None if item_id is not stored here, else (error, item) where
+    error is the reply for a refused claim.
+    """
+    require_loaded()
+    with items_lock:
+        item = item_store.get(item_id)
+        if item is None:
+            return None
+        partner = item_store.get(item["matched_with"]) if item.get("matched_with") else None
+        own_match = item["status"] == "matched" and partner is not None and partner.get("reporter_id") == client_id
+        if not own_match and (item["status"] != "found" or item.get("reporter_id") == client_id):
+            return f"ERROR Item {item_id} cannot be claimed (status: {item['status']}).\n", None
+        unindex_item(item)
+        return None, item_store.update(item_id, {"status": "claimed", "claimed_by": client_id,
+                                                 "claimed_at": time.strftime("%Y-%m-%d %H:%M:%S")}).to_dict()
+
+def items_resolve(client_id, item_id):
+    """
+    RESOLVE on the item store: None if item_id is not stored here, else (error, resolved
+    items). The item it was matched with (always stored alongside it) is resolved too.
+    """
+    require_loaded()
+    with items_lock:
+        item = item_store.get(item_id)
+        if item is None:
+            return None
+        if item.get("reporter_id") != client_id:
+            return "ERROR Item not found among your items.\n", []
+        if item["status"] == "resolved":
+            return f"ERROR Item {item_id} is already resolved.\n", []
+        resolved = [item_store.update(item_id, {"status": "resolved"})]
+        partner = item_store.get(item["matched_with"]) if item.get("matched_with") else None
+        if partner is not None and partner["status"] in ("matched", "claimed"):
+            resolved.append(item_store.update(partner["id"], {"status": "resolved"}))
+        for resolved_item in resolved:
+            unindex_item(resolved_item)
+        return None, [resolved_item.to_dict() for resolved_item in resolved]
+
+def items_withdraw(client_id, item_id):
+    """WITHDRAW on the item store: None if item_id is not stored here, else (error, withdrawn item)."""
+    require_loaded()
+    with items_lock:
+        item = item_store.get(item_id)
+        if item is None:
+            return None
+        if item.get("reporter_id") != client_id:
+            return "ERROR Item not found among your items.\n", None
+        if item["status"] not in ("lost", "found"):
+            return f"ERROR Item {item_id} is {item['status']} and cannot be withdrawn; RESOLVE it instead.\n", None
+        unindex_item(item)
+        withdrawn = item.to_dict()
+        item_store.remove(item_id)
+        return None, withdrawn
+
+def items_get_many(item_ids):
+    """Copies of the stored items among item_ids; ids stored elsewhere (or nowhere) are skipped."""
+    with items_lock:
+        return [item.to_dict() for item in map(item_store.get, item_ids) if item is not None]
+
+def items_archive_page(cursor, limit):
+    """One page of archived items, see SqliteItemStore.page()."""
+    with items_lock:
+        return archive_store.page(cursor, limit)
+
+def items_search(query):
+    """Copies of the items matching a parse_search() query, see the stores' search()."""
+    with items_lock:
+        return [item.to_dict() for item in item_store.search(query)]
+
+def items_stats():
+    """(items by status, open items in match_index), for metrics."""
+    with items_lock:
+        return (item_store.count_by_status() if item_store else {}), len(match_open_items)
+
+ITEM_OPERATIONS = {
+    'report': items_report, 'claim_pair': items_claim_pair, 'release_pair': items_release_pair,
+    'open_candidates': items_open_candidates, 'of_reporter': items_of_reporter, 'rekey_reporter': items_rekey_reporter,
+    'reporter_gone': items_reporter_gone, 'page': items_page, 'archive_page': items_archive_page,
+    'archive_batch': items_archive_batch, 'get_many': items_get_many,
+    'search': items_search, 'claim': items_claim,
+    'resolve': items_resolve, 'withdraw': items_withdraw, 'stats': items_stats,
+    'save': lambda: save_items(), 'metrics': metrics_snapshot,
+}
+
+def item_call(location, operation, *args):
+    """Runs an item operation on the shard that owns location (in-process without shards)."""
+    if shard_pool is None:
+        return ITEM_OPERATIONS[operation](*args)
+    return shard_pool[LOCATIONS.index(location) % len(shard_pool)].call(operation, args)
+
+def item_broadcast(operation, *args):
+    """Runs an item operation on every shard at once. Returns the results in shard order."""
+    if shard_pool is None:
+        return [ITEM_OPERATIONS[operation](*args)]
+    return ShardClient.broadcast(shard_pool, operation, args)
+
+def item_find(operation, *args):
+    """Runs an operation on an item id everywhere; returns the answer of the shard storing it, or None."""
+    for result in item_broadcast(operation, *args):
+        if result is not None:
+            return result
+    return None
+
+class ShardError(RuntimeError):
+    """A shard worker process stopped answering."""
+
+class ShardClient:
+    """
+    The server's end of the pipe to one shard worker. A request is (operation, args) and the
+    reply (True, result) or (False, exception), which call() raises again here. Requests to
+    one shard are serialized by lock; broadcast() sends to every shard before waiting for any.
+    """
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def _reply(self):
+        try:
+            return self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise ShardError(f"shard {self.index} stopped") from e
+
+    @staticmethod
+    def _result(reply):
+        ok, value = reply
+        if not ok:
+            raise value
+        return value
+
+    def call(self, operation, args):
+        with self.lock:
+            self.conn.send((operation, args))
+            return self._result(self._reply())
+
+    @staticmethod
+    def broadcast(shards, operation, args):
+        sent, replies = [], []
+        try:
+            for shard in shards: # Always in shard order, so concurrent broadcasts cannot deadlock
+                shard.lock.acquire()
+                sent.append(shard)
+                shard.conn.send((operation, args))
+            replies = [shard._reply() for shard in sent]
+        finally:
+            for shard in sent:
+                shard.lock.release()
+        return [ShardClient._result(reply) for reply in replies]
+
+def shard_path(path, index):
+    """items.json -> items.shard0.json"""
+    root, extension = os.path.splitext(path)
+    return f"{root}.shard{index}{extension}"
+
+def seed_shard(shard_locations, data_file, journal_file, sqlite_file, snapshot_file):
+    """
+    Fills a new shard's store with the items of shard_locations from the unsharded store,
+    so switching SHARDS on keeps existing items. Runs before the shard accepts changes.
+    """
+    if STORAGE_MODE == 'sqlite':
+        exists = os.path.exists(sqlite_file)
+    else:
+        exists = os.path.exists(data_file) or os.path.exists(snapshot_file) or \
+                 (STORAGE_MODE == 'journal' and os.path.exists(journal_file))
+    if not exists:
+        return
+    source = create_item_store(data_file, journal_file, sqlite_file, snapshot_file)
+    source.load()
+    seeded = 0
+    cursor = "0"
+    while cursor:
+        with items_lock:
+            page_items, cursor = source.page(cursor, ITEMS_PAGE_MAX)
+            for item in page_items:
+                if item.get("location") in shard_locations:
+                    item_store.add(item)
+                    seeded += 1
+    source.close()
+    log_event(INFO, 'SHARD', "Seeded shard from the unsharded store", count=seeded)
+
+def shard_worker(index, count, config, conn):
+    """
+    Entry point of shard worker process index (of count): loads the shard's own store and
+    answers item operations from the server over conn until asked to stop.
+    """
+    global DATA_FILE, JOURNAL_FILE, SQLITE_FILE, SNAPSHOT_FILE, ARCHIVE_FILE
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C reaches the whole process group; the server stops its shards
+    globals().update(config)
+    unsharded_files = (DATA_FILE, JOURNAL_FILE, SQLITE_FILE, SNAPSHOT_FILE)
+    DATA_FILE, JOURNAL_FILE, SQLITE_FILE, SNAPSHOT_FILE = (shard_path(path, index) for path in unsharded_files)
+    ARCHIVE_FILE = shard_path(ARCHIVE_FILE, index)
+    log_fields['shard'] = index
+    start_logging()
+    if LOCK_STATS:
+        install_lock_stats()
+    new_shard = not any(os.path.exists(path) for path in (DATA_FILE, JOURNAL_FILE, SQLITE_FILE, SNAPSHOT_FILE))
+    load_items((lambda: seed_shard(set(LOCATIONS[index::count]), *unsharded_files)) if new_shard else None)
+    if STORAGE_MODE == 'journal':
+        threading.Thread(target=compaction_worker, daemon=True).start()
+    log_event(INFO, 'SHARD', "Shard started", locations=LOCATIONS[index::count])
+
+    while True:
+        try:
+            operation, args = conn.recv()
+        except (EOFError, OSError):
+            break # The server process is gone
+        if operation == 'stop':
+            break
+        try:
+            reply = (True, ITEM_OPERATIONS[operation](*args))
+        except Exception as e:
+            log_event(ERROR, 'SHARD', "Item operation failed", operation=operation, error=e)
+            reply = (False, e)
+        try:
+            conn.send(reply)
+        except Exception as e: # e.g. an exception that does not pickle
+            conn.send((False, ShardError(f"{operation} failed: {e!r}")))
+
+    server_running.clear()
+    compact_requested.set()
+    save_items()
+    item_store.close()
+    with items_lock: # An archival pass may still be writing a batch
+        archive_store.close()
+    if LOCK_STATS:
+        for line in lock_stats_report():
+            log_event(INFO, 'LOCK STATS', line)
+    try:
+        conn.send((True, None)) # Saved; acknowledges 'stop'
+    except OSError:
+        pass
+    stop_logging()
+
+# Settings a shard worker takes over from the server (they may have been changed by flags)
+SHARD_SETTINGS = ('STORAGE_MODE', 'DATA_FILE', 'JOURNAL_FILE', 'SQLITE_FILE', 'SNAPSHOT_FILE', 'JOURNAL_FSYNC', 'LOCK_STATS',
+                  'ARCHIVE_FILE',
+                  'LOG_LEVEL', 'LOG_FORMAT')
+
+def start_shards():
+    """Starts SHARDS worker processes and waits until each has loaded its items."""
+    global shard_pool
+    context = multiprocessing.get_context('spawn') # Never fork: this process already runs threads
+    config = {name: globals()[name] for name in SHARD_SETTINGS}
+    shards = []
+    for index in range(SHARDS):
+        server_conn, shard_conn = context.Pipe()
+        process = context.Process(target=shard_worker, args=(index, SHARDS, config, shard_conn),
+                                  name=f"shard-{index}", daemon=True)
+        process.start()
+        shard_conn.close()
+        shards.append(ShardClient(index, process, server_conn))
+    ShardClient.broadcast(shards, 'stats', ()) # Answered once the shard is up (its items load in the background)
+    shard_pool = shards
+    log_event(INFO, 'SHARD', "Started shards", count=SHARDS)
+
+def stop_shards():
+    """Asks every shard to save and exit."""
+    for shard in shard_pool:
+        try:
+            shard.call('stop', ())
+        except (ShardError, OSError) as e:
+            log_event(ERROR, 'SHARD', "Shard did not stop cleanly", shard=shard.index, error=e)
+        shard.process.join(10)
+
+def available_candidates(candidates, limit=None):
+    """The first limit (default MATCH_TOP_K) of candidates whose reporter is still connected and not in a chat."""
+    limit = MATCH_TOP_K if limit is None else limit
+    available = []
+    with clients_lock:
+        for score, item in candidates:
+            reporter_info = client_connections.get(item.get("reporter_id"))
+            if reporter_info and reporter_info['mode'] == 'command':
+                available.append((score, item))
+                if len(available) >= limit:
+                    break
+    return available
 
-def load_items():
-    """Loads items from the JSON data file."""
-    global items
-    try:
-        with items_lock:
-            with open(DATA_FILE, 'r') as f:
-                items = json.load(f)
-            print(f"[SYSTEM] Loaded {len(items)} items from {DATA_FILE}")
-    except FileNotFoundError:
-        items = []
-        print(f"[SYSTEM] {DATA_FILE} not found. Starting with an empty item list.")
-    except json.JSONDecodeError:
-        items = []
-        print(f"[SYSTEM] Error decoding {DATA_FILE}. Starting with an empty item list.")
+def claim_match(item, candidates):
+    """
+    Starts a chat over the first of candidates ([(score, item)], best first) that can still
+    be claimed for item. Returns the (score, matched item) pair, or None if every claim failed.
+    """
+    for score, matched_item in candidates:
+        if start_chat_session(item, matched_item):
+            return score, matched_item
+    return None
 
-def save_items():
-    """Saves the current list of items to the JSON data file."""
-    with items_lock:
-        try:
-            with open(DATA_FILE, 'w') as f:
-                json.dump(items, f, indent=2)
-            # print(f"[SYSTEM] Saved {len(items)} items to {DATA_FILE}") # Can be too verbose
-        except IOError as e:
-            print(f"[SYSTEM] Error saving items to {DATA_FILE}: {e}")
+def request_rematch(reporter_id):
+    """Queues a reporter's open items for match_worker. Never blocks on items_lock or clients_lock."""
+    with match_queue_lock:
+        match_queue.append(reporter_id)
+    match_requested.set()
 
+def rematch_reporter(reporter_id):
+    """Tries the open items of reporter_id in turn until one of them starts a chat."""
+    for shard_candidates in item_broadcast('open_candidates', reporter_id):
+        for item, candidates in shard_candidates:
+            claimed = claim_match(item, available_candidates(candidates))
+            if claimed:
+                metric_inc('lostfound_matches_total', (('when', 'deferred'),))
+                log_event(INFO, 'MATCH', "Deferred item matched", item=item['id'], matched=claimed[1]['id'], score=round(claimed[0], 2))
+                return
 
-def find_match(new_item):
+def match_worker():
     """
-    Tries to find a match for a newly reported item.
-    A match occurs if name, color, and location are the same,
-    and one item is 'lost' and the other is 'found',
-    and neither item is already part of an active match/chat.
+    Background thread that retries matching for the reporters queued by request_rematch.
+    Items that could not be paired when reported (their best candidates were busy in a chat,
+    offline or claimed concurrently) are found again from the other side: when that reporter
+    becomes available, their own open items are re-matched here.
     """
-    with items_lock:
-        for item in items:
-            # Check if the item is already involved in an active chat or matched
-            is_item_reporter_in_chat = False
-            with clients_lock:
-                if item.get("reporter_id") and client_connections.get(item["reporter_id"], {}).get("mode") == "chat":
-                    is_item_reporter_in_chat = True
-            
-            if item.get("matched_with"): # If item already has a match_id
-                    continue
-            if is_item_reporter_in_chat: # If reporter of this item is already in chat
-                    continue
+    while server_running.is_set():
+        match_requested.wait()
+        match_requested.clear()
+        if not server_running.is_set():
+            break
+        while True:
+            with match_queue_lock:
+                batch = [match_queue.popleft() for _ in range(min(MATCH_RETRY_BATCH, len(match_queue)))]
+            if not batch:
+                break
+            for reporter_id in dict.fromkeys(batch): # Each reporter once per batch
+                try:
+                    rematch_reporter(reporter_id)
+                except Exception as e: # e.g. ShardError or ItemsLoading; the next request_rematch tries again
+                    if server_running.is_set():
+                        log_event(ERROR, 'MATCH', "Deferred matching failed", client=reporter_id, error=e)
 
-            # IMPORTANT FIX: Prevent self-matching
-            if item.get("reporter_id") == new_item.get("reporter_id"):
-                continue
+class OutboundQueue:
+    """
+    Bounded queue of encoded messages waiting to be written to one client.
+    Any thread may put() messages; a single writer (the client's writer thread in threaded
+    mode, the event loop otherwise) takes them with peek()/consume() and does the socket
+    I/O without holding any lock, so a slow receiver only ever stalls its own queue.
+    Entries are bytes, or iterators of bytes added with put_stream() that are pulled lazily
+    as the socket drains, so bulk listings are never queued in full.
+    """
+    def __init__(self, limit, policy):
+        self.limit = limit
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.entries = collections.deque()
+        self.size = 0 # Unwritten bytes queued (stream chunks count once pulled)
+        self.head_offset = 0 # Bytes of entries[0] already written
+        self.head_in_flight = False # entries[0] was handed to the writer by peek()
+        self.dropped_chats = 0 # Chat messages coalesced away since the last notice was written
+        self._notice = None # The queued coalescing notice, replaced on every overflow
+        self.closed = False
+        self.binary = False # Messages are framed (see protocol.py) once switch_to_binary() ran
 
-            if (item["name"].lower() == new_item["name"].lower() and
-                item["color"].lower() == new_item["color"].lower() and
-                item["location"] == new_item["location"] and
-                item["status"] != new_item["status"] and # One is lost, other is found
-                not item.get("matched_with")): # Ensure the existing item isn't already matched
+    def _encode(self, message):
+        """Encodes a text protocol message for the client's protocol. Caller holds lock."""
+        if self.binary:
+            return protocol.encode_text(message)
+        return (message if message.endswith('\n') else message + '\n').encode('utf-8')
 
-                # Check if the reporter of the existing item is still connected and not in chat
-                reporter_id_existing_item = item.get("reporter_id")
-                with clients_lock:
-                    if reporter_id_existing_item not in client_connections or \
-                       client_connections[reporter_id_existing_item]['mode'] == 'chat':
-                        continue # Reporter not connected or already in chat, skip this item
+    def _is_chat(self, data):
+        if self.binary:
+            return data[protocol.FRAME_HEADER.size - 1] == protocol.FRAME_CHAT
+        return data.startswith(b"CHAT_MSG")
 
-                return item # Return the matched item
-    return None
+    def put(self, data):
+        """Queues encoded data. Returns False when the overflow policy says to disconnect the client."""
+        with self.lock:
+            return self._put(data)
+
+    def put_message(self, message):
+        """Queues a text protocol message, encoded for the protocol in use when it is queued."""
+        with self.lock:
+            return self._put(self._encode(message))
+
+    def put_chat(self, sender_tag, text):
+        """Queues a relayed chat message."""
+        with self.lock:
+            if self.binary:
+                return self._put(protocol.encode_chat(sender_tag, text))
+            return self._put(f"CHAT_MSG [{sender_tag}]: {text}\n".encode('utf-8'))
+
+    def switch_to_binary(self, ack):
+        """Queues the text message ack and frames everything queued after it."""
+        with self.lock:
+            self._put(self._encode(ack))
+            self.binary = True
+
+    def _put(self, data):
+        if self.closed:
+            return True
+        if self.size + len(data) > self.limit:
+            action = self._overflow(data)
+            if action != 'queue':
+                return action == 'drop'
+        self.entries.append(data)
+        self.size += len(data)
+        self.changed.notify_all()
+        return True
+
+    def put_stream(self, chunks):
+        """Queues an iterator of bytes that is only pulled when everything before it is written."""
+        with self.lock:
+            if not self.closed:
+                self.entries.append(iter(chunks))
+                self.changed.notify_all()
+
+    def _overflow(self, data):
+        """Applies the overflow policy to data. Returns 'queue', 'drop' or 'disconnect'. Caller holds lock."""
+        if self.policy == 'drop':
+            return 'drop'
+        if self.policy != 'coalesce':
+            return 'disconnect'
+        # Chat relays are the bulk of unsolicited traffic: collapse the queued ones into a single notice
+        kept = collections.deque()
+        dropped = 0
+        notice_pending = False
+        for index, entry in enumerate(self.entries):
+            in_flight = index == 0 and self.head_in_flight
+            if entry is self._notice and not in_flight:
+                notice_pending = True
+                self.size -= len(entry)
+            elif isinstance(entry, bytes) and self._is_chat(entry) and not in_flight:
+                dropped += 1
+                self.size -= len(entry)
+            else:
+                kept.append(entry)
+        self.entries = kept
+        if not notice_pending: # The previous notice (if any) has been written already
+            self.dropped_chats = 0
+        self.dropped_chats += dropped
+        action = 'queue'
+        if self.size + len(data) > self.limit:
+            if not self._is_chat(data):
+                return 'disconnect'
+            self.dropped_chats += 1
+            action = 'drop'
+        if self.dropped_chats:
+            self._notice = self._encode(f"SYSTEM_MSG {self.dropped_chats} chat message(s) were dropped because your connection is too slow.\n")
+            self.entries.append(self._notice)
+            self.size += len(self._notice)
+        return action
+
+    def peek(self):
+        """Returns the next bytes to write (small messages are joined), or None if nothing is queued."""
+        with self.lock:
+            while self.entries and not isinstance(self.entries[0], bytes):
+                stream = self.entries[0]
+                # Streams read the item store, so pull them without holding this lock
+                self.lock.release()
+                failed = False
+                try:
+                    chunk = next(stream, None)
+                except Exception as e: # e.g. ShardError or sqlite3.Error: end this listing, not the connection
+                    log_event(ERROR, 'SYSTEM', "Could not stream a listing", error=e)
+                    failed = True
+                finally:
+                    self.lock.acquire()
+                if failed:
+                    self.entries.popleft()
+                    error = self._encode("ERROR Could not read the items; please try again.")
+                    self.entries.appendleft(error)
+                    self.size += len(error)
+                elif chunk is None:
+                    self.entries.popleft()
+                else:
+                    self.entries.appendleft(chunk)
+                    self.size += len(chunk)
+            if not self.entries:
+                return None
+            if not self.head_in_flight and len(self.entries) > 1 and isinstance(self.entries[1], bytes):
+                joined, total = [], 0
+                while self.entries and isinstance(self.entries[0], bytes) and total < WRITE_CHUNK_SIZE:
+                    entry = self.entries.popleft()
+                    joined.append(entry)
+                    total += len(entry)
+                self.entries.appendleft(b"".join(joined))
+            self.head_in_flight = True
+            return memoryview(self.entries[0])[self.head_offset:]
+
+    def consume(self, sent):
+        """Marks sent bytes of the chunk returned by peek() as written."""
+        with self.lock:
+            self.head_offset += sent
+            self.size -= sent
+            if self.head_offset >= len(self.entries[0]):
+                self.entries.popleft()
+                self.head_offset = 0
+                self.head_in_flight = False
+            if not self.entries:
+                self.changed.notify_all()
+
+    def wait_for_data(self):
+        """Blocks until there is something to write. Returns False once closed and drained."""
+        with self.lock:
+            while not self.entries and not self.closed:
+                self.changed.wait()
+            return bool(self.entries)
+
+    def wait_drained(self, timeout):
+        with self.lock:
+            return self.changed.wait_for(lambda: not self.entries, timeout)
+
+    def close(self):
+        """Stops accepting messages; the writer finishes what is already queued."""
+        with self.lock:
+            self.closed = True
+            self.changed.notify_all()
+
+def client_writer(client_id, conn, outbound):
+    """Writer thread of one client in threaded mode: drains its OutboundQueue into the socket."""
+    try:
+        while outbound.wait_for_data():
+            chunk = outbound.peek()
+            if chunk is not None:
+                conn.sendall(chunk)
+                outbound.consume(len(chunk))
+    except OSError as e:
+        log_event(ERROR, 'SYSTEM', "Could not send to client", client=client_id, error=e)
+        disconnect_client(client_id)
 
-def notify_client(client_id, message):
-    """Sends a message to a specific client."""
+def send_to_client(client_id, message):
+    """
+    Queues a message for a specific client. Never blocks on the socket, so it is safe to
+    call from any thread and with any lock held; the client's writer sends it.
+    Returns False if the client is gone or was disconnected by the overflow policy.
+    """
     # Don't acquire clients_lock here since it might already be held by the caller
     client_info = client_connections.get(client_id)
-    if client_info and client_info['conn']:
-        try:
-            # Ensure the message ends with a newline
-            if not message.endswith('\n'):
-                message += '\n'
-            client_info['conn'].sendall(message.encode('utf-8'))
-        except socket.error as e:
-            print(f"[SYSTEM] Error sending message to client {client_id}: {e}")
-            # Potentially handle disconnection here or in the main client loop
-
-def start_chat_session(client_id_1, client_id_2, item1_id, item2_id):
-    """Initiates a chat session between two clients."""
-    with clients_lock:
-        if client_id_1 not in client_connections or client_id_2 not in client_connections:
-            print("[SYSTEM] One or both clients for chat disconnected before chat could start.")
-            return
+    if not client_info or not client_info['conn']:
+        return False
+    if message.startswith("ERROR"):
+        metric_inc('lostfound_command_errors_total', (('command', getattr(dispatch_context, 'command', None) or 'NONE'),))
+    # The queue adds the newline (or binary framing) for the client's protocol
+    return queued_for_client(client_id, client_info['outbound'].put_message(message))
 
-        client_connections[client_id_1]['mode'] = 'chat'
-        client_connections[client_id_1]['chat_partner_id'] = client_id_2
-        client_connections[client_id_2]['mode'] = 'chat'
-        client_connections[client_id_2]['chat_partner_id'] = client_id_1
+def send_chat_to_client(client_id, sender_tag, text):
+    """Queues a relayed chat message: a CHAT_MSG line, or a chat frame for binary clients."""
+    client_info = client_connections.get(client_id)
+    if not client_info or not client_info['conn']:
+        return False
+    return queued_for_client(client_id, client_info['outbound'].put_chat(sender_tag, text))
 
-    with chat_partners_lock:
-        chat_partners[client_id_1] = client_id_2
-        chat_partners[client_id_2] = client_id_1
+def queued_for_client(client_id, queued):
+    """Disconnects the client if its queue overflowed, else wakes its writer. Returns queued."""
+    if not queued:
+        log_event(WARNING, 'SYSTEM', "Client is not reading fast enough; disconnecting", client=client_id, queue_limit=OUTBOUND_QUEUE_LIMIT)
+        disconnect_client(client_id)
+        return False
+    if event_loop:
+        event_loop.request_flush(client_id)
+    return True
 
-    # Mark items as matched
-    with items_lock:
-        for item in items:
-            if item["id"] == item1_id:
-                item["matched_with"] = item2_id
-                item["status"] = "matched"
-            elif item["id"] == item2_id:
-                item["matched_with"] = item1_id
-                item["status"] = "matched"
-    save_items()
+def stream_to_client(client_id, chunks):
+    """Queues an iterator of encoded chunks for a client; it is pulled only as the socket drains."""
+    client_info = client_connections.get(client_id)
+    if not client_info or not client_info['conn']:
+        return
+    client_info['outbound'].put_stream(chunks)
+    if event_loop:
+        event_loop.request_flush(client_id)
+
+def disconnect_client(client_id):
+    """Forces a client's connection closed from any thread; the usual cleanup runs when its reader notices."""
+    if event_loop:
+        event_loop.request_close(client_id)
+        return
+    client_info = client_connections.get(client_id)
+    if client_info:
+        try:
+            client_info['conn'].shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def start_chat_session(item1, item2):
+    """
+    Initiates a chat session between the reporters of two items stored at the same location.
+    Both clients are checked and reserved (match_reservations) under clients_lock, so no other
+    match can take them, and the items are then claimed (items_claim_pair) with the lock
+    released: with SHARDS that is a round trip to another process, otherwise a disk write.
+    If a client disconnected meanwhile, the claim is rolled back (items_release_pair).
+    Returns False if the match is no longer possible.
+    """
+    client_id_1, client_id_2 = item1["reporter_id"], item2["reporter_id"]
+    item1_id, item2_id, location = item1["id"], item2["id"], item1["location"]
+    pair = (client_id_1, client_id_2)
+    with clients_lock:
+        info_1 = client_connections.get(client_id_1)
+        info_2 = client_connections.get(client_id_2)
+        if not info_1 or not info_2:
+            log_event(INFO, 'SYSTEM', "A client disconnected before its chat could start", client1=client_id_1, client2=client_id_2)
+            return False
+        if info_1['mode'] != 'command' or info_2['mode'] != 'command' or not match_reservations.isdisjoint(pair):
+            log_event(INFO, 'SYSTEM', "Reporters were taken by another match", item1=item1_id, item2=item2_id)
+            return False
+        match_reservations.update(pair)
+    try:
+        claimed = item_call(location, 'claim_pair', item1_id, client_id_1, item2_id, client_id_2)
+    except BaseException:
+        with clients_lock:
+            match_reservations.difference_update(pair)
+        raise
+    with clients_lock:
+        match_reservations.difference_update(pair)
+        info_1 = client_connections.get(client_id_1)
+        info_2 = client_connections.get(client_id_2)
+        started = bool(claimed) and info_1 is not None and info_2 is not None
+        if started:
+            info_1['mode'] = 'chat'
+            info_1['chat_partner_id'] = client_id_2
+            info_2['mode'] = 'chat'
+            info_2['chat_partner_id'] = client_id_1
+            chat_partners[client_id_1] = client_id_2
+            chat_partners[client_id_2] = client_id_1
+    if not claimed:
+        log_event(INFO, 'SYSTEM', "Items were taken by another match", item1=item1_id, item2=item2_id)
+        return False
+    if not started:
+        log_event(INFO, 'SYSTEM', "A client disconnected while its chat was starting", client1=client_id_1, client2=client_id_2)
+        still_connected = [item["id"] for item, info in ((item1, info_1), (item2, info_2)) if info is not None]
+        released = item_call(location, 'release_pair', [(item1_id, item1["status"]), (item2_id, item2["status"])], still_connected)
+        publish_item_change(released, 'updated')
+        return False
 
     chat_instructions = "\n[CHAT] You are now connected for a chat. Type your message and press Enter.\n[CHAT] Type '/exit_chat' to end the chat and return to the main menu.\n"
-    notify_client(client_id_1, f"MATCH_FOUND You have been matched with another user regarding item ID {item2_id}!\n{chat_instructions}")
-    notify_client(client_id_2, f"MATCH_FOUND You have been matched with another user regarding item ID {item1_id}!\n{chat_instructions}")
-    print(f"[SYSTEM] Chat session started between {client_id_1} and {client_id_2} for items {item1_id} & {item2_id}")
+    send_to_client(client_id_1, f"MATCH_FOUND You have been matched with another user regarding item ID {item2_id}!\n{chat_instructions}")
+    send_to_client(client_id_2, f"MATCH_FOUND You have been matched with another user regarding item ID {item1_id}!\n{chat_instructions}")
+    publish_item_change(claimed, 'updated')
+    log_event(INFO, 'CHAT', "Chat session started", client1=client_id_1, client2=client_id_2, item1=item1_id, item2=item2_id)
+    return True
 
 def end_chat_session(client_id):
     """Ends a chat session for a client and their partner."""
-    print(f"[DEBUG] end_chat_session called for client {client_id}")
+    log_event(DEBUG, 'CHAT', "end_chat_session called", client=client_id)
     
     # Get partner_id first before modifying anything
     partner_id = None
@@ -151,16 +2441,16 @@ def end_chat_session(client_id):
     
     with clients_lock:
         if client_id not in client_connections:
-            print(f"[DEBUG] Client {client_id} not in client_connections")
+            log_event(DEBUG, 'CHAT', "Client not in client_connections", client=client_id)
             return
         
         client_info = client_connections[client_id]
         if client_info['mode'] != 'chat':
-            print(f"[DEBUG] Client {client_id} not in chat mode (mode: {client_info['mode']})")
+            log_event(DEBUG, 'CHAT', "Client not in chat mode", client=client_id, mode=client_info['mode'])
             return
         
         partner_id = client_info.get('chat_partner_id')
-        print(f"[DEBUG] Partner ID for {client_id}: {partner_id}")
+        log_event(DEBUG, 'CHAT', "Chat partner found", client=client_id, partner=partner_id)
         
         # Get connection objects while we have the lock
         client_conn = client_info['conn']
@@ -175,283 +2465,1135 @@ def end_chat_session(client_id):
             client_connections[partner_id]['mode'] = 'command'
             client_connections[partner_id]['chat_partner_id'] = None
 
-    # Remove from chat_partners
-    with chat_partners_lock:
-        if client_id in chat_partners:
-            del chat_partners[client_id]
-        if partner_id and partner_id in chat_partners:
-            del chat_partners[partner_id]
+        # Remove from chat_partners
+        chat_partners.pop(client_id, None)
+        if partner_id:
+            chat_partners.pop(partner_id, None)
 
     # Send notifications AFTER releasing the locks
-    try:
-        if client_conn:
-            message = "CHAT_ENDED You have left the chat. Returning to main menu.\n"
-            client_conn.sendall(message.encode('utf-8'))
-            print(f"[SYSTEM] Sent CHAT_ENDED to {client_id}. Mode set to command.")
-    except socket.error as e:
-        print(f"[SYSTEM] Error sending message to client {client_id}: {e}")
+    if client_conn:
+        send_to_client(client_id, "CHAT_ENDED You have left the chat. Returning to main menu.\n")
+        log_event(DEBUG, 'CHAT', "Sent CHAT_ENDED; mode set to command", client=client_id)
 
-    try:
-        if partner_conn and partner_id:
-            message = "CHAT_ENDED The other user has left the chat. Returning to main menu.\n"
-            partner_conn.sendall(message.encode('utf-8'))
-            print(f"[SYSTEM] Sent CHAT_ENDED to partner {partner_id}. Chat session ended between {client_id} and {partner_id}")
-    except socket.error as e:
-        print(f"[SYSTEM] Error sending message to partner {partner_id}: {e}")
+    if partner_conn and partner_id:
+        send_to_client(partner_id, "CHAT_ENDED The other user has left the chat. Returning to main menu.\n")
+        log_event(INFO, 'CHAT', "Chat session ended", client=client_id, partner=partner_id)
 
     if not partner_id:
-        print(f"[SYSTEM] Chat session ended for {client_id}. Partner was not found or already disconnected.")
+        log_event(INFO, 'CHAT', "Chat session ended; partner already gone", client=client_id)
     
-    print(f"[DEBUG] end_chat_session completed for {client_id}")
+    log_event(DEBUG, 'CHAT', "end_chat_session completed", client=client_id)
+    # Both users are available again; their other open items may have matches that were skipped
+    request_rematch(client_id)
+    if partner_id:
+        request_rematch(partner_id)
     # Items remain "matched" even after chat ends.
     # No need to change item status here unless a "claim" feature is added.
 
-def handle_client(conn, addr, client_id):
-    """Handles a single client connection."""
-    print(f"[NEW CONNECTION] {addr} connected as {client_id}.")
+def accepting_connections():
+    """Whether another connection fits under MAX_CONNECTIONS."""
+    with clients_lock:
+        return len(client_connections) < MAX_CONNECTIONS
+
+def refuse_connection(conn, addr):
+    """Turns away a connection accepted beyond MAX_CONNECTIONS, with a best-effort one-line reply."""
+    metric_inc('lostfound_connections_refused_total')
+    log_event(DEBUG, 'CONNECTION', "Too many connections; refusing", addr=addr, limit=MAX_CONNECTIONS)
+    try:
+        conn.setblocking(False)
+        conn.send(b"ERROR SERVER_BUSY Too many connections; please try again later.\n")
+    except OSError:
+        pass
+    conn.close()
+
+def register_client(conn, addr, client_id, **extra):
+    """Adds a freshly accepted connection to client_connections and greets it. Returns its entry."""
+    log_event(INFO, 'NEW CONNECTION', "Client connected", client=client_id, addr=addr)
+    # Writes are already batched by OutboundQueue; Nagle would only hold back the tail of a
+    # streamed listing until the client's delayed ACK (~40 ms)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client_info = {'conn': conn, 'addr': addr, 'mode': 'command', 'chat_partner_id': None,
+                   'outbound': OutboundQueue(OUTBOUND_QUEUE_LIMIT, OUTBOUND_OVERFLOW_POLICY),
+                   'resume_token': uuid.uuid4().hex, 'reader': protocol.StreamDecoder(MAX_FRAME_SIZE),
+                   'rate_buckets': {}, 'last_received': time.monotonic(), 'last_command': time.monotonic(),
+                   'pinged': False, 'heartbeats': False, **extra}
     with clients_lock:
-        client_connections[client_id] = {'conn': conn, 'addr': addr, 'mode': 'command', 'chat_partner_id': None}
+        client_connections[client_id] = client_info
+        resume_tokens[client_info['resume_token']] = client_id
+    send_to_client(client_id, "WELCOME Welcome to the Lost & Found Service!\n")
+    send_to_client(client_id, f"LOCATIONS {json.dumps(LOCATIONS)}\n") # Send locations once
+    send_to_client(client_id, f"SESSION {client_info['resume_token']}\n")
+    capabilities = f"binary zlib heartbeat={HEARTBEAT_INTERVAL}" if HEARTBEAT_INTERVAL else "binary zlib"
+    send_to_client(client_id, f"CAPABILITIES {capabilities}\n") # See protocol.py
+    return client_info
+
+class TokenBucket:
+    """Refills at rate tokens per second up to burst; every command takes one token. Not locked."""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.updated = time.monotonic()
 
+    def take(self, now):
+        """Takes a token. Returns 0 if there was one, else the seconds until there will be."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def give_back(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+# Command class of each rate-limited command (as labelled by process_message). Reports
+# persist and match, listings copy many items, item commands change one; anything
+# else (PROTOCOL, COMPRESS, unknown commands) is cheap and not limited.
+COMMAND_RATE_CLASSES = {"REPORT_LOST": 'report', "REPORT_FOUND": 'report', "GET_ALL_ITEMS": 'list',
+                        "GET_ITEMS": 'list', "GET_CHANGES_SINCE": 'list', "GET_ARCHIVED": 'list', "GET_MY_ITEMS": 'list',
+                        "SEARCH": 'list', "RESUME": 'item', "WATCH": 'item', "UNWATCH": 'item',
+                        "CLAIM": 'item', "RESOLVE": 'item', "WITHDRAW": 'item', "CHAT": 'chat'}
+
+def rate_limited(client_info, command):
+    """
+    Takes a token for command from the client's bucket and then the global one. Returns 0 if
+    the command may run, else the seconds to wait (nothing is taken from either bucket then).
+    """
+    rate_class = COMMAND_RATE_CLASSES.get(command)
+    if rate_class is None:
+        return 0
+    now = time.monotonic()
+    bucket = None
+    if rate_class in RATE_LIMITS:
+        bucket = client_info['rate_buckets'].get(rate_class)
+        if bucket is None:
+            bucket = client_info['rate_buckets'][rate_class] = TokenBucket(*RATE_LIMITS[rate_class])
+        retry_after = bucket.take(now)
+        if retry_after:
+            metric_inc('lostfound_rate_limited_total', (('class', rate_class), ('limit', 'client')))
+            return retry_after
+    if rate_class in GLOBAL_RATE_LIMITS:
+        with rate_limit_lock:
+            global_bucket = global_rate_buckets.get(rate_class)
+            if global_bucket is None:
+                global_bucket = global_rate_buckets[rate_class] = TokenBucket(*GLOBAL_RATE_LIMITS[rate_class])
+            retry_after = global_bucket.take(now)
+        if retry_after:
+            if bucket is not None:
+                bucket.give_back()
+            metric_inc('lostfound_rate_limited_total', (('class', rate_class), ('limit', 'global')))
+            return retry_after
+    return 0
+
+def process_data(client_id, reader, data):
+    """
+    Feeds received bytes through the client's protocol.StreamDecoder and dispatches every
+    complete line (or binary frame) in order, so pipelined commands are each handled on
+    their own. Shared by the threaded handler and the event loop.
+    """
+    client_info = client_connections.get(client_id)
+    if client_info: # Any traffic shows the client is alive (see heartbeat_worker)
+        client_info['last_received'] = time.monotonic()
+        client_info['pinged'] = False
+    reader.feed(data)
+    for frame_type, payload in reader.messages():
+        if frame_type is None:
+            send_to_client(client_id, f"ERROR Message too long (limit is {MAX_FRAME_SIZE} bytes).\n")
+            continue
+        try:
+            if frame_type == protocol.FRAME_CHAT:
+                text = protocol.decode_chat(payload)[1]
+                started = time.perf_counter()
+                dispatch_context.command = 'CHAT'
+                if client_info:
+                    client_info['last_command'] = time.monotonic() # Chatting is activity for IDLE_TIMEOUT
+                if not refuse_if_rate_limited(client_id, 'CHAT'):
+                    relay_chat(client_id, text)
+                record_command(started)
+                continue
+            if frame_type != protocol.FRAME_TEXT:
+                send_to_client(client_id, f"ERROR Unknown frame type {frame_type}.\n")
+                continue
+            message = payload.decode('utf-8')
+        except (UnicodeDecodeError, protocol.ProtocolError):
+            log_event(WARNING, 'PROTOCOL', "Client sent non-UTF-8 data", client=client_id)
+            send_to_client(client_id, "ERROR Invalid data encoding. Please use UTF-8.\n")
+            continue
+        if message.strip():
+            started = time.perf_counter()
+            try:
+                process_message(client_id, message)
+            except ItemsLoading:
+                send_to_client(client_id, "ERROR Items are still loading after a restart; please try again shortly.\n")
+            record_command(started)
+
+def refuse_if_rate_limited(client_id, command):
+    """Replies ERROR RATE_LIMITED retry_after=<seconds> and returns True if command is over its limit."""
+    client_info = client_connections.get(client_id)
+    retry_after = rate_limited(client_info, command) if client_info else 0
+    if retry_after:
+        send_to_client(client_id, f"ERROR RATE_LIMITED retry_after={retry_after:.2f}\n")
+    return bool(retry_after)
+
+def format_item_summary(item):
+    """One ITEM: line of an item listing."""
+    return (
+        f"ITEM: Type: {item['status'].capitalize()}, "
+        f"Name: {item['name']}, "
+        f"Color: {item['color']}, "
+        f"Location: {item['location']}, "
+        f"Description: {item['description']}, "
+        f"Reported: {item['timestamp']}, "
+        f"Matched: {'Yes' if item.get('matched_with') else 'No'}\n"
+    )
+
+def read_items_page(cursor, limit, operation='page'):
+    """
+    Copies one page of items out of the store. items_lock is held only for the copy,
+    never while formatting or sending.
+    With shards the cursor is "<shard>.<cursor within the shard>" and pages run through
+    the shards in turn, filled up from the next shard where one runs out.
+    """
+    if shard_pool is None:
+        return ITEM_OPERATIONS[operation](cursor, limit)
+    shard_index, _, shard_cursor = cursor.partition('.')
+    shard_index = int(shard_index)
+    if not 0 <= shard_index < len(shard_pool):
+        raise ValueError("bad shard in cursor")
+    page_items = []
+    shard_cursor = shard_cursor or "0"
+    while True:
+        shard_items, shard_next = shard_pool[shard_index].call(operation, (shard_cursor, limit - len(page_items)))
+        page_items += shard_items
+        if shard_next:
+            return page_items, f"{shard_index}.{shard_next}"
+        shard_index += 1
+        shard_cursor = "0"
+        if shard_index == len(shard_pool):
+            return page_items, None
+        if len(page_items) >= limit:
+            return page_items, f"{shard_index}.0"
+
+def client_is_binary(client_id):
+    """Whether the client negotiated the binary protocol. Only reliable on the client's own reader."""
+    client_info = client_connections.get(client_id)
+    return bool(client_info) and client_info['outbound'].binary
+
+def stream_bulk_to_client(client_id, chunks):
+    """
+    Queues the encoded frames of a bulk response (a listing) as a stream, deflated for
+    clients that enabled compression once it reaches COMPRESS_MIN_BYTES.
+    """
+    client_info = client_connections.get(client_id)
+    if client_info and client_info.get('compress'):
+        chunks = protocol.deflate_frames(chunks, COMPRESS_MIN_BYTES, COMPRESS_LEVEL)
+    stream_to_client(client_id, chunks)
+
+def send_items_page(client_id, args, operation='page', reply='ITEMS_PAGE'):
+    """
+    GET_ITEMS [cursor] [limit]: sends one page as a single write:
+    ITEMS_PAGE <count> <next_cursor|END>, the ITEM: lines, then ITEMS_PAGE_END.
+    GET_ARCHIVED [cursor] [limit] pages through the archive the same way ('archive_page'),
+    answered with ARCHIVED_PAGE and ARCHIVED_PAGE_END.
+    """
+    cursor = args[0] if args else "0"
+    try:
+        limit = int(args[1]) if len(args) > 1 else ITEMS_PAGE_SIZE
+        if limit <= 0:
+            raise ValueError
+    except ValueError:
+        send_to_client(client_id, "ERROR Invalid page limit.\n")
+        return
+    try:
+        page_items, next_cursor = read_items_page(cursor, min(limit, ITEMS_PAGE_MAX), operation)
+    except ValueError:
+        send_to_client(client_id, "ERROR Invalid cursor.\n")
+        return
+    header = f"{reply} {len(page_items)} {next_cursor or 'END'}\n"
+    if client_is_binary(client_id):
+        stream_bulk_to_client(client_id, [protocol.encode_text(header), protocol.encode_items(page_items),
+                                          protocol.encode_text(f"{reply}_END")])
+        return
+    lines = [header]
+    lines.extend(format_item_summary(item) for item in page_items)
+    lines.append(f"{reply}_END\n")
+    send_to_client(client_id, "".join(lines))
+
+def send_search_results(client_id, filter_text):
+    """
+    SEARCH <json filter>: SEARCH_RESULTS <count>, an ITEM: line per match, then SEARCH_END.
+    With shards every shard answers for its own items and the sorted answers are merged.
+    The reply is streamed in chunks of SEARCH_BATCH items as the client reads it.
+    """
+    try:
+        query = parse_search(filter_text)
+    except ValueError as e:
+        send_to_client(client_id, f"ERROR Invalid search: {e}.\n")
+        return
+    shard_results = item_broadcast('search', query)
+    if len(shard_results) == 1:
+        results = shard_results[0]
+    else:
+        key, reverse = search_sort_key(query['sort'])
+        results = list(itertools.islice(heapq.merge(*shard_results, key=key, reverse=reverse), query['limit']))
+    binary = client_is_binary(client_id)
+    encode_text = protocol.encode_text if binary else lambda message: message.encode('utf-8')
+    def search_chunks():
+        yield encode_text(f"SEARCH_RESULTS {len(results)}\n")
+        for start in range(0, len(results), SEARCH_BATCH):
+            batch = results[start:start + SEARCH_BATCH]
+            if binary:
+                yield protocol.encode_items(batch)
+            else:
+                yield "".join(format_item_summary(item) for item in batch).encode('utf-8')
+        yield encode_text("SEARCH_END\n")
+    if binary:
+        stream_bulk_to_client(client_id, search_chunks())
+    else:
+        stream_to_client(client_id, search_chunks())
+
+def public_item(item):
+    """The fields of an item dict that any client may see (no reporter or claimant ids)."""
+    return {'id': item['id'], 'status': item['status'], 'matched': bool(item.get('matched_with')), 'name': item['name'],
+            'color': item['color'], 'location': item['location'], 'description': item.get('description', ""),
+            'timestamp': item['timestamp']}
+
+def watch_keys(query):
+    """
+    The watch_index keys a WATCH query is filed under: one 3-character piece of its name
+    pattern if it has one, else its locations, else its statuses, else ('any',). Every item
+    the query matches produces one of these keys in item_watch_keys, so nothing is missed,
+    and the most selective field decides which changes even look at the watch.
+    """
+    if len(query['name']) >= 3:
+        return [('name', query['name'][:3])]
+    if query['location']:
+        return [('location', location) for location in query['location']]
+    if query['status']:
+        return [('status', status) for status in query['status']]
+    return [('any',)]
+
+def item_watch_keys(item):
+    """The watch_index keys that can hold watches matching item."""
+    name = (item['name'] or "").lower()
+    keys = {('name', name[i:i + 3]) for i in range(len(name) - 2)}
+    keys.update((('any',), ('location', item['location']), ('status', item['status'])))
+    return keys
+
+def add_watch(client_id, filter_text):
+    """
+    WATCH <json filter>: subscribes to changes of items matching the filter, a SEARCH filter
+    limited to "location", "status", "name" and "color". Replies WATCHING <watch_id>; matching
+    changes then arrive as WATCH_EVENT lines (see publish_item_change).
+    """
+    try:
+        query = parse_search(filter_text)
+        if filter_text.strip() and json.loads(filter_text).keys() & {'from', 'to', 'sort', 'limit'}:
+            raise ValueError("only location, status, name and color can be watched")
+    except ValueError as e:
+        send_to_client(client_id, f"ERROR Invalid watch: {e}.\n")
+        return
+    keys = watch_keys(query)
+    with watch_lock:
+        client_watches = watches_by_client.setdefault(client_id, {})
+        if len(client_watches) >= MAX_WATCHES_PER_CLIENT:
+            watch_id = None
+        else:
+            watch_id = str(next(watch_ids))
+            client_watches[watch_id] = (query, keys)
+            for key in keys:
+                watch_index[key][(client_id, watch_id)] = query
+    if watch_id is None:
+        send_to_client(client_id, f"ERROR Too many watches (limit is {MAX_WATCHES_PER_CLIENT}); UNWATCH one first.\n")
+        return
+    send_to_client(client_id, f"WATCHING {watch_id}\n")
+
+def drop_watches(client_id, watch_ids_to_drop=None):
+    """Removes the given watches of client_id (all of them if None). Returns the ids removed."""
+    with watch_lock:
+        client_watches = watches_by_client.get(client_id, {})
+        dropped = [watch_id for watch_id in (client_watches if watch_ids_to_drop is None else watch_ids_to_drop)
+                   if watch_id in client_watches]
+        for watch_id in dropped:
+            for key in client_watches.pop(watch_id)[1]:
+                watchers = watch_index[key]
+                watchers.pop((client_id, watch_id), None)
+                if not watchers:
+                    del watch_index[key]
+        if not client_watches:
+            watches_by_client.pop(client_id, None)
+    return dropped
+
+def remove_watch(client_id, watch_id):
+    """UNWATCH <watch_id>: cancels one of the client's watches."""
+    if drop_watches(client_id, [watch_id]):
+        send_to_client(client_id, f"UNWATCHED {watch_id}\n")
+    else:
+        send_to_client(client_id, f"ERROR No watch {watch_id}.\n")
+
+def publish_item_change(items, change, origin=None):
+    """
+    Records a change of items (item dicts as returned by the item operations) in the change
+    feed, and pushes WATCH_EVENT <watch_id> <change> <item json> to every watch matching one
+    of them, for change 'reported', 'updated' or 'removed'. The client whose command made the
+    change (origin) already has its reply and is skipped. Runs in the main process, so it
+    sees the changes of every shard.
+    """
+    global change_seq, change_feed_start
+    with change_feed_lock:
+        for item in items:
+            change_seq += 1
+            change_feed.append((change_seq, item['id']))
+        while len(change_feed) > CHANGE_FEED_SIZE:
+            change_feed_start = change_feed.popleft()[0]
+    with watch_lock:
+        if not watch_index:
+            return
+        events = []
+        for item in items:
+            record = None
+            for key in item_watch_keys(item):
+                for (client_id, watch_id), query in watch_index.get(key, {}).items():
+                    if client_id == origin:
+                        continue
+                    if record is None:
+                        record = Item(item)
+                    if search_matches(record, query):
+                        events.append((client_id, watch_id, item['id']))
+    payloads = {item['id']: json.dumps(public_item(item)) for item in items} if events else None
+    for client_id, watch_id, item_id in events:
+        send_to_client(client_id, f"WATCH_EVENT {watch_id} {change} {payloads[item_id]}\n")
+    if events:
+        metric_inc('lostfound_watch_events_total', (('change', change),), len(events))
+
+def changed_since(since):
+    """
+    (latest sequence number, ids of the items changed after since, each once, in change
+    order), or (latest sequence number, None) when the feed no longer reaches back to since.
+    """
+    with change_feed_lock:
+        if not change_feed_start <= since <= change_seq:
+            return change_seq, None
+        item_ids = []
+        for seq, item_id in reversed(change_feed):
+            if seq <= since:
+                break
+            item_ids.append(item_id)
+    return change_seq, list(dict.fromkeys(reversed(item_ids)))
+
+def send_changes(client_id, since):
+    """
+    GET_CHANGES_SINCE <seq>: CHANGES <new seq> delta, then the current state of every item
+    changed after seq (CHANGED <item json> lines, FRAME_ITEMS for binary clients) and
+    REMOVED <id>... lines for those no longer stored, then CHANGES_END. A client whose seq
+    is older than the feed (or 0) gets CHANGES <new seq> full and every stored item instead.
+    Items are read as the reply is streamed, after new seq was taken, so a change that
+    slips in between is sent now and again in the next delta, never lost.
+    """
     try:
-        conn.sendall("WELCOME Welcome to the Lost & Found Service!\n".encode('utf-8'))
-        conn.sendall(f"LOCATIONS {json.dumps(LOCATIONS)}\n".encode('utf-8')) # Send locations once
+        since = int(since)
+    except ValueError:
+        send_to_client(client_id, "ERROR Invalid sequence number.\n")
+        return
+    seq, item_ids = changed_since(since)
+    metric_inc('lostfound_change_syncs_total', (('kind', 'full' if item_ids is None else 'delta'),))
+    binary = client_is_binary(client_id)
+    encode_text = protocol.encode_text if binary else lambda message: message.encode('utf-8')
+    def encode_changed(changed_items):
+        if binary:
+            return protocol.encode_items(changed_items)
+        return "".join(f"CHANGED {json.dumps(public_item(item))}\n" for item in changed_items).encode('utf-8')
+    def change_chunks():
+        if item_ids is None:
+            yield encode_text(f"CHANGES {seq} full\n")
+            cursor = "0"
+            while cursor:
+                page_items, cursor = read_items_page(cursor, ITEMS_PAGE_MAX)
+                if page_items:
+                    yield encode_changed(page_items)
+        else:
+            yield encode_text(f"CHANGES {seq} delta\n")
+            for start in range(0, len(item_ids), CHANGES_BATCH):
+                batch = item_ids[start:start + CHANGES_BATCH]
+                changed_items = [item for shard_items in item_broadcast('get_many', batch) for item in shard_items]
+                if changed_items:
+                    yield encode_changed(changed_items)
+                removed = set(batch).difference(item['id'] for item in changed_items)
+                if removed:
+                    yield encode_text(f"REMOVED {' '.join(item_id for item_id in batch if item_id in removed)}\n")
+        yield encode_text("CHANGES_END\n")
+    if binary:
+        stream_bulk_to_client(client_id, change_chunks())
+    else:
+        stream_to_client(client_id, change_chunks())
+
+def send_all_items(client_id):
+    """
+    GET_ALL_ITEMS, built on the paginated reader. The listing is queued as a stream, so each
+    page is copied under the lock, formatted and written only once the client has taken the
+    previous one.
+    """
+    binary = client_is_binary(client_id)
+    encode_text = protocol.encode_text if binary else lambda message: message.encode('utf-8')
+    def all_items_chunks():
+        yield encode_text("ALL_ITEMS_START\n")
+        cursor = "0"
+        sent_any = False
+        while cursor:
+            page_items, cursor = read_items_page(cursor, ITEMS_PAGE_MAX)
+            if page_items:
+                if binary:
+                    yield protocol.encode_items(page_items)
+                else:
+                    yield "".join(format_item_summary(item) for item in page_items).encode('utf-8')
+                sent_any = True
+        if not sent_any:
+            yield encode_text("ITEM: No items reported yet.\n")
+        yield encode_text("ALL_ITEMS_END\n")
+    if binary:
+        stream_bulk_to_client(client_id, all_items_chunks())
+    else:
+        stream_to_client(client_id, all_items_chunks())
+
+def expire_resume_tokens():
+    """Forgets the tokens of connections closed more than RESUME_TOKEN_TTL ago. Call with clients_lock held."""
+    if not RESUME_TOKEN_TTL:
+        return
+    closed_before = time.monotonic() - RESUME_TOKEN_TTL
+    while resume_tokens_left:
+        token, closed = next(iter(resume_tokens_left.items()))
+        if closed >= closed_before:
+            break
+        del resume_tokens_left[token]
+        resume_tokens.pop(token, None)
+
+def resume_session(client_id, token):
+    """
+    RESUME <token>: makes client_id the reporter of every item reported by the earlier
+    connection that was given token in SESSION, and re-matches its open items.
+    """
+    with clients_lock:
+        expire_resume_tokens()
+        old_client_id = resume_tokens.get(token)
+        if old_client_id == client_id:
+            send_to_client(client_id, "INFO This session is already active.\n")
+            return
+        if old_client_id is None:
+            send_to_client(client_id, "INFO Previous session has expired; continuing with a new one.\n")
+            return
+        if old_client_id in client_connections:
+            send_to_client(client_id, "ERROR That session is still connected.\n")
+            return
+        # The token now belongs to this connection, in place of the one it was given, so
+        # nobody else can resume old_client_id while its items are handed over
+        client_info = client_connections[client_id]
+        resume_tokens.pop(client_info['resume_token'], None)
+        resume_tokens_left.pop(token, None)
+        client_info['resume_token'] = token
+        resume_tokens[token] = client_id
+    resumed = sum(item_broadcast('rekey_reporter', old_client_id, client_id))
+    log_event(INFO, 'SESSION', "Session resumed", client=client_id, previous=old_client_id, items=resumed)
+    send_to_client(client_id, f"SUCCESS Session resumed; {resumed} item(s) restored.\n")
+    send_to_client(client_id, f"SESSION {token}\n") # Replaces the token sent on connect
+    request_rematch(client_id)
+
+def claim_item(client_id, item_id):
+    """
+    CLAIM <item_id>: the owner of a found item claims it. Works on an open found item reported
+    by someone else, or on the item the client's own report was matched with.
+    """
+    result = item_find('claim', client_id, item_id)
+    if result is None:
+        send_to_client(client_id, "ERROR Item not found.\n")
+        return
+    error, item = result
+    if error:
+        send_to_client(client_id, error)
+        return
+    log_event(INFO, 'ITEM CLAIMED', "Item claimed", client=client_id, item=item_id)
+    send_to_client(client_id, f"SUCCESS Item {item_id} claimed. Arrange the handover with the finder.\n")
+    send_to_client(item["reporter_id"], f"INFO Your found item '{item['name']}' (ID: {item_id}) has been claimed by its owner.\n")
+    publish_item_change([item], 'updated', client_id)
+
+def resolve_item(client_id, item_id):
+    """
+    RESOLVE <item_id>: the reporter closes an item that is back with its owner.
+    The item it was matched with, if any, is resolved too.
+    """
+    error, resolved = item_find('resolve', client_id, item_id) or ("ERROR Item not found among your items.\n", [])
+    if error:
+        send_to_client(client_id, error)
+        return
+    log_event(INFO, 'ITEM RESOLVED', "Items resolved", client=client_id, items=[resolved_item['id'] for resolved_item in resolved])
+    send_to_client(client_id, f"SUCCESS Item {item_id} resolved.\n")
+    for resolved_item in resolved[1:]:
+        send_to_client(resolved_item["reporter_id"], f"INFO Your item '{resolved_item['name']}' (ID: {resolved_item['id']}) has been marked resolved.\n")
+    publish_item_change(resolved, 'updated', client_id)
+
+def withdraw_item(client_id, item_id):
+    """WITHDRAW <item_id>: the reporter deletes an open (unmatched) report."""
+    error, withdrawn = item_find('withdraw', client_id, item_id) or ("ERROR Item not found among your items.\n", None)
+    if error:
+        send_to_client(client_id, error)
+        return
+    log_event(INFO, 'ITEM WITHDRAWN', "Item withdrawn", client=client_id, item=item_id)
+    send_to_client(client_id, f"SUCCESS Item {item_id} withdrawn.\n")
+    publish_item_change([withdrawn], 'removed', client_id)
+
+def switch_to_binary(client_id):
+    """
+    PROTOCOL binary: everything the client sends after this line, and everything queued
+    for it after the "PROTOCOL binary" answer, is framed as described in protocol.py.
+    """
+    with clients_lock:
+        client_info = client_connections.get(client_id)
+        if not client_info or client_info['reader'].binary:
+            return
+        client_info['reader'].switch_to_binary()
+        client_info['outbound'].switch_to_binary("PROTOCOL binary\n")
+    if event_loop:
+        event_loop.request_flush(client_id)
+    log_event(INFO, 'PROTOCOL', "Client switched to the binary protocol", client=client_id)
+
+def enable_compression(client_id):
+    """COMPRESS zlib: bulk responses to this (binary) client are deflated from now on."""
+    if not client_is_binary(client_id):
+        send_to_client(client_id, "ERROR Compression needs the binary protocol (PROTOCOL binary).\n")
+        return
+    client_connections[client_id]['compress'] = True # Only read by this client's own reader
+    send_to_client(client_id, "COMPRESS zlib\n")
+
+ITEM_COMMANDS = {"CLAIM": claim_item, "RESOLVE": resolve_item, "WITHDRAW": withdraw_item}
+# Command names as counted in metrics; anything else is counted as OTHER
+COMMANDS = {"REPORT_LOST", "REPORT_FOUND", "GET_MY_ITEMS", "GET_ALL_ITEMS", "GET_ITEMS", "GET_ARCHIVED", "SEARCH", "RESUME",
+            "WATCH", "UNWATCH",
+            "GET_CHANGES_SINCE", "PROTOCOL", "COMPRESS", "PING", "PONG", "CHAT", *ITEM_COMMANDS}
+
+def process_message(client_id, raw_message):
+    """
+    Handles one command (or chat line) received from a client.
+    Replies go through send_to_client, so both server modes speak exactly the same protocol.
+    """
+    with clients_lock: # Check client mode safely
+        current_mode = client_connections.get(client_id, {}).get('mode', 'command')
+        partner_id = client_connections.get(client_id, {}).get('chat_partner_id')
+        heartbeats = client_connections.get(client_id, {}).get('heartbeats', False)
+
+    message = raw_message.strip()
+    command = message.split(' ', 1)[0].upper() if current_mode == 'command' else 'CHAT'
+    dispatch_context.command = command if command in COMMANDS else 'OTHER' # Bounded label set for metrics
+    if log_threshold <= DEBUG:
+        log_received(client_id, current_mode, command, message)
+    # Heartbeats: any PING/PONG in command mode, which also opts the client into them (see
+    # heartbeat_worker); in a chat only an exact PING/PONG from such a client, else it is chat text
+    if message.upper() in ("PING", "PONG") and (current_mode == 'command' or (heartbeats and message in ("PING", "PONG"))):
+        if not heartbeats:
+            client_connections.get(client_id, {})['heartbeats'] = True # Only this client's own reader writes it
+        dispatch_context.command = message.upper()
+        if message.upper() == "PING":
+            send_to_client(client_id, "PONG\n")
+        return
+    client_connections.get(client_id, {})['last_command'] = time.monotonic()
+    if refuse_if_rate_limited(client_id, dispatch_context.command):
+        return
+
+    if current_mode == 'command':
+        if message.startswith("REPORT_"):
+            parts = message.split(" ", 1)
+            command = parts[0]
+            
+            if len(parts) < 2 or not parts[1]:
+                send_to_client(client_id, "ERROR Invalid report command. Missing item data.\n")
+                return
+            
+            item_json_str = parts[1]
+            try:
+                item_data = json.loads(item_json_str)
+                item_data["id"] = str(uuid.uuid4()) # Generate unique ID for the item
+                item_data["reporter_id"] = client_id
+                item_data["timestamp"] = time.strftime("%Y-%m-%d %H:%M:%S")
+                item_data["matched_with"] = None # Initialize matched_with field
+
+                if command == "REPORT_LOST":
+                    item_data["status"] = "lost"
+                elif command == "REPORT_FOUND":
+                    item_data["status"] = "found"
+                else:
+                    send_to_client(client_id, "ERROR Invalid report type.\n")
+                    return
+                
+                # Validate essential fields
+                if not all(k in item_data for k in ("name", "color", "location", "description")):
+                    send_to_client(client_id, "ERROR Missing item details (name, color, location, description).\n")
+                    return
+                if not all(isinstance(item_data[k], str) for k in ("name", "color", "location", "description")):
+                    send_to_client(client_id, "ERROR Item details (name, color, location, description) must be text.\n")
+                    return
+                if item_data["location"] not in LOCATIONS:
+                    send_to_client(client_id, f"ERROR Invalid location. Please choose from: {', '.join(LOCATIONS)}\n")
+                    return
+
+
+                # Stored, indexed and scored on the shard that owns the location
+                all_candidates = item_call(item_data["location"], 'report', item_data)
+                send_to_client(client_id, f"SUCCESS Item {item_data['id']} reported successfully.\n")
+                publish_item_change([item_data], 'reported', client_id)
+                # FIX: Changed item['status'] to item_data['status']
+                metric_inc('lostfound_reports_total', (('status', item_data['status']),))
+                log_event(INFO, 'ITEM REPORTED', "Item reported", client=client_id, item=item_data['id'], status=item_data['status'],
+                          location=item_data['location'])
+
+                # Check for matches, best candidate first
+                candidates = available_candidates(all_candidates)
+                if candidates:
+                    if log_threshold <= DEBUG:
+                        log_event(DEBUG, 'MATCH', "Match candidates", item=item_data['id'],
+                                  candidates=[f"{item['id']}:{score:.2f}" for score, item in candidates])
+                    # start_chat_session re-checks that both clients are still connected and not in another chat
+                    claimed = claim_match(item_data, candidates)
+                    if claimed:
+                        metric_inc('lostfound_matches_total', (('when', 'reported'),))
+                        log_event(INFO, 'MATCH', "Item matched", item=item_data['id'], matched=claimed[1]['id'], score=round(claimed[0], 2))
+                    else:
+                        request_rematch(client_id) # Retry in the background, maybe with other candidates
+                        matched_item = candidates[0][1]
+                        with clients_lock:
+                            reporter2_info = client_connections.get(matched_item["reporter_id"])
+                            reporter2_available = reporter2_info is not None and reporter2_info['mode'] == 'command'
+                        log_event(INFO, 'MATCH DELAYED', "Could not start chat; a user is busy or disconnected", item=item_data['id'], matched=matched_item['id'])
+                        send_to_client(client_id, f"INFO Your item '{item_data['name']}' has a potential match (ID: {matched_item['id']}). The other user will be notified if available.\n")
+                        # Optionally notify the other user if they are in command mode
+                        if reporter2_available:
+                            send_to_client(matched_item["reporter_id"], f"INFO Your reported item '{matched_item['name']}' (ID: {matched_item['id']}) has a new potential match (ID: {item_data['id']}).\n")
+
+                else:
+                    send_to_client(client_id, "INFO No immediate match found. We'll keep an eye out!\n")
+            
+            except json.JSONDecodeError:
+                send_to_client(client_id, "ERROR Invalid item data format (not JSON).\n")
+            except ItemsLoading:
+                raise
+            except Exception as e:
+                send_to_client(client_id, f"ERROR Processing item: {str(e)}\n")
+                log_event(ERROR, 'ITEM REPORTED', "Could not process item", client=client_id, error=e)
+            
+        elif message.upper() == "GET_MY_ITEMS":
+            my_items = [item for shard_items in item_broadcast('of_reporter', client_id) for item in shard_items]
+            if shard_pool:
+                my_items.sort(key=lambda item: item['timestamp']) # Report order across shards
+            my_items_list = [f"ID: {item['id']}, Name: {item['name']}, Status: {item['status']}, Matched: {'Yes' if item.get('matched_with') else 'No'}"
+                             for item in my_items]
+            if my_items_list:
+                send_to_client(client_id, f"YOUR_ITEMS \n" + "\n".join(my_items_list) + "\nEND_YOUR_ITEMS\n")
+            else:
+                send_to_client(client_id, "YOUR_ITEMS You have not reported any items.\nEND_YOUR_ITEMS\n")
         
-        # Set a shorter timeout for client recv operations to allow for graceful shutdown
-        conn.settimeout(5.0) # 5-second timeout
+        elif message.upper() == "GET_ALL_ITEMS":
+            send_all_items(client_id)
+            log_event(DEBUG, 'ITEMS', "All items requested", client=client_id)
 
-        while server_running.is_set(): # Loop as long as the server is running
-            with clients_lock: # Check client mode safely
-                current_mode = client_connections.get(client_id, {}).get('mode', 'command')
-                partner_id = client_connections.get(client_id, {}).get('chat_partner_id')
+        elif message.upper().split()[0] == "GET_CHANGES_SINCE" and len(message.split()) == 2:
+            send_changes(client_id, message.split()[1])
+
+        elif message.upper().split()[0] == "GET_ITEMS":
+            send_items_page(client_id, message.split()[1:])
+
+        elif message.upper().split()[0] == "GET_ARCHIVED":
+            send_items_page(client_id, message.split()[1:], 'archive_page', 'ARCHIVED_PAGE')
+
+        elif message.upper().split()[0] == "SEARCH":
+            send_search_results(client_id, message[len("SEARCH"):])
+
+        elif message.upper().split()[0] == "WATCH":
+            add_watch(client_id, message[len("WATCH"):])
+
+        elif message.upper().split()[0] == "UNWATCH" and len(message.split()) == 2:
+            remove_watch(client_id, message.split()[1])
+
+        elif message.upper().split()[0] == "RESUME" and len(message.split()) == 2:
+            resume_session(client_id, message.split()[1])
+
+        elif message.upper() == "PROTOCOL BINARY":
+            switch_to_binary(client_id)
+
+        elif message.upper() == "COMPRESS ZLIB":
+            enable_compression(client_id)
+
+        elif message.upper().split()[0] in ITEM_COMMANDS and len(message.split()) == 2:
+            ITEM_COMMANDS[message.upper().split()[0]](client_id, message.split()[1])
+
+        else:
+            send_to_client(client_id, "ERROR Unknown command. Available: REPORT_LOST <json>, REPORT_FOUND <json>, GET_MY_ITEMS, GET_ALL_ITEMS, GET_ITEMS [cursor] [limit], GET_CHANGES_SINCE <seq>, GET_ARCHIVED [cursor] [limit], SEARCH <json filter>, WATCH <json filter>, UNWATCH <watch_id>, RESUME <token>, PING, CLAIM <item_id>, RESOLVE <item_id>, WITHDRAW <item_id>\n")
+    
+    elif current_mode == 'chat':
+        if message.lower() == "/exit_chat":
+            log_event(DEBUG, 'CHAT', "Client sent /exit_chat", client=client_id)
+            send_to_client(client_id, "INFO You are exiting the chat...")
+            end_chat_session(client_id)
+            # Do NOT disconnect here. The client's mode is now 'command',
+            # so next messages will be handled as commands.
+        else:
+            relay_chat(client_id, message)
 
+def relay_chat(client_id, message):
+    """Relays a chat line (or binary chat frame) to the client's chat partner."""
+    with clients_lock: # Ensure partner is still valid
+        client_info = client_connections.get(client_id, {})
+        if client_info.get('mode') != 'chat':
+            send_to_client(client_id, "ERROR You are not in a chat.\n")
+            return
+        partner_id = client_info.get('chat_partner_id')
+        partner_connected = partner_id in client_connections and client_connections[partner_id]['conn']
+    if not partner_id: # Should not happen if mode is chat
+        send_to_client(client_id, "SYSTEM_MSG Chat error: No partner found. Ending chat.\n")
+        end_chat_session(client_id)
+    elif partner_connected:
+        # Relay message (queued; no lock is held while it is written)
+        send_chat_to_client(partner_id, client_id[-6:], message)
+        metric_inc('lostfound_chat_messages_total')
+    else: # Partner disconnected or removed
+        send_to_client(client_id, "SYSTEM_MSG Your chat partner has disconnected. Ending chat.\n")
+        end_chat_session(client_id)
+
+def heartbeat_worker():
+    """
+    Background thread that sends PING to clients silent for HEARTBEAT_INTERVAL and disconnects
+    the ones silent for HEARTBEAT_TIMEOUT, or without a command for IDLE_TIMEOUT. Only clients
+    that have sent a PING or PONG themselves take part in heartbeats (in chats too); others,
+    such as plain text clients that would show a PING as a message, only have the idle timeout.
+    The per-client timestamps are written by the thread reading that client without
+    clients_lock; a reading that is one check out of date only delays a PING or a disconnect
+    by a check.
+    """
+    check_every = min(timeout for timeout in (HEARTBEAT_INTERVAL, IDLE_TIMEOUT) if timeout) / 3
+    while not heartbeat_stop.wait(check_every):
+        now = time.monotonic()
+        to_ping, to_close = [], []
+        with clients_lock:
+            for client_id, client_info in client_connections.items():
+                silent = now - client_info['last_received']
+                heartbeats = HEARTBEAT_INTERVAL and client_info['heartbeats']
+                if heartbeats and silent >= HEARTBEAT_TIMEOUT:
+                    to_close.append((client_id, 'heartbeat'))
+                elif IDLE_TIMEOUT and now - client_info['last_command'] >= IDLE_TIMEOUT:
+                    to_close.append((client_id, 'idle'))
+                elif heartbeats and silent >= HEARTBEAT_INTERVAL and not client_info['pinged']:
+                    client_info['pinged'] = True
+                    to_ping.append(client_id)
+        for client_id in to_ping:
+            send_to_client(client_id, "PING\n")
+        for client_id, reason in to_close:
+            metric_inc('lostfound_connections_reaped_total', (('reason', reason),))
+            log_event(INFO, 'DISCONNECTED', "Closing unresponsive connection" if reason == 'heartbeat' else "Closing idle connection",
+                      client=client_id)
+            disconnect_client(client_id)
+
+def cleanup_client(client_id, addr):
+    """Ends any chat the client was in and forgets the client."""
+    log_event(INFO, 'CLEANUP', "Cleaning up client", client=client_id, addr=addr)
+    # A disconnected reporter's open items can no longer be matched (until it RESUMEs)
+    has_unresolved_items = any(item_broadcast('reporter_gone', client_id))
+    drop_watches(client_id)
+    # If client was in a chat, end the session for the partner, and forget the client -
+    # all in one clients_lock section
+    partner_to_notify = None
+    with clients_lock:
+        client_info = client_connections.pop(client_id, None)
+        if client_info and not has_unresolved_items:
+            resume_tokens.pop(client_info['resume_token'], None) # Nothing left to resume
+        elif client_info:
+            resume_tokens_left[client_info['resume_token']] = time.monotonic()
+        expire_resume_tokens() # Each closed connection also ages out the oldest ones
+        if client_info and client_info['mode'] == 'chat':
+            partner_id_on_disconnect = client_info.get('chat_partner_id')
+            log_event(INFO, 'CLEANUP', "Client was in a chat; ending it", client=client_id, partner=partner_id_on_disconnect)
+            if partner_id_on_disconnect in client_connections:
+                client_connections[partner_id_on_disconnect]['mode'] = 'command'
+                client_connections[partner_id_on_disconnect]['chat_partner_id'] = None
+                partner_to_notify = partner_id_on_disconnect
+
+        # Ensure client is removed from any lingering chat partner mappings
+        lingering_partner = chat_partners.pop(client_id, None)
+        if lingering_partner is not None and chat_partners.get(lingering_partner) == client_id:
+            del chat_partners[lingering_partner]
+
+    if partner_to_notify:
+        send_to_client(partner_to_notify, "CHAT_ENDED Your chat partner has disconnected. Returning to main menu.")
+        log_event(INFO, 'CHAT', "Chat session ended by partner disconnect", client=partner_to_notify, partner=client_id)
+        request_rematch(partner_to_notify)
+
+def handle_client(conn, addr, client_id):
+    """Handles a single client connection (threaded mode)."""
+    client_info = register_client(conn, addr, client_id)
+    writer = threading.Thread(target=client_writer, args=(client_id, conn, client_info['outbound']), daemon=True)
+    writer.start()
+    try:
+        reader = client_info['reader']
+        # recv blocks until data arrives; disconnect_client() and shutdown wake it by shutting
+        # the socket down, and heartbeat_worker finds peers that went away silently
+        while server_running.is_set(): # Loop as long as the server is running
             try:
                 data = conn.recv(BUFFER_SIZE)
                 if not data:
-                    print(f"[DISCONNECTED] Client {client_id} ({addr}) disconnected (empty data).")
+                    if server_running.is_set():
+                        log_event(INFO, 'DISCONNECTED', "Client disconnected", client=client_id, addr=addr)
                     break # Exit loop if client disconnects
-                
-                message = data.decode('utf-8').strip()
-                print(f"[RECV {client_id} - {current_mode}] Raw message: '{data.decode('utf-8').replace('\n', '\\n')}' | Stripped message: '{message}'") # Added detailed logging for debugging
-
-                if current_mode == 'command':
-                    if message.startswith("REPORT_"):
-                        parts = message.split(" ", 1)
-                        command = parts[0]
-                        
-                        if len(parts) < 2 or not parts[1]:
-                            conn.sendall("ERROR Invalid report command. Missing item data.\n".encode('utf-8'))
-                            continue
-                        
-                        item_json_str = parts[1]
-                        try:
-                            item_data = json.loads(item_json_str)
-                            item_data["id"] = str(uuid.uuid4()) # Generate unique ID for the item
-                            item_data["reporter_id"] = client_id
-                            item_data["timestamp"] = time.strftime("%Y-%m-%d %H:%M:%S")
-                            item_data["matched_with"] = None # Initialize matched_with field
-
-                            if command == "REPORT_LOST":
-                                item_data["status"] = "lost"
-                            elif command == "REPORT_FOUND":
-                                item_data["status"] = "found"
-                            else:
-                                conn.sendall("ERROR Invalid report type.\n".encode('utf-8'))
-                                continue
-                            
-                            # Validate essential fields
-                            if not all(k in item_data for k in ("name", "color", "location", "description")):
-                                conn.sendall("ERROR Missing item details (name, color, location, description).\n".encode('utf-8'))
-                                continue
-                            if item_data["location"] not in LOCATIONS:
-                                conn.sendall(f"ERROR Invalid location. Please choose from: {', '.join(LOCATIONS)}\n".encode('utf-8'))
-                                continue
-
-
-                            with items_lock:
-                                items.append(item_data)
-                            save_items()
-                            conn.sendall(f"SUCCESS Item {item_data['id']} reported successfully.\n".encode('utf-8'))
-                            # FIX: Changed item['status'] to item_data['status']
-                            print(f"[ITEM REPORTED] Client {client_id} reported: {item_data['name']} ({item_data['status']}) at {item_data['location']}")
-
-                            # Check for matches
-                            matched_item = find_match(item_data)
-                            if matched_item:
-                                print(f"[MATCH] Item {item_data['id']} matched with {matched_item['id']}")
-                                # Ensure both clients are still connected and not in another chat
-                                with clients_lock:
-                                    reporter1_info = client_connections.get(item_data["reporter_id"])
-                                    reporter2_info = client_connections.get(matched_item["reporter_id"])
-
-                                if reporter1_info and reporter1_info['mode'] == 'command' and \
-                                   reporter2_info and reporter2_info['mode'] == 'command':
-                                    start_chat_session(item_data["reporter_id"], matched_item["reporter_id"], item_data["id"], matched_item["id"])
-                                else:
-                                    print(f"[MATCH DELAYED] Could not start chat for {item_data['id']} and {matched_item['id']} - one or both users busy/disconnected.")
-                                    conn.sendall(f"INFO Your item '{item_data['name']}' has a potential match (ID: {matched_item['id']}). The other user will be notified if available.\n".encode('utf-8'))
-                                    # Optionally notify the other user if they are in command mode
-                                    if reporter2_info and reporter2_info['mode'] == 'command':
-                                        notify_client(matched_item["reporter_id"], f"INFO Your reported item '{matched_item['name']}' (ID: {matched_item['id']}) has a new potential match (ID: {item_data['id']}).\n")
-
-                            else:
-                                conn.sendall("INFO No immediate match found. We'll keep an eye out!\n".encode('utf-8'))
-                        
-                        except json.JSONDecodeError:
-                            conn.sendall("ERROR Invalid item data format (not JSON).\n".encode('utf-8'))
-                        except Exception as e:
-                            conn.sendall(f"ERROR Processing item: {str(e)}\n".encode('utf-8'))
-                            print(f"[ERROR] Processing item for {client_id}: {e}")
-                        
-                    elif message.upper() == "GET_MY_ITEMS":
-                        my_items_list = []
-                        with items_lock:
-                            for item in items:
-                                if item.get("reporter_id") == client_id:
-                                    my_items_list.append(f"ID: {item['id']}, Name: {item['name']}, Status: {item['status']}, Matched: {'Yes' if item.get('matched_with') else 'No'}")
-                        if my_items_list:
-                            conn.sendall(f"YOUR_ITEMS \n" + "\n".join(my_items_list) + "\nEND_YOUR_ITEMS\n".encode('utf-8'))
-                        else:
-                            conn.sendall("YOUR_ITEMS You have not reported any items.\nEND_YOUR_ITEMS\n".encode('utf-8'))
-                    
-                    elif message.upper() == "GET_ALL_ITEMS":
-                        conn.sendall("ALL_ITEMS_START\n".encode('utf-8'))
-                        with items_lock:
-                            if items:
-                                for item in items:
-                                    item_summary = (
-                                        f"ITEM: Type: {item['status'].capitalize()}, "
-                                        f"Name: {item['name']}, "
-                                        f"Color: {item['color']}, "
-                                        f"Location: {item['location']}, "
-                                        f"Description: {item['description']}, "
-                                        f"Reported: {item['timestamp']}, "
-                                        f"Matched: {'Yes' if item.get('matched_with') else 'No'}\n"
-                                    )
-                                    conn.sendall(item_summary.encode('utf-8'))
-                            else:
-                                conn.sendall("ITEM: No items reported yet.\n".encode('utf-8'))
-                        conn.sendall("ALL_ITEMS_END\n".encode('utf-8'))
-                        print(f"[INFO] Client {client_id} requested all items.")
+                process_data(client_id, reader, data)
 
-                    else:
-                        conn.sendall("ERROR Unknown command. Available: REPORT_LOST <json>, REPORT_FOUND <json>, GET_MY_ITEMS, GET_ALL_ITEMS\n".encode('utf-8'))
-                
-                elif current_mode == 'chat':
-                    if message.lower() == "/exit_chat":
-                        print(f"[DEBUG] Client {client_id} sent /exit_chat. Calling end_chat_session.")
-                        notify_client(client_id, "INFO You are exiting the chat...")
-                        end_chat_session(client_id)
-                        # No need for time.sleep(0.1) here, as SHUT_WR should handle the timing.
-                        # Do NOT break here. Allow the loop to continue.
-                        # The client's mode is now 'command', so next messages will be handled as commands.
-                    elif partner_id:
-                        with clients_lock: # Ensure partner is still valid
-                            if partner_id in client_connections and client_connections[partner_id]['conn']:
-                                try:
-                                    # Relay message
-                                    client_connections[partner_id]['conn'].sendall(f"CHAT_MSG [{client_id[-6:]}]: {message}\n".encode('utf-8'))
-                                except socket.error as e:
-                                    print(f"[CHAT RELAY ERROR] Could not send to {partner_id}: {e}")
-                                    # Notify sender that partner might have disconnected
-                                    conn.sendall("SYSTEM_MSG Your chat partner may have disconnected. Ending chat.\n".encode('utf-8'))
-                                    end_chat_session(client_id) # End chat for current client as well
-                            else: # Partner disconnected or removed
-                                conn.sendall("SYSTEM_MSG Your chat partner has disconnected. Ending chat.\n".encode('utf-8'))
-                                end_chat_session(client_id)
-                    else: # Should not happen if mode is chat and partner_id is None
-                        conn.sendall("SYSTEM_MSG Chat error: No partner found. Ending chat.\n".encode('utf-8'))
-                        end_chat_session(client_id)
-
-            except socket.timeout:
-                continue # Just continue listening
-            except UnicodeDecodeError:
-                print(f"[ERROR] Client {client_id} sent non-UTF-8 data.")
-                conn.sendall("ERROR Invalid data encoding. Please use UTF-8.\n".encode('utf-8'))
             except ConnectionResetError:
-                print(f"[DISCONNECTED] Client {client_id} ({addr}) reset the connection.")
+                log_event(INFO, 'DISCONNECTED', "Client reset the connection", client=client_id, addr=addr)
                 break # Break if client explicitly disconnects or connection is reset
             except Exception as e:
-                print(f"[ERROR] Unexpected error with client {client_id} ({addr}): {e}")
+                if server_running.is_set(): # Otherwise main() closed the socket at shutdown
+                    log_event(ERROR, 'CONNECTION', "Unexpected error with client", client=client_id, addr=addr, error=e)
                 break # Break on other unexpected errors
         
     finally:
-        print(f"[CLEANUP] Cleaning up for client {client_id} ({addr}).")
-        # If client was in a chat, notify partner and end session
-        with clients_lock:
-            if client_id in client_connections and client_connections[client_id]['mode'] == 'chat':
-                partner_id_on_disconnect = client_connections[client_id].get('chat_partner_id')
-                print(f"[CLEANUP] Client {client_id} was in chat with {partner_id_on_disconnect}. Ending chat.")
-                if partner_id_on_disconnect in client_connections:
-                    client_connections[partner_id_on_disconnect]['mode'] = 'command'
-                    client_connections[partner_id_on_disconnect]['chat_partner_id'] = None
-                    notify_client(partner_id_on_disconnect, "CHAT_ENDED Your chat partner has disconnected. Returning to main menu.")
-                    print(f"[SYSTEM] Chat session ended for {partner_id_on_disconnect} due to partner {client_id} disconnecting.")
-                    with chat_partners_lock:
-                        if partner_id_on_disconnect in chat_partners:
-                            del chat_partners[partner_id_on_disconnect]
-                        if client_id in chat_partners: # remove self from chat_partners too
-                            del chat_partners[client_id]
+        if server_running.is_set(): # At shutdown main() notifies and closes every connection itself
+            cleanup_client(client_id, addr)
+        client_info['outbound'].close()
+        writer.join(timeout=1.0) # Let the writer finish what was already queued
+        conn.close()
+        log_event(INFO, 'CONNECTION CLOSED', "Connection closed", client=client_id, addr=addr)
+
+class EventLoopServer:
+    """
+    Serves every client from a single selectors loop instead of one thread per connection.
+    Sockets are non-blocking; each client's OutboundQueue is flushed by the loop when the
+    socket is writable. Other threads hand flushes and closes over to the loop through a
+    wakeup socket.
+    """
+    MAX_CHUNKS_PER_FLUSH = 16 # Keeps one fast bulk reader from starving everyone else
 
+    def __init__(self, server_socket):
+        self.server_socket = server_socket
+        self.selector = selectors.DefaultSelector()
+        self.loop_thread = None
+        self.pending_lock = threading.Lock() # Guards pending_flush and pending_close only
+        self.pending_flush = set()
+        self.pending_close = set()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
 
-        with clients_lock:
-            if client_id in client_connections:
-                del client_connections[client_id]
-        
-        with chat_partners_lock: # Ensure client is removed from any lingering chat partner mappings
-            if client_id in chat_partners:
-                lingering_partner = chat_partners.pop(client_id)
-                if lingering_partner in chat_partners and chat_partners[lingering_partner] == client_id:
-                    del chat_partners[lingering_partner]
+    def run(self):
+        """Runs the loop until server_running is cleared (see wakeup())."""
+        self.loop_thread = threading.current_thread()
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ, None)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, None)
+        while server_running.is_set():
+            for key, mask in self.selector.select():
+                if key.fileobj is self.server_socket:
+                    self._accept()
+                elif key.fileobj is self.wakeup_recv:
+                    self._drain_wakeup()
+                else:
+                    client_id = key.data
+                    if mask & selectors.EVENT_READ:
+                        self._read(client_id, key.fileobj)
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(client_id)
+            # Output queued while handling these events is written now, with no lock held
+            self._run_pending()
+
+    def wakeup(self):
+        """Interrupts select() from any thread."""
+        try:
+            self.wakeup_send.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass # A wakeup is already pending or the loop is gone
+
+    def request_flush(self, client_id):
+        """Asks the loop to write a client's queued output."""
+        with self.pending_lock:
+            self.pending_flush.add(client_id)
+        if threading.current_thread() is not self.loop_thread:
+            self.wakeup()
+
+    def request_close(self, client_id):
+        """Asks the loop to close a client's connection (safe while holding clients_lock)."""
+        with self.pending_lock:
+            self.pending_close.add(client_id)
+        if threading.current_thread() is not self.loop_thread:
+            self.wakeup()
+
+    def close(self):
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
+    def _accept(self):
+        try:
+            conn, addr = self.server_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except Exception as e:
+            log_event(ERROR, 'CONNECTION', "Could not accept a new connection", error=e)
+            return
+        if not accepting_connections():
+            refuse_connection(conn, addr)
+            return
+        conn.setblocking(False)
+        client_id = str(uuid.uuid4()) # Assign a unique ID to the client
+        self.selector.register(conn, selectors.EVENT_READ, client_id)
+        register_client(conn, addr, client_id)
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup_recv.recv(BUFFER_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _run_pending(self):
+        with self.pending_lock:
+            to_flush, self.pending_flush = self.pending_flush, set()
+            to_close, self.pending_close = self.pending_close, set()
+        for client_id in to_flush - to_close:
+            self._flush(client_id)
+        for client_id in to_close:
+            client_info = client_connections.get(client_id)
+            if client_info:
+                self._close_client(client_id, client_info['conn'])
+
+    def _read(self, client_id, conn):
+        try:
+            data = conn.recv(BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except ConnectionResetError:
+            log_event(INFO, 'DISCONNECTED', "Client reset the connection", client=client_id)
+            self._close_client(client_id, conn)
+            return
+        except OSError as e: # e.g. ETIMEDOUT from a peer that vanished; only this client is affected
+            log_event(WARNING, 'DISCONNECTED', "Could not read from client", client=client_id, error=e)
+            self._close_client(client_id, conn)
+            return
+        if not data:
+            log_event(INFO, 'DISCONNECTED', "Client disconnected", client=client_id)
+            self._close_client(client_id, conn)
+            return
+        try:
+            process_data(client_id, client_connections[client_id]['reader'], data)
+        except Exception as e:
+            log_event(ERROR, 'CONNECTION', "Unexpected error with client", client=client_id, error=e)
+            self._close_client(client_id, conn)
 
+    def _flush(self, client_id):
+        client_info = client_connections.get(client_id)
+        if not client_info:
+            return
+        conn, outbound = client_info['conn'], client_info['outbound']
+        events = selectors.EVENT_READ
+        try:
+            for _ in range(self.MAX_CHUNKS_PER_FLUSH):
+                chunk = outbound.peek()
+                if chunk is None:
+                    break
+                sent = conn.send(chunk)
+                outbound.consume(sent)
+                if sent < len(chunk):
+                    events |= selectors.EVENT_WRITE
+                    break
+            else:
+                events |= selectors.EVENT_WRITE # More to send; continue on the next pass
+        except (BlockingIOError, InterruptedError):
+            events |= selectors.EVENT_WRITE
+        except OSError as e:
+            log_event(ERROR, 'SYSTEM', "Could not send to client", client=client_id, error=e)
+            self.request_close(client_id)
+            return
+        try:
+            if self.selector.get_key(conn).events != events:
+                self.selector.modify(conn, events, client_id)
+        except (KeyError, ValueError):
+            pass # Connection already closed
 
+    def _close_client(self, client_id, conn):
+        try:
+            self.selector.unregister(conn)
+        except (KeyError, ValueError):
+            return # Already closed
+        client_info = client_connections.get(client_id, {})
+        addr = client_info.get('addr')
+        cleanup_client(client_id, addr)
+        if 'outbound' in client_info:
+            client_info['outbound'].close()
         conn.close()
-        print(f"[CONNECTION CLOSED] Connection with {addr} (Client {client_id}) closed.")
+        log_event(INFO, 'CONNECTION CLOSED', "Connection closed", client=client_id, addr=addr)
+
+def run_threaded(server_socket):
+    """Accepts connections and serves each one from its own thread (original server mode)."""
+    # accept() blocks; Ctrl+C interrupts it with KeyboardInterrupt
+    while server_running.is_set(): # Loop as long as the server is signaled to be running
+        try:
+            conn, addr = server_socket.accept()
+            if not accepting_connections():
+                refuse_connection(conn, addr)
+                continue
+            client_id = str(uuid.uuid4()) # Assign a unique ID to the client
+            
+            thread = threading.Thread(target=handle_client, args=(conn, addr, client_id))
+            thread.daemon = True # Allow main program to exit even if threads are running
+            thread.start()
+        except Exception as e:
+            log_event(ERROR, 'CONNECTION', "Could not accept a new connection", error=e)
+            if not server_running.is_set(): # If server is shutting down, break
+                break
 
 def main():
     """Main function to start the server."""
-    load_items()
+    global event_loop
+    if SHARDS:
+        start_shards()
+    else:
+        load_items()
+        if STORAGE_MODE == 'journal':
+            threading.Thread(target=compaction_worker, daemon=True).start()
+    if ARCHIVE_INTERVAL:
+        threading.Thread(target=archive_worker, daemon=True).start()
+    threading.Thread(target=match_worker, daemon=True).start()
+    if HEARTBEAT_INTERVAL or IDLE_TIMEOUT:
+        threading.Thread(target=heartbeat_worker, daemon=True).start()
+    if METRICS_PORT:
+        start_metrics_server()
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Allow address reuse
     try:
         server_socket.bind((HOST, PORT))
     except socket.error as e:
-        print(f"[FATAL ERROR] Could not bind to port {PORT}: {e}")
+        log_event(ERROR, 'FATAL ERROR', "Could not bind to port", port=PORT, error=e)
         return
         
-    server_socket.listen(5) # Listen for up to 5 queued connections
-    print(f"[LISTENING] Server listening on {HOST}:{PORT}")
-
-    # Set a timeout for the accept() call to allow checking server_running flag
-    server_socket.settimeout(1.0) 
+    server_socket.listen(LISTEN_BACKLOG)
+    log_event(INFO, 'LISTENING', "Server listening", host=HOST, port=PORT, mode=SERVER_MODE)
 
     try:
-        while server_running.is_set(): # Loop as long as the server is signaled to be running
-            try:
-                conn, addr = server_socket.accept()
-                client_id = str(uuid.uuid4()) # Assign a unique ID to the client
-                
-                thread = threading.Thread(target=handle_client, args=(conn, addr, client_id))
-                thread.daemon = True # Allow main program to exit even if threads are running
-                thread.start()
-            except socket.timeout:
-                continue # Timeout on accept(), check server_running flag again
-            except Exception as e:
-                print(f"[ERROR] Error accepting new connection: {e}")
-                if not server_running.is_set(): # If server is shutting down, break
-                    break
+        if SERVER_MODE == 'threaded':
+            run_threaded(server_socket)
+        else:
+            event_loop = EventLoopServer(server_socket)
+            event_loop.run()
     except KeyboardInterrupt:
-        print("\n[SYSTEM] KeyboardInterrupt detected. Server shutting down...")
+        log_event(INFO, 'SYSTEM', "KeyboardInterrupt detected; server shutting down")
     finally:
-        print("[SYSTEM] Setting server_running to False to stop client threads.")
+        log_event(INFO, 'SYSTEM', "Stopping client threads")
         server_running.clear() # Signal all client threads to stop
-        
-        # Give a small delay for threads to notice the shutdown signal and start cleaning up
-        time.sleep(1) 
+        compact_requested.set() # Wake the compaction thread so it can exit
+        archive_requested.set()
+        match_requested.set() # ...and the match worker
+        heartbeat_stop.set()
 
-        print("[SYSTEM] Saving items before shutdown...")
-        save_items()
-        print("[SYSTEM] Closing server socket.")
+        log_event(INFO, 'SYSTEM', "Saving items before shutdown")
+        if shard_pool:
+            stop_shards() # Each shard saves its own items
+        else:
+            save_items()
+        log_event(INFO, 'SYSTEM', "Closing server socket")
         server_socket.close()
         
         # Attempt to notify all connected clients about server shutdown
@@ -459,17 +3601,126 @@ def main():
             # Create a copy of client_connections keys to iterate over, as it might be modified
             # by threads during cleanup.
             client_ids_to_notify = list(client_connections.keys()) 
-            for cid in client_ids_to_notify:
-                client_info = client_connections.get(cid)
-                if client_info and client_info['conn']:
-                    try:
-                        client_info['conn'].sendall("SERVER_SHUTDOWN The server is shutting down. Goodbye.\n".encode('utf-8'))
-                        client_info['conn'].close()
-                        print(f"[CLEANUP] Notified and closed connection for client {cid}")
-                    except Exception as e:
-                        print(f"[CLEANUP ERROR] Could not notify client {cid}: {e}")
-        print("[SYSTEM] Server shutdown complete.")
+        for cid in client_ids_to_notify:
+            client_info = client_connections.get(cid)
+            if client_info and client_info['conn']:
+                try:
+                    conn, outbound = client_info['conn'], client_info['outbound']
+                    send_to_client(cid, "SERVER_SHUTDOWN The server is shutting down. Goodbye.\n")
+                    outbound.close()
+                    if event_loop:
+                        # The loop is gone, so flush what is still queued with blocking sends
+                        conn.settimeout(1.0)
+                        while (chunk := outbound.peek()) is not None:
+                            conn.sendall(chunk)
+                            outbound.consume(len(chunk))
+                    else:
+                        outbound.wait_drained(1.0) # The client's writer thread is still running
+                        conn.shutdown(socket.SHUT_RDWR) # Wakes the client's handler thread out of recv
+                    conn.close()
+                    log_event(INFO, 'CLEANUP', "Notified and closed connection", client=cid)
+                except Exception as e:
+                    log_event(ERROR, 'CLEANUP', "Could not notify client", client=cid, error=e)
+        if event_loop:
+            event_loop.close()
+        if LOCK_STATS:
+            for line in lock_stats_report():
+                log_event(INFO, 'LOCK STATS', line)
+        log_event(INFO, 'SYSTEM', "Server shutdown complete")
         sys.exit(0) # Ensure the main process exits
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lost & Found server")
+    parser.add_argument('--mode', choices=['eventloop', 'threaded'],
+                        help="eventloop multiplexes all clients on one thread; threaded uses one thread per client "
+                             "(the default with --shards, which needs it)")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--storage', choices=['journal', 'json', 'sqlite'], default=STORAGE_MODE,
+                        help="journal appends one record per change; json rewrites the whole file; sqlite uses SQLITE_FILE")
+    parser.add_argument('--shards', type=int, default=SHARDS,
+                        help="run items in this many worker processes, split by location (0 keeps them in-process)")
+    parser.add_argument('--archive-interval', type=int, default=ARCHIVE_INTERVAL,
+                        help="seconds between passes that move old items to ARCHIVE_FILE (0 turns archival off)")
+    parser.add_argument('--archive-open-ttl', type=int, default=ARCHIVE_OPEN_TTL,
+                        help="archive unmatched reports this many seconds after they were made")
+    parser.add_argument('--change-feed-size', type=int, default=CHANGE_FEED_SIZE,
+                        help="item changes kept for GET_CHANGES_SINCE; clients further behind get a full resync")
+    parser.add_argument('--lock-stats', action='store_true', default=LOCK_STATS,
+                        help="record lock wait and hold times per call site and print them at shutdown")
+    parser.add_argument('--log-level', choices=list(LOG_LEVELS), default=LOG_LEVEL)
+    parser.add_argument('--log-format', choices=['text', 'json'], default=LOG_FORMAT)
+    parser.add_argument('--log-payloads', action='store_true', default=LOG_PAYLOADS,
+                        help="include raw message text in debug RECV lines")
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='CLASS=RATE/BURST',
+                        help="per-connection limit of a command class (report, item, list, chat); "
+                             "CLASS=off removes it (repeatable)")
+    parser.add_argument('--global-rate-limit', action='append', default=[], metavar='CLASS=RATE/BURST',
+                        help="limit of a command class across all connections, like --rate-limit")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help="connections accepted beyond this are refused with ERROR SERVER_BUSY")
+    parser.add_argument('--heartbeat-interval', type=int, default=HEARTBEAT_INTERVAL,
+                        help="seconds of client silence before a PING (0 turns heartbeats off)")
+    parser.add_argument('--heartbeat-timeout', type=int, default=HEARTBEAT_TIMEOUT,
+                        help="seconds of client silence before the connection is closed")
+    parser.add_argument('--idle-timeout', type=int, default=IDLE_TIMEOUT,
+                        help="close connections that send no command for this many seconds (0 = never)")
+    parser.add_argument('--resume-token-ttl', type=int, default=RESUME_TOKEN_TTL,
+                        help="seconds a closed connection's open items can be RESUMEd (0 = forever)")
+    parser.add_argument('--log-sample', action='append', default=[], metavar='COMMAND=N',
+                        help="log only one in N debug RECV lines of COMMAND (repeatable)")
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--import-json', metavar='PATH',
+                        help="import an existing items.json into SQLITE_FILE and exit")
+    args = parser.parse_args()
+    SHARDS = args.shards
+    # Shard calls block the calling thread until the shard replies, so only handler threads
+    # keep several shards busy at once; the event loop would run them one at a time
+    SERVER_MODE = args.mode or ('threaded' if SHARDS else SERVER_MODE)
+    if SHARDS and SERVER_MODE != 'threaded':
+        parser.error("--shards needs --mode threaded (the event loop would wait on one shard at a time)")
+    PORT = args.port
+    STORAGE_MODE = args.storage
+    ARCHIVE_INTERVAL = args.archive_interval
+    ARCHIVE_OPEN_TTL = args.archive_open_ttl
+    CHANGE_FEED_SIZE = args.change_feed_size
+    LOCK_STATS = args.lock_stats
+    LOG_LEVEL = args.log_level
+    METRICS_PORT = args.metrics_port
+    LOG_FORMAT = args.log_format
+    LOG_PAYLOADS = args.log_payloads
+    for sample in args.log_sample:
+        command, _, every = sample.partition('=')
+        if not every.isdigit() or int(every) < 1:
+            parser.error(f"--log-sample expects COMMAND=N, got {sample!r}")
+        LOG_SAMPLE_EVERY[command.upper()] = int(every)
+    MAX_CONNECTIONS = args.max_connections
+    HEARTBEAT_INTERVAL = args.heartbeat_interval
+    HEARTBEAT_TIMEOUT = args.heartbeat_timeout
+    IDLE_TIMEOUT = args.idle_timeout
+    RESUME_TOKEN_TTL = args.resume_token_ttl
+    if HEARTBEAT_INTERVAL and HEARTBEAT_TIMEOUT <= HEARTBEAT_INTERVAL:
+        parser.error("--heartbeat-timeout must be longer than --heartbeat-interval")
+    for option, limits, settings in (('--rate-limit', RATE_LIMITS, args.rate_limit),
+                                     ('--global-rate-limit', GLOBAL_RATE_LIMITS, args.global_rate_limit)):
+        for setting in settings:
+            rate_class, _, limit = setting.partition('=')
+            if rate_class not in set(COMMAND_RATE_CLASSES.values()):
+                parser.error(f"{option}: unknown command class {rate_class!r}")
+            if limit == 'off':
+                limits.pop(rate_class, None)
+                continue
+            rate, _, burst = limit.partition('/')
+            try:
+                limits[rate_class] = (float(rate), int(burst or 1))
+            except ValueError:
+                parser.error(f"{option} expects CLASS=RATE/BURST or CLASS=off, got {setting!r}")
+            if limits[rate_class][0] <= 0 or limits[rate_class][1] < 1:
+                parser.error(f"{option} needs a positive rate and burst, got {setting!r}")
+    start_logging()
+    if LOCK_STATS:
+        install_lock_stats()
+    if args.import_json:
+        import_json_items(args.import_json)
+        sys.exit(0)
     main()
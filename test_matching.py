@@ -0,0 +1,48 @@
+"""
+Tests for the item matching rules in server.py. Run with: python -m unittest test_matching
+"""
+import unittest
+import uuid
+
+import server
+
+def item(status, name, color, description, location="Cafe"):
+    return server.Item({"name": name, "color": color, "location": location, "description": description,
+                        "id": str(uuid.uuid4()), "reporter_id": str(uuid.uuid4()), "timestamp": "2024-05-01 10:00:00",
+                        "matched_with": None, "status": status})
+
+def score(first, second):
+    return server.match_score(server.match_features(first), server.match_features(second))
+
+class MatchScoreTest(unittest.TestCase):
+    def test_same_name_and_color_match(self):
+        self.assertGreaterEqual(score(item("lost", "Phone", "Black", "cracked screen"),
+                                      item("found", "phone", "blk", "found on a table")), server.MATCH_THRESHOLD)
+
+    def test_different_colors_never_match(self):
+        # Same name and the same description words: only the color tells them apart
+        black = item("lost", "black phone", "Black", "samsung phone with a cracked screen")
+        white = item("found", "white phone", "White", "samsung phone with a cracked screen")
+        self.assertEqual(score(black, white), 0.0)
+        self.assertLess(score(black, white), server.MATCH_THRESHOLD)
+
+    def test_multicolored_items_can_match_any_color(self):
+        self.assertGreaterEqual(score(item("lost", "Umbrella", "multicolor", "striped umbrella"),
+                                      item("found", "umbrella", "red", "striped umbrella")), server.MATCH_THRESHOLD)
+
+class MatchCandidatesTest(unittest.TestCase):
+    def setUp(self):
+        server.match_index.clear()
+        server.match_open_items.clear()
+        server.match_index_by_reporter.clear()
+
+    def test_black_phone_is_not_matched_with_white_phone(self):
+        white = item("found", "Phone", "White", "samsung phone with a cracked screen")
+        black = item("found", "Phone", "Black", "samsung phone with a cracked screen")
+        server.index_open_item(white)
+        server.index_open_item(black)
+        candidates = server.match_candidates(item("lost", "Phone", "Black", "samsung phone with a cracked screen"))
+        self.assertEqual([candidate for _, candidate in candidates], [black])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+"""
+Tests for the message framing in protocol.py. Run with: python -m unittest test_protocol
+"""
+import unittest
+
+import protocol
+
+def messages(decoder, *chunks):
+    received = []
+    for chunk in chunks:
+        decoder.feed(chunk)
+        received += decoder.messages()
+    return received
+
+class TextLineTest(unittest.TestCase):
+    def test_pipelined_lines_in_one_read(self):
+        decoder = protocol.StreamDecoder(100)
+        self.assertEqual(messages(decoder, b"GET_MY_ITEMS\nGET_ITEMS 0 10\nPING\n"),
+                         [(protocol.FRAME_TEXT, b"GET_MY_ITEMS"), (protocol.FRAME_TEXT, b"GET_ITEMS 0 10"),
+                          (protocol.FRAME_TEXT, b"PING")])
+
+    def test_line_split_across_reads(self):
+        decoder = protocol.StreamDecoder(100)
+        self.assertEqual(messages(decoder, b"GET_IT", b"EMS 0", b" 10\nPI"), [(protocol.FRAME_TEXT, b"GET_ITEMS 0 10")])
+        self.assertEqual(messages(decoder, b"NG\n"), [(protocol.FRAME_TEXT, b"PING")])
+
+    def test_utf8_character_split_across_reads(self):
+        line = "REPORT_LOST Schlüssel €".encode("utf-8")
+        split = line.index("€".encode("utf-8")) + 1 # Inside the three bytes of the euro sign
+        received = messages(protocol.StreamDecoder(100), line[:split], line[split:] + b"\n")
+        self.assertEqual([payload.decode("utf-8") for _, payload in received], ["REPORT_LOST Schlüssel €"])
+
+    def test_oversized_line_is_reported_once_and_skipped(self):
+        decoder = protocol.StreamDecoder(10)
+        self.assertEqual(messages(decoder, b"x" * 8, b"x" * 8, b"x" * 8), [(None, None)])
+        self.assertEqual(messages(decoder, b"xx\nPING\n"), [(protocol.FRAME_TEXT, b"PING")])
+
+    def test_oversized_line_in_one_read(self):
+        self.assertEqual(messages(protocol.StreamDecoder(10), b"x" * 20 + b"\nPING\n"),
+                         [(None, None), (protocol.FRAME_TEXT, b"PING")])
+
+class BinaryFrameTest(unittest.TestCase):
+    def test_switch_applies_from_the_next_byte(self):
+        decoder = protocol.StreamDecoder(100)
+        decoder.feed(b"PROTOCOL binary\n" + protocol.encode_text("PING"))
+        received = []
+        for frame_type, payload in decoder.messages():
+            received.append((frame_type, payload))
+            if payload == b"PROTOCOL binary":
+                decoder.switch_to_binary()
+        self.assertEqual(received, [(protocol.FRAME_TEXT, b"PROTOCOL binary"), (protocol.FRAME_TEXT, b"PING")])
+
+    def test_frame_split_across_reads(self):
+        decoder = protocol.StreamDecoder(100)
+        decoder.switch_to_binary()
+        frame = protocol.encode_chat("A", "hello ünïcode")
+        received = messages(decoder, frame[:3], frame[3:9], frame[9:] + protocol.encode_text("PING"))
+        self.assertEqual([frame_type for frame_type, _ in received], [protocol.FRAME_CHAT, protocol.FRAME_TEXT])
+        self.assertEqual(protocol.decode_chat(received[0][1]), ("A", "hello ünïcode"))
+
+    def test_oversized_frame_is_skipped(self):
+        decoder = protocol.StreamDecoder(10)
+        decoder.switch_to_binary()
+        big = protocol.encode_frame(protocol.FRAME_TEXT, b"x" * 50)
+        self.assertEqual(messages(decoder, big[:20]), [(None, None)])
+        self.assertEqual(messages(decoder, big[20:] + protocol.encode_text("PING")), [(protocol.FRAME_TEXT, b"PING")])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+Tests for the crash safety of the journal and the binary snapshot in server.py. Run with: python -m unittest test_storage
+"""
+import json
+import os
+import tempfile
+import unittest
+import uuid
+
+import server
+
+def item(name, status="lost"):
+    return {"name": name, "color": "Black", "location": "Cafe", "description": "x", "id": str(uuid.uuid4()),
+            "reporter_id": str(uuid.uuid4()), "timestamp": "2024-05-01 10:00:00", "matched_with": None, "status": status}
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.data_file = os.path.join(directory.name, "items.json")
+        self.journal_file = os.path.join(directory.name, "items.journal")
+        self.snapshot_file = os.path.join(directory.name, "items.snapshot")
+
+    def open_store(self):
+        store = server.JsonItemStore(self.data_file, self.journal_file, self.snapshot_file)
+        store.load()
+        self.addCleanup(store.close)
+        return store
+
+    def names(self, store):
+        with server.items_lock:
+            return sorted(stored.name for stored in store.live_items())
+
+class JournalReplayTest(StoreTestCase):
+    def test_torn_record_is_dropped_and_truncated(self):
+        store = self.open_store()
+        with server.items_lock:
+            store.add(item("Keys"))
+            store.add(item("Phone"))
+        store.close()
+        with open(self.journal_file, "ab") as f: # A crash in the middle of writing the third record
+            f.write(json.dumps({"op": "add", "item": item("Wallet")}).encode("utf-8")[:40])
+        intact_size = os.path.getsize(self.journal_file) - 40
+        self.assertEqual(self.names(self.open_store()), ["Keys", "Phone"])
+        self.assertEqual(os.path.getsize(self.journal_file), intact_size)
+
+    def test_complete_record_without_newline_is_dropped(self):
+        with open(self.journal_file, "wb") as f:
+            f.write(json.dumps({"op": "add", "item": item("Keys")}).encode("utf-8") + b"\n")
+            f.write(json.dumps({"op": "add", "item": item("Phone")}).encode("utf-8"))
+        self.assertEqual(self.names(self.open_store()), ["Keys"])
+
+    def test_appends_after_a_torn_record_are_replayed(self):
+        with open(self.journal_file, "wb") as f:
+            f.write(b'{"op": "add", "item": {"na')
+        store = self.open_store()
+        with server.items_lock:
+            store.add(item("Keys"))
+        store.close()
+        self.assertEqual(self.names(self.open_store()), ["Keys"])
+
+    def test_interrupted_compaction_replays_both_journals(self):
+        store = self.open_store()
+        with server.items_lock:
+            keys = store.add(item("Keys"))
+            store.add(item("Phone"))
+        store.close()
+        # Compaction rotated the journal aside, then the server stopped before the snapshot was written
+        os.replace(self.journal_file, self.journal_file + ".compacting")
+        store = self.open_store()
+        with server.items_lock:
+            store.add(item("Wallet"))
+            store.update(keys.to_dict()["id"], {"status": "resolved"})
+        store.close()
+        store = self.open_store()
+        self.assertEqual(self.names(store), ["Keys", "Phone", "Wallet"])
+        with server.items_lock:
+            self.assertEqual(store.get(keys.to_dict()["id"]).status, "resolved")
+
+class SnapshotTest(StoreTestCase):
+    def test_records_round_trip_across_chunks(self):
+        records = [server.Item(item(f"item {number}")).to_record() for number in range(25)]
+        chunk_items = server.SNAPSHOT_CHUNK_ITEMS
+        server.SNAPSHOT_CHUNK_ITEMS = 10
+        self.addCleanup(setattr, server, "SNAPSHOT_CHUNK_ITEMS", chunk_items)
+        self.assertTrue(server.write_snapshot_file(self.snapshot_file, records))
+        chunks = [list(chunk) for chunk in server.read_snapshot_chunks(self.snapshot_file)]
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+        self.assertEqual([record for chunk in chunks for record in chunk], records)
+
+    def test_item_fields_survive_a_record(self):
+        original = server.Item(dict(item("Keys", "claimed"), matched_with=str(uuid.uuid4()), claimed_by=str(uuid.uuid4()),
+                                    matched_at="2024-05-01 11:00:00", claimed_at="2024-05-01 12:00:00", brand="Acme"))
+        self.assertEqual(server.Item.from_record(original.to_record()).to_dict(), original.to_dict())
+
+    def test_truncated_snapshot_is_refused(self):
+        server.write_snapshot_file(self.snapshot_file, [server.Item(item("Keys")).to_record()])
+        with open(self.snapshot_file, "r+b") as f:
+            f.truncate(os.path.getsize(self.snapshot_file) - 5)
+        with self.assertRaises(ValueError):
+            list(server.read_snapshot_chunks(self.snapshot_file))
+
+    def test_journal_is_replayed_on_top_of_the_snapshot(self):
+        keys, phone = server.Item(item("Keys")), server.Item(item("Phone"))
+        server.write_snapshot_file(self.snapshot_file, [keys.to_record(), phone.to_record()])
+        with open(self.journal_file, "wb") as f:
+            f.write(json.dumps({"op": "remove", "id": phone.to_dict()["id"]}).encode("utf-8") + b"\n")
+            f.write(json.dumps({"op": "add", "item": item("Wallet")}).encode("utf-8") + b"\n")
+        self.assertEqual(self.names(self.open_store()), ["Keys", "Wallet"])
+
+if __name__ == "__main__":
+    unittest.main()